@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 # Script to upload software via Katapult
 #
+# The flash_serial(), flash_can(), query_can() and watch_can() coroutines
+# may be imported by other tools, the command line is a wrapper for them.
+# Given a progress callback they report through it instead of stdout.
+#
 # Copyright (C) 2022 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
@@ -10,7 +14,10 @@ import os
 import termios
 import fcntl
 import zlib
+import re
+import binascii
 import json
+import time
 import asyncio
 import socket
 import struct
@@ -20,9 +27,12 @@ import argparse
 import hashlib
 import pathlib
 import shutil
-import shlex
 import contextlib
-from typing import Dict, List, Optional, Union, Any
+import contextvars
+from typing import (
+    AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple,
+    Union, Any
+)
 HAS_SERIAL = True
 try:
     from serial import Serial, SerialException
@@ -30,26 +40,100 @@ except ModuleNotFoundError:
     HAS_SERIAL = False
     SerialException = Exception
 
+# Receives progress events, see CanFlasher._emit_progress, and status
+# messages as {"node": <name or None>, "stage": "message", "message": <line>}
+ProgressCallback = Callable[[Dict[str, Any]], None]
+
+class _OutputRedirect:
+    # Collects partial output until the line is complete
+    def __init__(self, callback: ProgressCallback) -> None:
+        self.callback = callback
+        self.pending = ""
+
+    def write_line(self, msg: str, node: Optional[str] = None) -> None:
+        msg = self.pending + msg
+        self.pending = ""
+        for line in msg.splitlines():
+            if line.strip():
+                self.callback({"node": node, "stage": "message", "message": line})
+
+# Set while an API session with a progress callback runs, each asyncio
+# task sees the redirect of the session it belongs to
+_output_redirect: contextvars.ContextVar[Optional[_OutputRedirect]] = (
+    contextvars.ContextVar("flashtool_output_redirect", default=None)
+)
+
 def output_line(msg: str) -> None:
+    redirect = _output_redirect.get()
+    if redirect is not None:
+        redirect.write_line(msg)
+        return
     sys.stdout.write(msg + "\n")
     sys.stdout.flush()
 
 def output(msg: str) -> None:
+    redirect = _output_redirect.get()
+    if redirect is not None:
+        redirect.pending += msg
+        return
     sys.stdout.write(msg)
     sys.stdout.flush()
 
-# Standard crc16 ccitt, take from msgproto.py in Klipper
-def crc16_ccitt(buf: Union[bytes, bytearray]) -> int:
-    crc = 0xffff
-    for data in buf:
-        data ^= crc & 0xff
-        data ^= (data & 0x0f) << 4
-        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
-    return crc & 0xFFFF
+# Standard crc16 ccitt, take from msgproto.py in Klipper.  The Klipper
+# variant is the bit reflected form of the CRC computed by
+# binascii.crc_hqx, so the input bytes are reversed with a 256 entry
+# table and the native implementation does the heavy lifting.
+BIT_REVERSE_TABLE = bytes(
+    int(f"{i:08b}"[::-1], 2) for i in range(256)
+)
+
+def _reflect16(crc: int) -> int:
+    return (
+        (BIT_REVERSE_TABLE[crc & 0xFF] << 8) | BIT_REVERSE_TABLE[crc >> 8]
+    )
+
+def crc16_ccitt(buf: Union[bytes, bytearray, memoryview]) -> int:
+    refl = bytes(buf).translate(BIT_REVERSE_TABLE)
+    return _reflect16(binascii.crc_hqx(refl, 0xFFFF))
+
+def crc16_ccitt_batch(
+    bufs: Iterable[Union[bytes, bytearray, memoryview]]
+) -> List[int]:
+    """
+    Calculate the crc16 of each buffer.  All buffers are reflected in a
+    single pass over the joined data, so checksumming every frame of a
+    firmware image costs one call.
+    """
+    bufs = list(bufs)
+    refl = memoryview(b"".join(bufs).translate(BIT_REVERSE_TABLE))
+    crc_hqx = binascii.crc_hqx
+    rev = BIT_REVERSE_TABLE
+    crcs: List[int] = []
+    offset = 0
+    for buf in bufs:
+        end = offset + len(buf)
+        crc = crc_hqx(refl[offset:end], 0xFFFF)
+        crcs.append((rev[crc & 0xFF] << 8) | rev[crc >> 8])
+        offset = end
+    return crcs
 
 
-logging.basicConfig(level=logging.INFO)
 CAN_FMT = "<IB3x8s"
+CAN_STRUCT = struct.Struct(CAN_FMT)
+CAN_FRAME_SIZE = CAN_STRUCT.size
+# struct canfd_frame, the flags follow the length
+CANFD_FMT = "<IBB2x64s"
+CANFD_STRUCT = struct.Struct(CANFD_FMT)
+CANFD_FRAME_SIZE = CANFD_STRUCT.size
+CANFD_BRS = 0x01
+CANFD_LENGTHS = (64, 48, 32, 24, 20, 16, 12, 8)
+CAN_RECV_BATCH = 256
+# Delay before retrying a send when the interface transmit queue is full
+CAN_SEND_RETRY_DELAY = .001
+# Frames queued per node before senders wait in drain(), and the initial
+# ring size, which leaves room for the largest Katapult message on top
+CAN_TX_QUEUE_LIMIT = 64
+CAN_TX_RING_FRAMES = 160
 CAN_READER_LIMIT = 1024 * 1024
 
 # Katapult Defs
@@ -82,6 +166,9 @@ CANBUS_CMD_SET_NODEID = 0x11
 CANBUS_CMD_CLEAR_NODE_ID = 0x12
 CANBUS_RESP_NEED_NODEID = 0x20
 CANBUS_NODEID_OFFSET = 128
+# Bounds of the backoff between repeated unassigned node queries
+DISCOVERY_MIN_INTERVAL = .05
+DISCOVERY_MAX_INTERVAL = 1.
 
 # USB IDs
 KATAPULT_USB_ID = "1d50:6177"
@@ -89,58 +176,413 @@ KLIPPER_USB_ID = "1d50:614e"
 GS_CAN_USB_ID = "1d50:606f"
 SERIAL_BL_REQ = b"~ \x1c Request Serial Bootloader!! ~"
 
+# Netlink Defs (for USB re-enumeration events)
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+
 class FlashError(Exception):
     pass
 
+class DeviceInUseError(FlashError):
+    def __init__(self, device: pathlib.Path, owner: Dict[str, Any]) -> None:
+        super().__init__(f"Serial device {device} in use")
+        self.device = device
+        self.owner = owner
+
+def _read_sysfs_attr(path: pathlib.Path) -> Optional[str]:
+    # Attributes disappear while a device is being removed
+    try:
+        return path.read_text().strip().lower()
+    except OSError:
+        return None
+
+# USB device names in sysfs, "<bus>-<port>[.<port>...]"
+USB_DEVICE_NAME_RE = re.compile(r"^\d+-\d+(\.\d+)*$")
+SYSFS_USB_DIR = pathlib.Path("/sys/bus/usb/devices")
+SERIAL_BY_PATH_DIR = pathlib.Path("/dev/serial/by-path")
+
+class UsbDeviceInventory:
+    """
+    Index of the USB devices in sysfs with their tty and network
+    interfaces, built from a single scan.  Devices are looked up by
+    sysfs name, tty name, USB ID, serial number or the CAN UUID derived
+    from the serial number.  A netlink socket collects kernel uevents,
+    which are drained on each lookup to rescan only the devices that
+    changed.  Without uevents every lookup rescans sysfs.
+    """
+    def __init__(self) -> None:
+        self._devices: Dict[str, Dict[str, Any]] = {}
+        self._by_tty: Dict[str, str] = {}
+        self._by_serial: Dict[str, str] = {}
+        self._by_uuid: Dict[int, str] = {}
+        self._by_usb_id: Dict[str, List[str]] = {}
+        self._by_path_links: Dict[str, pathlib.Path] = {}
+        self._by_path_mtime: Optional[int] = None
+        self._dirty: set = set()
+        self._full_scan = True
+        self._sock: Optional[socket.socket] = None
+        try:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+            )
+        except (OSError, AttributeError):
+            return
+        try:
+            sock.bind((0, UEVENT_KERNEL_GROUP))
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            return
+        self._sock = sock
+
+    def _drain_uevents(self) -> None:
+        if self._sock is None:
+            self._full_scan = True
+            return
+        while True:
+            try:
+                data = self._sock.recv(8192)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Receive buffer overrun, events were lost
+                self._full_scan = True
+                continue
+            for field in data.split(b"\x00"):
+                if not field.startswith(b"DEVPATH="):
+                    continue
+                for part in reversed(field[8:].decode(errors="ignore").split("/")):
+                    if USB_DEVICE_NAME_RE.match(part):
+                        self._dirty.add(part)
+                        break
+                break
+
+    def _scan_device(self, name: str) -> None:
+        sys_path = SYSFS_USB_DIR.joinpath(name)
+        self._devices.pop(name, None)
+        if not sys_path.joinpath("bDeviceClass").is_file():
+            return
+        vid = _read_sysfs_attr(sys_path.joinpath("idVendor"))
+        pid = _read_sysfs_attr(sys_path.joinpath("idProduct"))
+        serial_no = _read_sysfs_attr(sys_path.joinpath("serial")) or ""
+        uuid: Optional[int] = None
+        if serial_no:
+            with contextlib.suppress(ValueError):
+                uuid = convert_usbsn_to_uuid(serial_no)
+        # cdc_acm ttys sit directly below the interface, usb-serial
+        # (ch341, ftdi, cp210x) ttys below a port device such as ttyUSB0
+        ttys = {p.name for p in sys_path.glob(f"{name}:*/tty/tty*")}
+        ttys.update(p.name for p in sys_path.glob(f"{name}:*/tty*/tty/tty*"))
+        self._devices[name] = {
+            "sys_path": sys_path,
+            "usb_id": f"{vid}:{pid}" if vid and pid else "",
+            "manufacturer": (
+                _read_sysfs_attr(sys_path.joinpath("manufacturer")) or "unknown"
+            ),
+            "product": _read_sysfs_attr(sys_path.joinpath("product")) or "unknown",
+            "serial_number": serial_no,
+            "uuid": uuid,
+            "ttys": sorted(ttys),
+            "net": sorted(p.name for p in sys_path.glob(f"{name}:*/net/*"))
+        }
+
+    def _rebuild_index(self) -> None:
+        self._by_tty.clear()
+        self._by_serial.clear()
+        self._by_uuid.clear()
+        self._by_usb_id.clear()
+        for name, dev in self._devices.items():
+            for tty in dev["ttys"]:
+                self._by_tty[tty] = name
+            if dev["serial_number"]:
+                self._by_serial[dev["serial_number"]] = name
+            if dev["uuid"] is not None:
+                self._by_uuid[dev["uuid"]] = name
+            self._by_usb_id.setdefault(dev["usb_id"], []).append(name)
+
+    def refresh(self) -> None:
+        self._drain_uevents()
+        if self._full_scan:
+            self._full_scan = False
+            self._dirty.clear()
+            self._devices.clear()
+            with contextlib.suppress(OSError):
+                for item in SYSFS_USB_DIR.iterdir():
+                    if USB_DEVICE_NAME_RE.match(item.name):
+                        self._scan_device(item.name)
+        elif self._dirty:
+            for name in self._dirty:
+                self._scan_device(name)
+            self._dirty.clear()
+        else:
+            return
+        self._rebuild_index()
+
+    def get_device(self, name: str) -> Optional[Dict[str, Any]]:
+        self.refresh()
+        return self._devices.get(name)
+
+    def find_by_tty(self, tty_name: str) -> Optional[Dict[str, Any]]:
+        self.refresh()
+        name = self._by_tty.get(tty_name)
+        return None if name is None else self._devices[name]
+
+    def find_by_serial(self, serial_no: str) -> Optional[Dict[str, Any]]:
+        self.refresh()
+        name = self._by_serial.get(serial_no.lower())
+        return None if name is None else self._devices[name]
+
+    def find_by_uuid(self, uuid: int) -> Optional[Dict[str, Any]]:
+        self.refresh()
+        name = self._by_uuid.get(uuid)
+        return None if name is None else self._devices[name]
+
+    def find_by_usb_id(self, usb_id: str) -> List[Dict[str, Any]]:
+        self.refresh()
+        return [self._devices[name] for name in self._by_usb_id.get(usb_id, [])]
+
+    def get_by_path_link(self, tty_name: str) -> Optional[pathlib.Path]:
+        # udev creates the links after the kernel uevent, so the link
+        # table is validated against the directory mtime instead
+        try:
+            mtime = SERIAL_BY_PATH_DIR.stat().st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._by_path_mtime:
+            self._by_path_links.clear()
+            with contextlib.suppress(OSError):
+                for item in SERIAL_BY_PATH_DIR.iterdir():
+                    target = os.path.basename(os.readlink(item))
+                    self._by_path_links[target] = item
+            self._by_path_mtime = mtime
+        return self._by_path_links.get(tty_name)
+
+    def close(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+_device_inventory: Optional[UsbDeviceInventory] = None
+
+def get_device_inventory() -> UsbDeviceInventory:
+    global _device_inventory
+    if _device_inventory is None:
+        _device_inventory = UsbDeviceInventory()
+    return _device_inventory
+
 def get_usb_info(usb_path: pathlib.Path) -> Dict[str, Any]:
-    usb_info: Dict[str, Any] = {}
-    id_path = usb_path.joinpath("idVendor")
-    prod_id_path = usb_path.joinpath("idProduct")
-    mfr_path = usb_path.joinpath("manufacturer")
-    prod_path = usb_path.joinpath("product")
-    serial_path = usb_path.joinpath("serial")
-    usb_info["usb_id"] = ""
-    if id_path.is_file() and prod_id_path.is_file():
-        vid = id_path.read_text().strip().lower()
-        pid = prod_id_path.read_text().strip().lower()
-        usb_info["usb_id"] = f"{vid}:{pid}"
-    usb_info["manufacturer"] = "unknown"
-    usb_info["product"] = "unknown"
-    usb_info["serial_number"] = ""
-    if mfr_path.is_file():
-        usb_info["manufacturer"] = mfr_path.read_text().strip().lower()
-    if prod_path.is_file():
-        usb_info["product"] = prod_path.read_text().strip().lower()
-    if serial_path.is_file():
-        usb_info["serial_number"] = serial_path.read_text().strip().lower()
-    return usb_info
+    dev = get_device_inventory().get_device(usb_path.name)
+    if dev is None:
+        return {
+            "usb_id": "", "manufacturer": "unknown", "product": "unknown",
+            "serial_number": ""
+        }
+    return {
+        key: dev[key]
+        for key in ("usb_id", "manufacturer", "product", "serial_number")
+    }
 
 def get_usb_path(device: pathlib.Path) -> Optional[pathlib.Path]:
     device_path = device.resolve()
     if not device_path.exists():
         return None
-    sys_dev_path = pathlib.Path("/sys/class/tty").joinpath(device_path.name)
-    if not sys_dev_path.exists():
+    dev = get_device_inventory().find_by_tty(device_path.name)
+    return None if dev is None else dev["sys_path"]
+
+def get_usb_tty(usb_path: pathlib.Path) -> Optional[pathlib.Path]:
+    dev = get_device_inventory().get_device(usb_path.name)
+    if dev is None or len(dev["ttys"]) != 1:
+        return None
+    tty_path = pathlib.Path("/dev").joinpath(dev["ttys"][0])
+    return tty_path if tty_path.exists() else None
+
+class UsbEventMonitor:
+    """
+    Listens for kernel uevents so that USB re-enumeration is detected as
+    soon as it happens.  When the netlink socket is unavailable wait()
+    simply sleeps, which degrades to polling sysfs.
+    """
+    def __init__(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._sock: Optional[socket.socket] = None
+        try:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+            )
+        except (OSError, AttributeError):
+            logging.info("Kernel uevents unavailable, polling for USB changes")
+            return
+        try:
+            sock.bind((0, UEVENT_KERNEL_GROUP))
+            sock.setblocking(False)
+        except OSError:
+            logging.info("Kernel uevents unavailable, polling for USB changes")
+            sock.close()
+            return
+        self._sock = sock
+        self._loop.add_reader(sock.fileno(), self._handle_uevent)
+
+    def _handle_uevent(self) -> None:
+        assert self._sock is not None
+        while True:
+            try:
+                data = self._sock.recv(8192)
+            except BlockingIOError:
+                break
+            except OSError:
+                logging.exception("Uevent socket read error, closing")
+                self.close()
+                break
+            fields = data.split(b"\x00")
+            if b"SUBSYSTEM=usb" in fields or b"SUBSYSTEM=tty" in fields:
+                self._event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Wait for a USB or tty uevent.  Returns False on timeout.
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._event.clear()
+        return True
+
+    def close(self) -> None:
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+
+async def wait_usb_reconnect(
+    monitor: UsbEventMonitor,
+    usb_dev_path: pathlib.Path,
+    start_usb_id: str,
+    timeout: float = 4.
+) -> Optional[Dict[str, Any]]:
+    """
+    Wait for the device at usb_dev_path to re-enumerate with a USB ID
+    other than start_usb_id.  Returns the new device's usb info, or
+    None if the device did not come back within the timeout.
+    """
+    loop = asyncio.get_running_loop()
+    endtime = loop.time() + timeout
+    while True:
+        usb_info = get_usb_info(usb_dev_path)
+        usb_id = usb_info.get("usb_id", "")
+        if usb_id and usb_id != start_usb_id:
+            break
+        remaining = endtime - loop.time()
+        if remaining <= 0:
+            return None
+        if not await monitor.wait(min(.5, remaining)):
+            output(".")
+    # Give the tty node a moment to be created
+    tty_endtime = loop.time() + .5
+    while get_usb_tty(usb_dev_path) is None:
+        remaining = tty_endtime - loop.time()
+        if remaining <= 0:
+            break
+        await monitor.wait(remaining)
+    return get_usb_info(usb_dev_path)
+
+def _find_lock_owner(device: pathlib.Path) -> Optional[int]:
+    """
+    Returns the pid holding a lock on the device, such as the flock used
+    by pyserial's exclusive mode, or None if it is not locked.  The pid
+    is -1 for locks not owned by a process.  The lock table is read from
+    /proc/locks, opening the tty to probe it would toggle DTR and RTS
+    and reset many USB serial MCUs.
+    """
+    try:
+        st = device.stat()
+        lock_table = pathlib.Path("/proc/locks").read_text()
+    except OSError:
         return None
-    sys_dev_path = sys_dev_path.resolve()
-    for usb_path in sys_dev_path.parents:
-        dnum_file = usb_path.joinpath("devnum")
-        bnum_file = usb_path.joinpath("busnum")
-        if dnum_file.is_file() and bnum_file.is_file():
-            return usb_path
+    dev_id = (os.major(st.st_dev), os.minor(st.st_dev), st.st_ino)
+    for line in lock_table.splitlines():
+        fields = line.split()
+        # The waiters of a lock are listed with a "->" prefix
+        if len(fields) < 6 or fields[1] == "->":
+            continue
+        try:
+            major, minor, inode = fields[5].split(":")
+            lock_id = (int(major, 16), int(minor, 16), int(inode))
+            pid = int(fields[4])
+        except ValueError:
+            continue
+        if lock_id == dev_id:
+            return pid
     return None
 
-def get_stable_usb_symlink(device: pathlib.Path) -> pathlib.Path:
-    device_path = device.resolve()
-    ser_by_path_dir = pathlib.Path("/dev/serial/by-path")
+def _pid_has_open(pid: str, dev_name: str) -> bool:
     try:
-        if ser_by_path_dir.exists():
-            for item in ser_by_path_dir.iterdir():
-                if item.samefile(device_path):
-                    return item
+        with os.scandir(f"/proc/{pid}/fd") as fd_iter:
+            for entry in fd_iter:
+                with contextlib.suppress(OSError):
+                    if os.readlink(entry.path) == dev_name:
+                        return True
     except OSError:
         pass
-    return device_path
+    return False
+
+def get_process_info(pid: int) -> Dict[str, Any]:
+    proc_info: Dict[str, Any] = {
+        "pid": pid, "unit": None, "cmdline": "", "exe": ""
+    }
+    proc_dir = pathlib.Path(f"/proc/{pid}")
+    with contextlib.suppress(OSError):
+        for line in proc_dir.joinpath("cgroup").read_text().splitlines():
+            unit = line.rsplit("/", 1)[-1]
+            if unit.endswith(".service"):
+                proc_info["unit"] = unit
+                break
+    with contextlib.suppress(OSError):
+        cmdline = proc_dir.joinpath("cmdline").read_text()
+        proc_info["cmdline"] = cmdline.replace("\x00", " ").strip()
+    with contextlib.suppress(OSError):
+        proc_info["exe"] = os.readlink(proc_dir.joinpath("exe"))
+    return proc_info
+
+def find_device_owner(device: pathlib.Path) -> Optional[Dict[str, Any]]:
+    """
+    Search /proc for a process with the device open, stopping at the
+    first match.  Returns a report from get_process_info(), or None if
+    no owner was found.
+    """
+    dev_name = str(device.resolve())
+    self_pid = str(os.getpid())
+    with contextlib.suppress(OSError):
+        for pid in os.listdir("/proc"):
+            if pid.isdigit() and pid != self_pid and _pid_has_open(pid, dev_name):
+                return get_process_info(int(pid))
+    return None
+
+def check_device_owner(device: pathlib.Path) -> Optional[Dict[str, Any]]:
+    """
+    Returns a report describing the process using the device, or None
+    if the device is free.  Klipper and other pyserial users lock the
+    device, their pid is read from /proc/locks without a /proc scan.
+    Only when the device is not locked by a process we can inspect are
+    the open files of every process searched.
+    """
+    lock_pid = _find_lock_owner(device)
+    if lock_pid is not None and lock_pid > 0:
+        if os.path.isdir(f"/proc/{lock_pid}"):
+            return get_process_info(lock_pid)
+    owner = find_device_owner(device)
+    if owner is None and lock_pid is not None:
+        # Locked by a process we cannot inspect
+        owner = {"pid": None, "unit": None, "cmdline": "", "exe": ""}
+    return owner
+
+def get_stable_usb_symlink(device: pathlib.Path) -> pathlib.Path:
+    device_path = device.resolve()
+    link = get_device_inventory().get_by_path_link(device_path.name)
+    return link if link is not None else device_path
 
 
 #  Python Port of fasthash6
@@ -208,21 +650,697 @@ def convert_usbsn_to_uuid(serial_number: str) -> int:
         swapped |= ((result >> (i * 8)) & 0xFF) << ((5 - i) * 8)
     return swapped
 
+# zlib stream header: CM = 8 with a 32K window followed by a FLG byte
+# for one of the four compression levels
+ZLIB_HEADER_RE = re.compile(rb"\x78[\x01\x5e\x9c\xda]")
+
+def find_klipper_dict(
+    bin_data: Union[bytes, bytearray, memoryview]
+) -> Optional[Dict[str, Any]]:
+    """
+    Locate the compressed data dictionary embedded in a Klipper binary.
+    The image is scanned once for zlib stream headers and only those
+    offsets are decompressed.  Candidates that do not inflate to a JSON
+    object are rejected after the first few bytes.
+    """
+    view = memoryview(bin_data)
+    for match in ZLIB_HEADER_RE.finditer(view):
+        idx = match.start()
+        decomp = zlib.decompressobj()
+        try:
+            uncmp_data = decomp.decompress(view[idx:idx + 64])
+            if uncmp_data and not uncmp_data.startswith(b"{"):
+                continue
+            uncmp_data += decomp.decompress(view[idx + 64:])
+            if not decomp.eof:
+                continue
+            klipper_dict = json.loads(uncmp_data)
+        except (zlib.error, json.JSONDecodeError, UnicodeDecodeError):
+            continue
+        if (
+            isinstance(klipper_dict, dict) and
+            klipper_dict.get("app") == "Klipper"
+        ):
+            return klipper_dict
+    return None
+
+def get_firmware_info(fw_file: pathlib.Path) -> Dict[str, Any]:
+    """
+    Returns the Klipper version and MCU type of a firmware image.  Both
+    values are empty strings if the image does not contain a Klipper
+    data dictionary.
+    """
+    info = PreparedImageCache().get_info(fw_file)
+    return {"version": info["version"], "mcu": info["mcu"]}
+
+FLASHTOOL_CACHE_DIR = pathlib.Path("~/.cache/flashtool").expanduser()
+
+# Upper bounds, in milliseconds, of the round trip histogram buckets
+RTT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+# Retransmission timer bounds in seconds.  The initial and maximum
+# timeouts match the fixed timeout used before any round trip is measured.
+RTO_INITIAL = 2.
+RTO_MIN = .1
+RTO_MAX = 2.
+RETRY_DELAY_MAX = .75
+BUSY_DELAY_MIN = .01
+BUSY_DELAY_MAX = 1.5
+
+class RttEstimator:
+    """
+    Smoothed round trip time and variance of a bootloader connection,
+    computed as for TCP retransmission timers (RFC 6298).  The timeout
+    doubles on every expiry and returns to the estimate with the next
+    valid sample.  The time a bootloader stays busy is measured the same
+    way, so the first wait after a busy response matches past behavior.
+    """
+    def __init__(self) -> None:
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.
+        self.rto = RTO_INITIAL
+        self.backoff = 1
+        self.samples = 0
+        self.expired = 0
+        self.busy_time: Optional[float] = None
+        self.busy_backoff = 1
+
+    def update(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.
+        else:
+            self.rttvar = .75 * self.rttvar + .25 * abs(self.srtt - rtt)
+            self.srtt = .875 * self.srtt + .125 * rtt
+        self.rto = min(RTO_MAX, max(RTO_MIN, self.srtt + 4. * self.rttvar))
+        self.backoff = 1
+        self.samples += 1
+
+    def expire(self) -> None:
+        self.expired += 1
+        if self.timeout < RTO_MAX:
+            self.backoff *= 2
+
+    @property
+    def timeout(self) -> float:
+        return min(RTO_MAX, self.rto * self.backoff)
+
+    @property
+    def retry_delay(self) -> float:
+        return min(RETRY_DELAY_MAX, self.timeout)
+
+    def next_busy_delay(self) -> float:
+        if self.busy_time is not None:
+            # Start at half the measured busy time so the estimate can
+            # shrink again when the bootloader speeds up
+            delay = self.busy_time / 2.
+        else:
+            delay = self.srtt or BUSY_DELAY_MIN
+        delay = min(BUSY_DELAY_MAX, max(BUSY_DELAY_MIN, delay) * self.busy_backoff)
+        self.busy_backoff *= 2
+        return delay
+
+    def record_busy(self, duration: float) -> None:
+        if self.busy_time is None:
+            self.busy_time = duration
+        else:
+            self.busy_time = .75 * self.busy_time + .25 * duration
+        self.busy_backoff = 1
+
+    def get_state(self) -> Dict[str, Any]:
+        return {
+            "srtt_ms": (self.srtt or 0.) * 1000.,
+            "rttvar_ms": self.rttvar * 1000.,
+            "rto_ms": self.rto * 1000.,
+            "timeout_ms": self.timeout * 1000.,
+            "samples": self.samples,
+            "expired": self.expired,
+            "busy_time_ms": (
+                None if self.busy_time is None else self.busy_time * 1000.
+            )
+        }
+
+class FlashTelemetry:
+    """
+    Collects wall time per phase, command round trip times, retry
+    counters and transfer sizes for a flash session.  Concurrent CAN
+    flashers each get a child instance, reported under "nodes".
+    """
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.transfer_bytes: Dict[str, int] = {}
+        self.commands: Dict[str, Dict[str, Any]] = {}
+        self.nodes: Dict[str, FlashTelemetry] = {}
+        self.info: Dict[str, Any] = {}
+        self.estimator: Optional[RttEstimator] = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.phases[name] = self.phases.get(name, 0.) + elapsed
+
+    def node(self, name: str) -> FlashTelemetry:
+        return self.nodes.setdefault(name, FlashTelemetry())
+
+    def _command_stats(self, cmdname: str) -> Dict[str, Any]:
+        if cmdname not in self.commands:
+            self.commands[cmdname] = {
+                "count": 0, "rtt_total": 0., "rtt_min": None, "rtt_max": 0.,
+                "histogram": [0] * (len(RTT_BUCKETS_MS) + 1),
+                "events": {}
+            }
+        return self.commands[cmdname]
+
+    def record_rtt(self, cmdname: str, rtt: float) -> None:
+        stats = self._command_stats(cmdname)
+        stats["count"] += 1
+        stats["rtt_total"] += rtt
+        stats["rtt_max"] = max(stats["rtt_max"], rtt)
+        if stats["rtt_min"] is None or rtt < stats["rtt_min"]:
+            stats["rtt_min"] = rtt
+        rtt_ms = rtt * 1000.
+        for idx, bound in enumerate(RTT_BUCKETS_MS):
+            if rtt_ms <= bound:
+                break
+        else:
+            idx = len(RTT_BUCKETS_MS)
+        stats["histogram"][idx] += 1
+
+    def record_event(self, cmdname: str, event: str) -> None:
+        events = self._command_stats(cmdname)["events"]
+        events[event] = events.get(event, 0) + 1
+
+    def add_bytes(self, phase: str, count: int) -> None:
+        self.transfer_bytes[phase] = self.transfer_bytes.get(phase, 0) + count
+
+    def get_report(self) -> Dict[str, Any]:
+        commands: Dict[str, Any] = {}
+        for cmdname, stats in self.commands.items():
+            count = stats["count"]
+            labels = [f"<={b}ms" for b in RTT_BUCKETS_MS]
+            labels.append(f">{RTT_BUCKETS_MS[-1]}ms")
+            commands[cmdname] = {
+                "count": count,
+                "rtt_min_ms": (stats["rtt_min"] or 0.) * 1000.,
+                "rtt_avg_ms": stats["rtt_total"] / count * 1000. if count else 0.,
+                "rtt_max_ms": stats["rtt_max"] * 1000.,
+                "rtt_histogram": dict(zip(labels, stats["histogram"])),
+                "events": dict(stats["events"])
+            }
+        throughput: Dict[str, float] = {}
+        for phase, count in self.transfer_bytes.items():
+            elapsed = self.phases.get(phase, 0.)
+            if elapsed > 0.:
+                throughput[phase] = count / elapsed
+        report: Dict[str, Any] = dict(self.info)
+        report.update({
+            "phases": dict(self.phases),
+            "bytes": dict(self.transfer_bytes),
+            "bytes_per_second": throughput,
+            "commands": commands
+        })
+        if self.estimator is not None:
+            report["rtt_estimator"] = self.estimator.get_state()
+        if self.nodes:
+            report["nodes"] = {
+                name: node.get_report() for name, node in self.nodes.items()
+            }
+        return report
+
+    def write_report(self, dest: str) -> None:
+        report = json.dumps(self.get_report(), indent=2)
+        if dest == "-":
+            output_line(report)
+            return
+        try:
+            pathlib.Path(dest).expanduser().write_text(report + "\n")
+        except OSError:
+            logging.exception("Unable to write telemetry report")
+
+# Katapult erases a flash page when the first block of that page is
+# written, so a differential flash must rewrite every block of a page
+# that contains a change.  Page (or sector) sizes are looked up by the
+# MCU type reported by the bootloader.
+ERASE_PAGE_SIZES = {
+    "rp2040": 4096,
+    "stm32f0": 2048,
+    "stm32f1": 2048,
+    "stm32f3": 2048,
+    "stm32g0": 2048,
+    "stm32g4": 4096,
+    "stm32l4": 2048
+}
+STM32_FLASH_BASE = 0x08000000
+STM32_SECTOR_SIZES = [0x4000] * 4 + [0x10000] + [0x20000] * 11
+
+def get_erase_unit(mcu_type: str, address: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the start address and size of the flash page containing
+    the address, or None if the page layout of the MCU is unknown.
+    """
+    mcu_type = mcu_type.lower()
+    if mcu_type.startswith(("stm32f2", "stm32f4")):
+        start = STM32_FLASH_BASE
+        for size in STM32_SECTOR_SIZES:
+            if start <= address < start + size:
+                return start, size
+            start += size
+        return None
+    for prefix, size in ERASE_PAGE_SIZES.items():
+        if mcu_type.startswith(prefix):
+            return address - address % size, size
+    return None
+
+def block_digest(buf: Union[bytes, bytearray]) -> str:
+    # Content digest of a flash block, unrelated to the frame CRC
+    return hashlib.blake2b(buf, digest_size=8).hexdigest()
+
+# Number of blocks read back before an interrupted flash is resumed
+RESUME_VERIFY_BLOCKS = 4
+
+class FlashStateCache:
+    """
+    Records the block digests of the last image written to each device,
+    keyed by the CAN UUID or USB serial number of the device.  When a
+    write is interrupted the entry instead holds a checkpoint, the
+    address of the first block not acknowledged by the bootloader.
+    """
+    def __init__(
+        self, path: pathlib.Path = FLASHTOOL_CACHE_DIR.joinpath("flash_state.json")
+    ) -> None:
+        self.path = path
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            state = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def get_digests(
+        self, device_id: str, block_size: int, app_start: int
+    ) -> Optional[List[str]]:
+        entry = self._load().get(device_id)
+        if (
+            not isinstance(entry, dict) or
+            entry.get("block_size") != block_size or
+            entry.get("app_start") != app_start
+        ):
+            return None
+        return entry.get("digests")
+
+    def set_digests(
+        self,
+        device_id: str,
+        block_size: int,
+        app_start: int,
+        digests: List[str],
+        image_sha1: str
+    ) -> None:
+        state = self._load()
+        state[device_id] = {
+            "block_size": block_size,
+            "app_start": app_start,
+            "sha1": image_sha1,
+            "digests": digests
+        }
+        self._save(state)
+
+    def get_checkpoint(
+        self, device_id: str, block_size: int, app_start: int,
+        image_sha1: str
+    ) -> Optional[int]:
+        entry = self._load().get(device_id)
+        if (
+            not isinstance(entry, dict) or
+            entry.get("block_size") != block_size or
+            entry.get("app_start") != app_start or
+            entry.get("sha1") != image_sha1
+        ):
+            return None
+        address = entry.get("checkpoint")
+        return address if isinstance(address, int) else None
+
+    def set_checkpoint(
+        self,
+        device_id: str,
+        block_size: int,
+        app_start: int,
+        image_sha1: str,
+        address: int
+    ) -> None:
+        # The flash holds a partial image, the block digests are dropped
+        state = self._load()
+        state[device_id] = {
+            "block_size": block_size,
+            "app_start": app_start,
+            "sha1": image_sha1,
+            "checkpoint": address
+        }
+        self._save(state)
+
+    def _save(self, state: Dict[str, Any]) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(state))
+            tmp_path.replace(self.path)
+        except OSError:
+            logging.exception("Unable to save flash state")
+
+    def clear(self, device_id: str) -> None:
+        state = self._load()
+        if state.pop(device_id, None) is not None:
+            self._save(state)
+
+class PreparedImageCache:
+    """
+    Content addressed store of prepared firmware images, keyed by the
+    SHA-256 of the image file.  An entry holds the Klipper version and
+    MCU parsed from the image and, per block size, the padded image,
+    its block digests and the SHA1 expected by verification.  An index
+    maps image paths to their SHA-256 by inode, size, modification and
+    change time, so an unchanged image is neither re-read nor re-hashed.
+    The change time can't be set from user space, it catches an image
+    replaced with the same size and modification time (cp -p, rsync or
+    tar extraction).
+    """
+    def __init__(
+        self, path: pathlib.Path = FLASHTOOL_CACHE_DIR.joinpath("images")
+    ) -> None:
+        self.path = path
+
+    def _read_json(self, path: pathlib.Path) -> Dict[str, Any]:
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _write_file(self, path: pathlib.Path, data: Union[str, bytes]) -> None:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            if isinstance(data, str):
+                tmp_path.write_text(data)
+            else:
+                tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+        except OSError:
+            logging.exception(f"Unable to write image cache file {path}")
+
+    def _lookup(
+        self, fw_file: pathlib.Path
+    ) -> Tuple[str, Optional[bytes]]:
+        """
+        Returns the SHA-256 of an image and, if the file had to be read
+        to compute it, the image data.
+        """
+        fw_file = fw_file.resolve()
+        st = fw_file.stat()
+        index = self._read_json(self.path.joinpath("index.json"))
+        entry = index.get(str(fw_file))
+        file_key = {
+            "inode": st.st_ino, "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns, "ctime_ns": st.st_ctime_ns
+        }
+        if (
+            isinstance(entry, dict) and
+            all(entry.get(k) == v for k, v in file_key.items()) and
+            self.path.joinpath(entry.get("sha256", ""), "info.json").is_file()
+        ):
+            return entry["sha256"], None
+        data = fw_file.read_bytes()
+        sha256 = hashlib.sha256(data).hexdigest()
+        self._update_index(str(fw_file), dict(file_key, sha256=sha256))
+        return sha256, data
+
+    def _update_index(self, key: str, entry: Dict[str, Any]) -> None:
+        # Concurrent flashes share the index, the lock keeps the read,
+        # modify and write of one from dropping the update of another
+        index_path = self.path.joinpath("index.json")
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            lock_fd = os.open(
+                str(self.path.joinpath("index.lock")), os.O_RDWR | os.O_CREAT,
+                0o644
+            )
+        except OSError:
+            logging.exception("Unable to lock image cache index")
+            return
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            index = self._read_json(index_path)
+            index[key] = entry
+            self._write_file(index_path, json.dumps(index))
+        finally:
+            os.close(lock_fd)
+
+    def get_info(
+        self, fw_file: pathlib.Path, data: Optional[bytes] = None
+    ) -> Dict[str, Any]:
+        """
+        Returns the SHA-256, size, Klipper version and MCU of an image.
+        The version and MCU are empty strings if the image does not
+        contain a Klipper data dictionary.
+        """
+        if data is None:
+            sha256, data = self._lookup(fw_file)
+        else:
+            sha256 = hashlib.sha256(data).hexdigest()
+        info_path = self.path.joinpath(sha256, "info.json")
+        info = self._read_json(info_path)
+        if not info:
+            if data is None:
+                data = fw_file.read_bytes()
+            info = {"size": len(data), "version": "", "mcu": "", "blocks": {}}
+            klipper_dict = find_klipper_dict(data)
+            if klipper_dict is not None:
+                info["version"] = klipper_dict.get("version", "")
+                info["mcu"] = klipper_dict.get("config", {}).get("MCU", "")
+            self._write_file(info_path, json.dumps(info))
+        info["sha256"] = sha256
+        return info
+
+    def get_image(
+        self, fw_file: pathlib.Path, block_size: int
+    ) -> Dict[str, Any]:
+        """
+        Returns the image info with the image padded to a multiple of
+        the block size ("data"), the digest of each block ("digests")
+        and the SHA1 of the padded image ("sha1").
+        """
+        sha256, data = self._lookup(fw_file)
+        info = self.get_info(fw_file, data)
+        entry_path = self.path.joinpath(sha256)
+        image_path = entry_path.joinpath(f"image-{block_size}.bin")
+        blocks = info["blocks"].get(str(block_size))
+        if blocks is not None:
+            try:
+                padded = image_path.read_bytes()
+            except OSError:
+                pass
+            else:
+                # Guard against a truncated or damaged cache entry
+                if hashlib.sha1(padded).hexdigest().upper() == blocks["sha1"]:
+                    info.update(blocks, data=padded)
+                    return info
+        if data is None:
+            data = fw_file.read_bytes()
+        pad_len = -len(data) % block_size
+        padded = data + b"\xFF" * pad_len
+        blocks = {
+            "sha1": hashlib.sha1(padded).hexdigest().upper(),
+            "digests": [
+                block_digest(padded[offset:offset + block_size])
+                for offset in range(0, len(padded), block_size)
+            ]
+        }
+        self._write_file(image_path, padded)
+        info["blocks"][str(block_size)] = blocks
+        self._write_file(
+            entry_path.joinpath("info.json"),
+            json.dumps({k: v for k, v in info.items() if k != "sha256"})
+        )
+        info.update(blocks, data=padded)
+        return info
+
+KLIPPY_SOCKET_PATH = pathlib.Path("~/printer_data/comms/klippy.sock")
+KLIPPY_API_LIMIT = 4 * 1024 * 1024
+
+async def klippy_request(
+    sock_path: pathlib.Path,
+    method: str,
+    params: Dict[str, Any],
+    timeout: float = 2.
+) -> Dict[str, Any]:
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_unix_connection(
+            str(sock_path.expanduser()), limit=KLIPPY_API_LIMIT
+        ),
+        timeout
+    )
+    try:
+        request = {"id": 1, "method": method, "params": params}
+        writer.write(json.dumps(request).encode() + b"\x03")
+        await writer.drain()
+        while True:
+            data = await asyncio.wait_for(reader.readuntil(b"\x03"), timeout)
+            response = json.loads(data[:-1])
+            if response.get("id") == 1:
+                break
+    finally:
+        writer.close()
+    if "error" in response:
+        raise FlashError(f"Klippy API error: {response['error']}")
+    return response.get("result", {})
+
+async def get_running_firmware(
+    sock_path: pathlib.Path,
+    device: Optional[str] = None,
+    uuid: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Look up the Klipper MCU configured for a serial device or CAN uuid
+    and return its section name, running version and MCU type.  Returns
+    None if Klipper does not know the device or has not identified it.
+    """
+    result = await klippy_request(
+        sock_path, "objects/query", {"objects": {"configfile": ["settings"]}}
+    )
+    settings = result.get("status", {}).get("configfile", {}).get("settings", {})
+    dev_path = pathlib.Path(device).resolve() if device is not None else None
+    mcu_name: Optional[str] = None
+    for name, section in settings.items():
+        if name != "mcu" and not name.startswith("mcu "):
+            continue
+        serial = section.get("serial")
+        if dev_path is not None and serial:
+            if pathlib.Path(serial).resolve() == dev_path:
+                mcu_name = name
+                break
+        can_uuid = section.get("canbus_uuid")
+        if uuid is not None and can_uuid:
+            if int(can_uuid, 16) == uuid:
+                mcu_name = name
+                break
+    if mcu_name is None:
+        return None
+    result = await klippy_request(
+        sock_path, "objects/query",
+        {"objects": {mcu_name: ["mcu_version", "mcu_constants"]}}
+    )
+    status = result.get("status", {}).get(mcu_name, {})
+    version = status.get("mcu_version")
+    if not version:
+        return None
+    return {
+        "name": mcu_name,
+        "version": version,
+        "mcu": (status.get("mcu_constants") or {}).get("MCU", "")
+    }
+
+async def check_firmware_current(
+    fw_file: pathlib.Path,
+    sock_path: pathlib.Path = KLIPPY_SOCKET_PATH,
+    device: Optional[str] = None,
+    uuid: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Compare the version of a firmware image with the version running on
+    the device, as reported by the Klippy API.  The USB product string
+    of a device running Klipper is the MCU type, a mismatch there rules
+    out a match without asking Klippy.
+    """
+    fw_info = PreparedImageCache().get_info(fw_file)
+    result: Dict[str, Any] = {
+        "image_version": fw_info["version"],
+        "image_mcu": fw_info["mcu"],
+        "running_version": None,
+        "running_mcu": None,
+        "mcu_name": None,
+        "up_to_date": False
+    }
+    if not fw_info["version"]:
+        return result
+    if device is not None:
+        usb_path = get_usb_path(pathlib.Path(device))
+        if usb_path is not None:
+            usb_info = get_usb_info(usb_path)
+            if (
+                usb_info.get("manufacturer") != "klipper" and
+                usb_info.get("usb_id") != KLIPPER_USB_ID
+            ):
+                # Not running Klipper, most likely already in Katapult
+                return result
+            product = usb_info.get("product")
+            if product and fw_info["mcu"] and product != fw_info["mcu"]:
+                result["running_mcu"] = product
+                return result
+    try:
+        running = await get_running_firmware(sock_path, device, uuid)
+    except (OSError, ValueError, FlashError, asyncio.TimeoutError) as e:
+        logging.info(f"Unable to query running firmware from Klippy: {e}")
+        return result
+    if running is None:
+        return result
+    result["running_version"] = running["version"]
+    result["running_mcu"] = running["mcu"]
+    result["mcu_name"] = running["name"]
+    result["up_to_date"] = (
+        running["version"] == fw_info["version"] and
+        (not running["mcu"] or not fw_info["mcu"] or
+         running["mcu"] == fw_info["mcu"])
+    )
+    return result
+
 class CanFlasher:
     def __init__(
         self,
         node: CanNode,
-        fw_file: pathlib.Path
+        fw_file: pathlib.Path,
+        window: int = 1,
+        diff_mode: bool = False,
+        device_id: Optional[str] = None,
+        name: Optional[str] = None,
+        telemetry: Optional[FlashTelemetry] = None,
+        progress: Optional[ProgressCallback] = None
     ) -> None:
         self.node = node
+        self.progress = progress
+        self.telemetry = telemetry or FlashTelemetry()
+        self.rtt = RttEstimator()
+        self.telemetry.estimator = self.rtt
         self.firmware_path = fw_file
-        self.fw_sha = hashlib.sha1()
+        self.window = max(1, window)
+        self.diff_mode = diff_mode
+        self.device_id = device_id
+        self.name = name
+        self.mcu_type = ""
+        self.image_blocks: List[bytes] = []
+        self.image_digests: List[str] = []
+        self.verify_range: Optional[Tuple[int, int]] = None
+        self.contents_cached = False
+        self.image_sha1 = ""
+        self.write_acked: set = set()
+        self.checkpoint_saved = False
+        self.partial_write = False
+        self.partial_verify_failed = False
         self.primed = False
         self.file_size = 0
         self.block_size = 64
         self.block_count = 0
+        self.last_percent = 0.
+        self.progress_total = 0
+        self.progress_count = 0
+        self.progress_label = ""
         self.app_start_addr = 0
-        self.klipper_dict: Optional[Dict[str, Any]] = None
+        self.image_cache = PreparedImageCache()
+        self.fw_info: Optional[Dict[str, Any]] = None
         self._check_binary()
 
     def _check_binary(self) -> None:
@@ -232,35 +1350,34 @@ class CanFlasher:
         fw_name = self.firmware_path.name.lower()
         if fw_name != "klipper.bin" or not self.firmware_path.is_file():
             return
-        bin_data = self.firmware_path.read_bytes()
-        klipper_dict: Dict[str, Any] = {}
-        for idx in range(len(bin_data)):
-            try:
-                uncmp_data = zlib.decompress(bin_data[idx:])
-                klipper_dict = json.loads(uncmp_data)
-            except (zlib.error, json.JSONDecodeError):
-                continue
-            if klipper_dict.get("app") == "Klipper":
-                break
-        if klipper_dict:
-            self.klipper_dict = klipper_dict
-            ver = klipper_dict.get("version", "")
-            bin_mcu = self.klipper_dict.get("config", {}).get("MCU", "")
-            output_line(
-                f"Detected Klipper binary version {ver}, MCU: {bin_mcu}"
+        fw_info = self.image_cache.get_info(self.firmware_path)
+        if fw_info["version"] or fw_info["mcu"]:
+            self.fw_info = fw_info
+            self._output_line(
+                f"Detected Klipper binary version {fw_info['version']}, "
+                f"MCU: {fw_info['mcu']}"
             )
 
     def _build_command(self, cmd: int, payload: bytes) -> bytearray:
-        word_cnt = (len(payload) // 4) & 0xFF
-        out_cmd = bytearray(CMD_HEADER)
-        out_cmd.append(cmd)
-        out_cmd.append(word_cnt)
-        if payload:
-            out_cmd.extend(payload)
-        crc = crc16_ccitt(out_cmd[2:])
-        out_cmd.extend(struct.pack("<H", crc))
-        out_cmd.extend(CMD_TRAILER)
-        return out_cmd
+        return self._build_commands(cmd, [payload])[0]
+
+    def _build_commands(
+        self, cmd: int, payloads: List[bytes]
+    ) -> List[bytearray]:
+        out_cmds: List[bytearray] = []
+        for payload in payloads:
+            word_cnt = (len(payload) // 4) & 0xFF
+            out_cmd = bytearray(CMD_HEADER)
+            out_cmd.append(cmd)
+            out_cmd.append(word_cnt)
+            if payload:
+                out_cmd.extend(payload)
+            out_cmds.append(out_cmd)
+        crcs = crc16_ccitt_batch([c[2:] for c in out_cmds])
+        for out_cmd, crc in zip(out_cmds, crcs):
+            out_cmd.extend(struct.pack("<H", crc))
+            out_cmd.extend(CMD_TRAILER)
+        return out_cmds
 
     def prime(self) -> None:
         # Prime with an invalid command.  This will generate an error
@@ -271,7 +1388,7 @@ class CanFlasher:
         self.primed = True
 
     async def connect_btl(self) -> None:
-        output_line("Attempting to connect to bootloader")
+        self._output_line("Attempting to connect to bootloader")
         ret = await self.send_command('CONNECT')
         pinfo = ret[:12]
         mcu_info = ret[12:]
@@ -290,10 +1407,19 @@ class CanFlasher:
             if len(build_info) == 2:
                 self.software_version = build_info[1].decode()
             else:
-                output_line("Katapult build not reporting software version!")
+                self._output_line(
+                    "Katapult build not reporting software version!"
+                )
         else:
             mcu_type = mcu_info.decode()
-        output_line(
+        self.mcu_type = mcu_type
+        self.telemetry.info.update({
+            "mcu_type": mcu_type,
+            "katapult_version": self.software_version,
+            "block_size": self.block_size,
+            "app_start": self.app_start_addr
+        })
+        self._output_line(
             f"Katapult Connected\n"
             f"Software Version: {self.software_version}\n"
             f"Protocol Version: {proto_version_str}\n"
@@ -301,8 +1427,8 @@ class CanFlasher:
             f"Application Start: 0x{self.app_start_addr:4X}\n"
             f"MCU type: {mcu_type}"
         )
-        if self.klipper_dict is not None:
-            bin_mcu = self.klipper_dict.get("config", {}).get("MCU", "")
+        if self.fw_info is not None:
+            bin_mcu = self.fw_info["mcu"]
             if bin_mcu and bin_mcu != mcu_type:
                 raise FlashError(
                     "MCU returned by Katapult does not match MCU "
@@ -312,178 +1438,687 @@ class CanFlasher:
                 )
 
     async def verify_canbus_uuid(self, uuid):
-        output_line("Verifying canbus connection")
+        self._output_line("Verifying canbus connection")
         ret = await self.send_command('GET_CANBUS_ID')
         mcu_uuid = sum([v << ((5 - i) * 8) for i, v in enumerate(ret[:6])])
         if mcu_uuid != uuid:
             raise FlashError("UUID mismatch (%s vs %s)" % (uuid, mcu_uuid))
 
+    async def _read_frame(
+        self, timeout: Optional[float] = 2.
+    ) -> bytearray:
+        data = bytearray()
+        read_done = False
+        while not read_done:
+            ret = await self.node.readuntil(CMD_TRAILER, timeout)
+            data.extend(ret)
+            while len(data) > 7:
+                if data[:2] != CMD_HEADER:
+                    data = data[1:]
+                    continue
+                recd_len = data[3] * 4
+                read_done = len(data) == recd_len + 8
+                break
+            if self.primed and read_done:
+                data.clear()
+                self.primed = False
+                read_done = False
+        return data
+
+    def _parse_frame(
+        self, cmdname: str, data: bytearray
+    ) -> Optional[Tuple[int, int, bytearray]]:
+        """
+        Validate a response frame.  Returns a tuple containing the
+        ack code, the acknowledged command and the payload, or None
+        if the frame is corrupt.
+        """
+        trailer = data[-2:]
+        recd_crc, = struct.unpack("<H", data[-4:-2])
+        calc_crc = crc16_ccitt(data[2:-4])
+        recd_len = data[3] * 4
+        if trailer != CMD_TRAILER:
+            logging.info(
+                f"Command '{cmdname}': Invalid Trailer Received "
+                f"0x{trailer.hex()}"
+            )
+            return None
+        if recd_crc != calc_crc:
+            logging.info(
+                f"Command '{cmdname}': Frame CRC Mismatch, expected: "
+                f"{calc_crc}, received {recd_crc}"
+            )
+            return None
+        cmd_response = 0
+        if recd_len:
+            cmd_response, = struct.unpack("<I", data[4:8])
+        payload = bytearray()
+        if recd_len > 4:
+            payload = data[8:recd_len + 4]
+        return data[2], cmd_response, payload
+
+    async def _drain_input(self, timeout: float = .25) -> None:
+        while True:
+            try:
+                ret = await self.node.read(1024, timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+            if not ret:
+                break
+            logging.info(f"Read Buffer Contents: {ret!r}")
+
     async def send_command(
         self,
         cmdname: str,
         payload: bytes = b"",
-        tries: int = 5
+        tries: int = 5,
+        out_cmd: Optional[bytearray] = None,
+        timeout: Optional[float] = None
     ) -> bytearray:
+        """
+        Send a command and return the response payload.  Without an
+        explicit timeout the response timeout follows the measured round
+        trip time.  Timeouts shorter than RTO_MAX back off and do not
+        count as a try, so slow responses are waited out as before.
+        """
         cmd = BOOTLOADER_CMDS[cmdname]
-        out_cmd = self._build_command(cmd, payload)
+        if out_cmd is None:
+            out_cmd = self._build_command(cmd, payload)
         last_err = Exception()
+        telemetry = self.telemetry
+        rtt = self.rtt
+        attempts = 0
+        busy_start: Optional[float] = None
         while tries:
-            data = bytearray()
-            recd_len = 0
+            wait = rtt.timeout if timeout is None else timeout
+            count_try = True
             try:
                 self.node.write(out_cmd)
-                read_done = False
-                while not read_done:
-                    ret = await self.node.readuntil(CMD_TRAILER)
-                    data.extend(ret)
-                    while len(data) > 7:
-                        if data[:2] != CMD_HEADER:
-                            data = data[1:]
-                            continue
-                        recd_len = data[3] * 4
-                        read_done = len(data) == recd_len + 8
-                        break
-                    if self.primed and read_done:
-                        recd_len = 0
-                        data.clear()
-                        self.primed = False
-                        read_done = False
+                await self.node.drain()
+                start = time.monotonic()
+                attempts += 1
+                data = await self._read_frame(wait)
             except asyncio.CancelledError:
                 raise
             except asyncio.TimeoutError:
+                telemetry.record_event(cmdname, "timeout")
+                if timeout is None:
+                    rtt.expire()
+                    count_try = wait >= RTO_MAX
                 logging.info(
-                    f"Response for command {cmdname} timed out, "
-                    f"{tries - 1} tries remaining"
+                    f"Response for command {cmdname} timed out after "
+                    f"{wait * 1000:.0f} ms, {tries - count_try} tries remaining"
                 )
             except Exception as e:
+                telemetry.record_event(cmdname, "read_error")
                 if type(e) is type(last_err) and e.args == last_err.args:
                     last_err = e
                     logging.exception("Device Read Error")
             else:
-                trailer = data[-2:]
-                recd_crc, = struct.unpack("<H", data[-4:-2])
-                calc_crc = crc16_ccitt(data[2:-4])
-                recd_ack = data[2]
-                cmd_response = 0
-                if recd_len:
-                    cmd_response, = struct.unpack("<I", data[4:8])
-                if trailer != CMD_TRAILER:
-                    logging.info(
-                        f"Command '{cmdname}': Invalid Trailer Received "
-                        f"0x{trailer.hex()}"
-                    )
-                elif recd_crc != calc_crc:
-                    logging.info(
-                        f"Command '{cmdname}': Frame CRC Mismatch, expected: "
-                        f"{calc_crc}, received {recd_crc}"
-                    )
-                elif recd_ack == ACK_ERROR:
-                    logging.info(f"Command '{cmdname}': Received Error Response")
-                elif recd_ack == ACK_BUSY:
-                    logging.info(f"Command '{cmdname}': Received busy signal")
-                    await asyncio.sleep(1.5)
-                elif recd_ack != ACK_SUCCESS:
-                    logging.info(f"Command '{cmdname}': Received NACK")
-                elif cmd_response != cmd:
-                    logging.info(
-                        f"Command '{cmdname}': Acknowledged wrong command, "
-                        f"expected: {cmd:2x}, received: {cmd_response:2x}"
-                    )
+                result = self._parse_frame(cmdname, data)
+                if result is None:
+                    telemetry.record_event(cmdname, "corrupt")
                 else:
-                    # Validation passed, return payload sans command
-                    if recd_len <= 4:
-                        return bytearray()
-                    return data[8:recd_len + 4]
-            tries -= 1
-            # clear the read buffer
+                    recd_ack, cmd_response, resp_payload = result
+                    if recd_ack == ACK_ERROR:
+                        telemetry.record_event(cmdname, "error")
+                        logging.info(
+                            f"Command '{cmdname}': Received Error Response"
+                        )
+                    elif recd_ack == ACK_BUSY:
+                        telemetry.record_event(cmdname, "busy")
+                        if busy_start is None:
+                            busy_start = start
+                        delay = rtt.next_busy_delay()
+                        logging.info(
+                            f"Command '{cmdname}': Received busy signal, "
+                            f"retrying in {delay * 1000:.0f} ms"
+                        )
+                        await asyncio.sleep(delay)
+                        # Busy responses only count as a try once the
+                        # backoff has reached its limit
+                        if delay < BUSY_DELAY_MAX:
+                            continue
+                    elif recd_ack != ACK_SUCCESS:
+                        telemetry.record_event(cmdname, "nack")
+                        logging.info(f"Command '{cmdname}': Received NACK")
+                    elif cmd_response != cmd:
+                        telemetry.record_event(cmdname, "wrong_command")
+                        logging.info(
+                            f"Command '{cmdname}': Acknowledged wrong command, "
+                            f"expected: {cmd:2x}, received: {cmd_response:2x}"
+                        )
+                    else:
+                        # Validation passed, return payload sans command
+                        elapsed = time.monotonic() - start
+                        telemetry.record_rtt(cmdname, elapsed)
+                        if busy_start is not None:
+                            rtt.record_busy(time.monotonic() - busy_start)
+                        elif timeout is None and attempts == 1:
+                            # Only unambiguous round trips are sampled
+                            rtt.update(elapsed)
+                        return resp_payload
+            if count_try:
+                tries -= 1
+            if tries:
+                telemetry.record_event(cmdname, "retry")
+            # clear the read buffer, late responses arrive within a timeout
+            await self._drain_input(rtt.retry_delay)
+        raise FlashError("Error sending command [%s] to Device" % (cmdname))
+
+    def _output_line(self, msg: str) -> None:
+        redirect = _output_redirect.get()
+        if redirect is not None:
+            redirect.write_line(msg, self.name or self.device_id)
+            return
+        if self.name is None:
+            output_line(msg)
+            return
+        for line in msg.splitlines():
+            if line:
+                output_line(f"[{self.name}] {line}")
+
+    def _output(self, msg: str) -> None:
+        # Partial lines from concurrent flashers would interleave, so
+        # named flashers report progress with whole lines instead
+        if self.name is None:
+            output(msg)
+
+    def _emit_progress(self) -> None:
+        # Progress events carry the node name (or device id), the stage
+        # label, the completed and total block counts and the percentage
+        assert self.progress is not None
+        self.progress({
+            "node": self.name or self.device_id,
+            "stage": self.progress_label.lower(),
+            "done": self.progress_count,
+            "total": self.progress_total,
+            "percent": int(self.last_percent)
+        })
+
+    def _start_progress(self, total: int, label: str) -> None:
+        self.last_percent = 0.
+        self.progress_total = max(1, total)
+        self.progress_count = 0
+        self.progress_label = label
+        if self.progress is not None:
+            self._emit_progress()
+            return
+        self._output("\n[")
+
+    def _update_progress(self) -> None:
+        self.progress_count += 1
+        pct = int(self.progress_count / float(self.progress_total) * 100 + .5)
+        if pct < self.last_percent + 2:
+            return
+        if self.progress is not None:
+            self.last_percent = float(pct - pct % 2)
+            self._emit_progress()
+            return
+        while pct >= self.last_percent + 2:
+            self.last_percent += 2.
+            self._output("#")
+            if self.name is not None and self.last_percent % 20 == 0:
+                self._output_line(
+                    f"{self.progress_label} {int(self.last_percent)}%"
+                )
+
+    def _end_progress(self) -> None:
+        if self.progress is None:
+            self._output("]\n\n")
+
+    def _block_address(self, index: int) -> int:
+        return self.app_start_addr + index * self.block_size
+
+    async def _request_block(self, flash_address: int, index: int) -> bytearray:
+        for _ in range(3):
+            payload = struct.pack("<I", flash_address)
+            resp = await self.send_command("REQUEST_BLOCK", payload)
+            recd_addr, = struct.unpack("<I", resp[:4])
+            if recd_addr == flash_address:
+                return resp[4:]
+            self.telemetry.record_event('REQUEST_BLOCK', "mismatch")
+            logging.info(
+                f"Block read mismatch: expected: 0x{flash_address:4X}, "
+                f"received: 0x{recd_addr}"
+            )
+            await asyncio.sleep(.1)
+        self._output_line("Error")
+        raise FlashError("Block Request Error, block: %d" % (index,))
+
+    def _may_erase(self, flash_address: int) -> bool:
+        # Katapult erases a page when its first block is written, which
+        # takes far longer than a round trip.  Without a known page layout
+        # any 1 KiB aligned block may start a page.
+        unit = get_erase_unit(self.mcu_type, flash_address)
+        if unit is None:
+            return flash_address % 1024 == 0
+        return unit[0] == flash_address
+
+    async def _send_block(self, flash_address: int, out_cmd: bytearray) -> None:
+        recd_addr = 0
+        timeout = RTO_MAX if self._may_erase(flash_address) else None
+        for _ in range(3):
+            resp = await self.send_command(
+                'SEND_BLOCK', out_cmd=out_cmd, timeout=timeout
+            )
+            recd_addr, = struct.unpack("<I", resp)
+            if recd_addr == flash_address:
+                self.write_acked.add(flash_address)
+                break
+            self.telemetry.record_event('SEND_BLOCK', "mismatch")
+            logging.info(
+                f"Block write mismatch: expected: {flash_address:4X}, "
+                f"received: {recd_addr:4X}"
+            )
+            await asyncio.sleep(.1)
+        else:
+            raise FlashError(
+                f"Flash write failed, block address 0x{recd_addr:4X}"
+            )
+        self._update_progress()
+
+    async def _send_blocks_windowed(
+        self, blocks: List[Tuple[int, bytearray]]
+    ) -> None:
+        """
+        Keep up to self.window SEND_BLOCK commands in flight.  Responses
+        are matched to outstanding blocks by the returned flash address.
+        Blocks that are not acknowledged are retransmitted in address
+        order.  Bootloaders that report busy or repeatedly fail to keep
+        up are flashed with stop-and-wait for the remaining blocks.
+        """
+        cmd = BOOTLOADER_CMDS['SEND_BLOCK']
+        pending: Dict[int, bytearray] = {}
+        sent_times: Dict[int, float] = {}
+        acked = self.write_acked
+        retransmitted: set = set()
+        next_idx = 0
+        failures = 0
+        while next_idx < len(blocks) or pending:
+            while next_idx < len(blocks) and len(pending) < self.window:
+                addr, out_cmd = blocks[next_idx]
+                next_idx += 1
+                pending[addr] = out_cmd
+                self.node.write(out_cmd)
+                await self.node.drain()
+                sent_times[addr] = time.monotonic()
+            busy = False
+            retransmit_all = False
+            count_failure = True
+            wait = self.rtt.timeout
+            if any(self._may_erase(addr) for addr in pending):
+                wait = RTO_MAX
             try:
-                ret = await self.node.read(1024, timeout=.25)
+                data = await self._read_frame(wait)
             except asyncio.TimeoutError:
-                pass
+                self.telemetry.record_event('SEND_BLOCK', "timeout")
+                logging.info(
+                    f"Windowed block write timed out after "
+                    f"{wait * 1000:.0f} ms, {len(pending)} blocks outstanding"
+                )
+                retransmit_all = True
+                if wait < RTO_MAX:
+                    # Adaptive timeouts back off before counting as failure
+                    self.rtt.expire()
+                    count_failure = False
             else:
-                logging.info(f"Read Buffer Contents: {ret!r}")
-            await asyncio.sleep(.5)
-        raise FlashError("Error sending command [%s] to Device" % (cmdname))
+                result = self._parse_frame('SEND_BLOCK', data)
+                if result is None:
+                    self.telemetry.record_event('SEND_BLOCK', "corrupt")
+                else:
+                    recd_ack, cmd_response, resp = result
+                    if recd_ack == ACK_SUCCESS and cmd_response == cmd:
+                        recd_addr, = struct.unpack("<I", resp[:4])
+                        if recd_addr in pending:
+                            del pending[recd_addr]
+                            acked.add(recd_addr)
+                            elapsed = time.monotonic() - sent_times.pop(recd_addr)
+                            self.telemetry.record_rtt('SEND_BLOCK', elapsed)
+                            if not (
+                                recd_addr in retransmitted or
+                                self._may_erase(recd_addr)
+                            ):
+                                self.rtt.update(elapsed)
+                            failures = 0
+                            self._update_progress()
+                            continue
+                        if recd_addr in acked:
+                            # Late acknowledgement of a retransmitted block
+                            continue
+                        self.telemetry.record_event('SEND_BLOCK', "mismatch")
+                        logging.info(
+                            f"Block write mismatch: received: {recd_addr:4X}"
+                        )
+                    elif recd_ack == ACK_BUSY:
+                        self.telemetry.record_event('SEND_BLOCK', "busy")
+                        logging.info("Command 'SEND_BLOCK': Received busy signal")
+                        busy = True
+                    else:
+                        self.telemetry.record_event('SEND_BLOCK', "nack")
+                        logging.info(
+                            f"Command 'SEND_BLOCK': Received response "
+                            f"0x{recd_ack:02X}"
+                        )
+            failures += count_failure
+            if busy or failures >= 2:
+                self._output_line(
+                    "\nBootloader unable to keep up with a window of "
+                    f"{self.window} blocks, falling back to stop-and-wait"
+                )
+                self.window = 1
+                self.telemetry.record_event('SEND_BLOCK', "window_fallback")
+                await self._drain_input(self.rtt.retry_delay)
+                remaining = [(addr, pending[addr]) for addr in sorted(pending)]
+                remaining.extend(blocks[next_idx:])
+                for addr, out_cmd in remaining:
+                    await self._send_block(addr, out_cmd)
+                return
+            if retransmit_all:
+                retransmit = sorted(pending)
+            else:
+                retransmit = [min(pending)]
+            for addr in retransmit:
+                self.telemetry.record_event('SEND_BLOCK', "retransmit")
+                retransmitted.add(addr)
+                self.node.write(pending[addr])
+                await self.node.drain()
+                sent_times[addr] = time.monotonic()
+
+    async def _find_changed_blocks(self) -> Optional[List[int]]:
+        """
+        Compare the image with the current flash contents and return
+        the indices of the blocks that must be written.  The contents
+        are taken from the flash state cache when the device is known,
+        otherwise they are read back with REQUEST_BLOCK.  Cached contents
+        are only trusted to skip the read back before writing, the
+        unchanged blocks are still read back by verify_file.
+        """
+        if get_erase_unit(self.mcu_type, self.app_start_addr) is None:
+            self._output_line(
+                f"Differential flashing not supported on MCU {self.mcu_type}, "
+                "writing full image"
+            )
+            return None
+        cur_digests: Optional[List[str]] = None
+        if self._can_cache_digests():
+            cur_digests = FlashStateCache().get_digests(
+                self.device_id, self.block_size, self.app_start_addr
+            )
+        if cur_digests is not None:
+            self.contents_cached = True
+            self._output_line(
+                f"Using cached flash contents for {self.device_id}"
+            )
+        else:
+            self._output_line("Reading current flash contents...")
+            self._start_progress(self.block_count, "Reading")
+            cur_digests = []
+            for i in range(self.block_count):
+                data = await self._request_block(self._block_address(i), i)
+                cur_digests.append(block_digest(data))
+                self._update_progress()
+            self._end_progress()
+            self.telemetry.add_bytes(
+                "readback", self.block_count * self.block_size
+            )
+        changed_pages = set()
+        for i, digest in enumerate(self.image_digests):
+            if i < len(cur_digests) and cur_digests[i] == digest:
+                continue
+            page = get_erase_unit(self.mcu_type, self._block_address(i))
+            if page is None:
+                return None
+            changed_pages.add(page)
+        indices = [
+            i for i in range(self.block_count)
+            if get_erase_unit(self.mcu_type, self._block_address(i))
+            in changed_pages
+        ]
+        self._output_line(
+            f"Differential flash: {len(indices)} of {self.block_count} "
+            "blocks changed"
+        )
+        return indices
+
+    async def _find_resume_index(self) -> Optional[int]:
+        """
+        Returns the index of the block an interrupted flash of this image
+        resumes from, or None to write from the start.  Writing resumes
+        at the start of the flash page holding the checkpoint, as
+        Katapult only erases a page when its first block is written, and
+        the blocks preceding that page are read back to confirm that the
+        earlier write reached the flash.
+        """
+        if self.device_id is None:
+            return None
+        address = FlashStateCache().get_checkpoint(
+            self.device_id, self.block_size, self.app_start_addr,
+            self.image_sha1
+        )
+        if address is None:
+            return None
+        page = get_erase_unit(self.mcu_type, address)
+        if page is None:
+            self._output_line(
+                f"Unable to resume on MCU {self.mcu_type}, "
+                "writing full image"
+            )
+            return None
+        index = (page[0] - self.app_start_addr) // self.block_size
+        if not 0 < index < self.block_count:
+            return None
+        first = max(0, index - RESUME_VERIFY_BLOCKS)
+        self._output_line(
+            f"Resuming interrupted flash at 0x{page[0]:X}, "
+            f"checking {index - first} preceding blocks"
+        )
+        for i in range(first, index):
+            data = await self._request_block(self._block_address(i), i)
+            if block_digest(data) != self.image_digests[i]:
+                self._output_line(
+                    f"Block 0x{self._block_address(i):X} does not match "
+                    "the image, writing full image"
+                )
+                return None
+        self.telemetry.add_bytes("readback", (index - first) * self.block_size)
+        return index
+
+    def _save_checkpoint(self, addresses: List[int]) -> None:
+        if self.device_id is None:
+            return
+        cache = FlashStateCache()
+        remaining = [a for a in addresses if a not in self.write_acked]
+        if not remaining:
+            cache.clear(self.device_id)
+            return
+        cache.set_checkpoint(
+            self.device_id, self.block_size, self.app_start_addr,
+            self.image_sha1, remaining[0]
+        )
+        self.checkpoint_saved = True
+        self._output_line(
+            f"\nWrite interrupted, the next run resumes at 0x{remaining[0]:X}"
+        )
 
     async def send_file(self):
-        last_percent = 0
-        output_line("Flashing '%s'..." % (self.firmware_path))
-        output("\n[")
-        with open(self.firmware_path, 'rb') as f:
-            f.seek(0, os.SEEK_END)
-            self.file_size = f.tell()
-            f.seek(0)
-            flash_address = self.app_start_addr
-            recd_addr = 0
-            while True:
-                buf = f.read(self.block_size)
-                if not buf:
-                    break
-                if len(buf) < self.block_size:
-                    buf += b"\xFF" * (self.block_size - len(buf))
-                self.fw_sha.update(buf)
-                prefix = struct.pack("<I", flash_address)
-                for _ in range(3):
-                    resp = await self.send_command('SEND_BLOCK', prefix + buf)
-                    recd_addr, = struct.unpack("<I", resp)
-                    if recd_addr == flash_address:
-                        break
-                    logging.info(
-                        f"Block write mismatch: expected: {flash_address:4X}, "
-                        f"received: {recd_addr:4X}"
-                    )
-                    await asyncio.sleep(.1)
-                else:
-                    raise FlashError(
-                        f"Flash write failed, block address 0x{recd_addr:4X}"
-                    )
-                flash_address += self.block_size
-                self.block_count += 1
-                uploaded = self.block_count * self.block_size
-                pct = int(uploaded / float(self.file_size) * 100 + .5)
-                if pct >= last_percent + 2:
-                    last_percent += 2.
-                    output("#")
-            resp = await self.send_command('SEND_EOF')
-            page_count, = struct.unpack("<I", resp)
-            output_line("]\n\nWrite complete: %d pages" % (page_count))
+        self._output_line("Flashing '%s'..." % (self.firmware_path))
+        image = self.image_cache.get_image(self.firmware_path, self.block_size)
+        padded: bytes = image["data"]
+        self.file_size = image["size"]
+        self.image_sha1 = image["sha1"]
+        self.image_digests = image["digests"]
+        self.image_blocks = [
+            padded[offset:offset + self.block_size]
+            for offset in range(0, len(padded), self.block_size)
+        ]
+        self.block_count = len(self.image_blocks)
+        indices: Optional[List[int]] = None
+        self.verify_range = None
+        self.contents_cached = False
+        with self.telemetry.phase("readback"):
+            resume_index = await self._find_resume_index()
+            if resume_index is not None:
+                # Blocks from the interrupted run are covered by verification
+                indices = list(range(resume_index, self.block_count))
+                self.telemetry.info["resumed_at"] = self._block_address(
+                    resume_index
+                )
+            elif self.diff_mode:
+                indices = await self._find_changed_blocks()
+                if indices:
+                    self.verify_range = (indices[0], indices[-1])
+                elif indices is not None:
+                    self.verify_range = (0, -1)
+        if indices is None:
+            indices = list(range(self.block_count))
+        self.partial_write = len(indices) < self.block_count
+        with self.telemetry.phase("write"):
+            await self._write_blocks(indices)
+
+    async def _write_blocks(self, indices: List[int]) -> None:
+        self._start_progress(len(indices), "Writing")
+        addresses = [self._block_address(i) for i in indices]
+        payloads = [
+            struct.pack("<I", addr) + self.image_blocks[i]
+            for addr, i in zip(addresses, indices)
+        ]
+        out_cmds = self._build_commands(BOOTLOADER_CMDS['SEND_BLOCK'], payloads)
+        blocks = list(zip(addresses, out_cmds))
+        try:
+            if self.window > 1:
+                await self._send_blocks_windowed(blocks)
+            else:
+                for addr, out_cmd in blocks:
+                    await self._send_block(addr, out_cmd)
+        except BaseException:
+            self._save_checkpoint(addresses)
+            raise
+        self.telemetry.add_bytes("write", len(indices) * self.block_size)
+        self.telemetry.info["blocks_written"] = len(indices)
+        resp = await self.send_command('SEND_EOF', timeout=RTO_MAX)
+        page_count, = struct.unpack("<I", resp)
+        self._end_progress()
+        self._output_line("Write complete: %d pages" % (page_count))
 
     async def verify_file(self):
-        last_percent = 0
-        output_line("Verifying (block count = %d)..." % (self.block_count,))
-        output("\n[")
+        first, last = 0, self.block_count - 1
+        if self.verify_range is not None and not self.contents_cached:
+            # The blocks outside the range were read back before writing
+            first, last = self.verify_range
+        verify_count = max(0, last - first + 1)
+        self._output_line("Verifying (block count = %d)..." % (verify_count,))
+        self._start_progress(verify_count, "Verifying")
         ver_sha = hashlib.sha1()
         for i in range(self.block_count):
-            flash_address = i * self.block_size + self.app_start_addr
-            for _ in range(3):
-                payload = struct.pack("<I", flash_address)
-                resp = await self.send_command("REQUEST_BLOCK", payload)
-                recd_addr, = struct.unpack("<I", resp[:4])
-                if recd_addr == flash_address:
-                    break
-                logging.info(
-                    f"Block read mismatch: expected: 0x{flash_address:4X}, "
-                    f"received: 0x{recd_addr}"
-                )
-                await asyncio.sleep(.1)
+            if first <= i <= last:
+                data = await self._request_block(self._block_address(i), i)
+                self._update_progress()
             else:
-                output_line("Error")
-                raise FlashError("Block Request Error, block: %d" % (i,))
-            ver_sha.update(resp[4:])
-            pct = int(i * self.block_size / float(self.file_size) * 100 + .5)
-            if pct >= last_percent + 2:
-                last_percent += 2
-                output("#")
+                # Block confirmed unchanged before writing
+                data = self.image_blocks[i]
+            ver_sha.update(data)
+        self.telemetry.add_bytes("verify", verify_count * self.block_size)
         ver_hex = ver_sha.hexdigest().upper()
-        fw_hex = self.fw_sha.hexdigest().upper()
+        fw_hex = self.image_sha1
         if ver_hex != fw_hex:
+            if self.device_id is not None:
+                FlashStateCache().clear(self.device_id)
+            # Blocks skipped by a differential or resumed write are not
+            # what was expected, the app is corrupt until a full write
+            self.partial_verify_failed = self.partial_write
             raise FlashError("Checksum mismatch: Expected %s, Received %s"
                                 % (fw_hex, ver_hex))
-        output_line("]\n\nVerification Complete: SHA = %s" % (ver_hex))
+        self._end_progress()
+        self._output_line("Verification Complete: SHA = %s" % (ver_hex))
+        self.telemetry.info["sha1"] = ver_hex
+        if self._can_cache_digests():
+            FlashStateCache().set_digests(
+                self.device_id, self.block_size, self.app_start_addr,
+                self.image_digests, fw_hex
+            )
+
+    def _can_cache_digests(self) -> bool:
+        # A tty path may name a different board after a re-plug, only
+        # devices identified by a serial number or CAN UUID are cached
+        return self.device_id is not None and not self.device_id.startswith("tty:")
 
     async def finish(self):
-        await self.send_command("COMPLETE")
+        if self.checkpoint_saved:
+            # Jumping to a partial image would leave the MCU unreachable
+            self._output_line(
+                "Bootloader left active, run the flash again to resume"
+            )
+            return
+        if self.partial_verify_failed:
+            self._output_line(
+                "Bootloader left active, flash the full image without "
+                "differential mode"
+            )
+            return
+        await self.send_command("COMPLETE", timeout=RTO_MAX)
+
+
+class CanFrameRing:
+    """
+    Preallocated ring of packed frames queued for one node.  Slots fit
+    a CAN-FD frame, the length of each frame is kept alongside.  A
+    sender that writes without draining may fill the ring, it then
+    doubles in size instead of dropping frames.
+    """
+    def __init__(self, capacity: int = CAN_TX_RING_FRAMES) -> None:
+        self.slot_size = CANFD_FRAME_SIZE
+        self.capacity = capacity
+        self.buffer = bytearray(CANFD_FRAME_SIZE * capacity)
+        self.view = memoryview(self.buffer)
+        self.sizes = [0] * capacity
+        self.head = 0
+        self.count = 0
+        self.waiters: List[asyncio.Future] = []
+
+    def _grow(self) -> None:
+        slot_size = self.slot_size
+        buffer = bytearray(len(self.buffer) * 2)
+        sizes = [0] * (self.capacity * 2)
+        for idx in range(self.count):
+            slot = (self.head + idx) % self.capacity
+            start = slot * slot_size
+            buffer[idx * slot_size:(idx + 1) * slot_size] = (
+                self.view[start:start + slot_size]
+            )
+            sizes[idx] = self.sizes[slot]
+        self.view.release()
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.sizes = sizes
+        self.capacity *= 2
+        self.head = 0
+
+    def push(
+        self, frame_struct: struct.Struct, can_id: int, *fields: Any
+    ) -> None:
+        if self.count == self.capacity:
+            self._grow()
+        slot = (self.head + self.count) % self.capacity
+        frame_struct.pack_into(
+            self.buffer, slot * self.slot_size, can_id, *fields
+        )
+        self.sizes[slot] = frame_struct.size
+        self.count += 1
+
+    def peek(self) -> memoryview:
+        start = self.head * self.slot_size
+        return self.view[start:start + self.sizes[self.head]]
 
+    def pop(self) -> None:
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+
+    def wake(self) -> None:
+        waiters, self.waiters = self.waiters, []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
 
 class CanNode:
     def __init__(self, node_id: int, cansocket: CanSocket | SerialSocket) -> None:
@@ -511,6 +2146,9 @@ class CanNode:
             payload = bytes(payload)
         self._cansocket.send(self.node_id, payload)
 
+    async def drain(self) -> None:
+        await self._cansocket.drain(self.node_id)
+
     async def write_with_response(
         self,
         payload: Union[bytearray, bytes],
@@ -518,6 +2156,7 @@ class CanNode:
         timeout: Optional[float] = 2.
     ) -> bytes:
         self.write(payload)
+        await self.drain()
         return await self.readexactly(resp_length, timeout)
 
     def feed_data(self, data: bytes) -> None:
@@ -527,9 +2166,16 @@ class CanNode:
         self._reader.feed_eof()
 
 class BaseSocket:
-    def __init__(self, args: argparse.Namespace) -> None:
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        telemetry: Optional[FlashTelemetry] = None,
+        progress: Optional[ProgressCallback] = None
+    ) -> None:
         self._loop = asyncio.get_running_loop()
         self._args = args
+        self.telemetry = telemetry or FlashTelemetry()
+        self.progress = progress
         self._fw_path = pathlib.Path(args.firmware).expanduser().resolve()
 
     @property
@@ -565,13 +2211,23 @@ class BaseSocket:
     async def run(self) -> None:
         raise NotImplementedError()
 
+    async def drain(self, can_id: int) -> None:
+        pass
+
     def close(self) -> None:
         raise NotImplementedError()
 
 class CanSocket(BaseSocket):
-    def __init__(self, args: argparse.Namespace) -> None:
-        super().__init__(args)
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        telemetry: Optional[FlashTelemetry] = None,
+        progress: Optional[ProgressCallback] = None
+    ) -> None:
+        super().__init__(args, telemetry, progress)
         self._uuid = 0
+        self._uuids: List[int] = []
+        self._flash_all = False
         self._can_interface = args.interface
         self._can_bridge_path: pathlib.Path | None = None
         self._can_bridge_serial_path: pathlib.Path | None = None
@@ -580,11 +2236,34 @@ class CanSocket(BaseSocket):
                 raise FlashError(
                     "The 'uuid' option must be specified to flash a CAN device"
                 )
+            intf = self._can_interface
+            uuid_args = [u.strip() for u in args.uuid.split(",") if u.strip()]
+            if [u.lower() for u in uuid_args] == ["all"]:
+                self._flash_all = True
             else:
-                intf = self._can_interface
-                self._uuid = int(args.uuid, 16)
+                self._uuids = [int(u, 16) for u in uuid_args]
+            if len(self._uuids) == 1:
+                self._uuid = self._uuids[0]
                 self._search_canbus_bridge()
                 output_line(f"Connecting to CAN UUID {args.uuid} on interface {intf}")
+            elif self.is_bootloader_req and self._flash_all:
+                raise FlashError(
+                    "A bootloader request requires explicit UUIDs"
+                )
+            else:
+                for uuid in self._uuids:
+                    self._uuid = uuid
+                    self._search_canbus_bridge()
+                    if self.is_usb_can_bridge:
+                        raise FlashError(
+                            f"UUID {uuid:012x} is a USB-CAN bridge, bridges "
+                            "must be flashed on their own"
+                        )
+                self._uuid = 0
+                targets = "all Katapult nodes" if self._flash_all else (
+                    ", ".join(f"{u:012x}" for u in self._uuids)
+                )
+                output_line(f"Connecting to {targets} on interface {intf}")
         self.cansock = socket.socket(socket.PF_CAN, socket.SOCK_RAW,
                                      socket.CAN_RAW)
         self.admin_node = CanNode(CANBUS_ID_ADMIN, self)
@@ -592,129 +2271,246 @@ class CanSocket(BaseSocket):
             CANBUS_ID_ADMIN_RESP: self.admin_node
         }
 
-        self.input_buffer = b""
-        self.output_packets: List[bytes] = []
-        self.input_busy = False
+        self.fd_mode = False
+        self.frame_struct = CAN_STRUCT
+        self.frame_size = CAN_FRAME_SIZE
+        self.input_buffer = bytearray(CAN_FRAME_SIZE * CAN_RECV_BATCH)
+        self.input_view = memoryview(self.input_buffer)
+        self.input_len = 0
+        # Each node queues its frames in a ring, allocated on first use
+        self.output_rings: Dict[int, CanFrameRing] = {}
         self.output_busy = False
+        self.output_handle: Optional[asyncio.TimerHandle] = None
         self.closed = True
 
     @property
     def is_usb_can_bridge(self) -> bool:
         return self._can_bridge_path is not None
 
+    @property
+    def is_multi_target(self) -> bool:
+        return self._flash_all or len(self._uuids) > 1
+
     @property
     def usb_serial_path(self) -> pathlib.Path:
         if self._can_bridge_serial_path is not None:
             return self._can_bridge_serial_path
         # find tty path
         assert self._can_bridge_path is not None
-        dir_name = self._can_bridge_path.name
-        ttys = list(self._can_bridge_path.glob(f"{dir_name}:*/tty/tty*"))
-        if not ttys:
+        dev = get_device_inventory().get_device(self._can_bridge_path.name)
+        if dev is None or not dev["ttys"]:
             raise FlashError("Failed to locate serial tty path")
-        tty_path = pathlib.Path("/dev").joinpath(ttys[0].name)
+        tty_path = pathlib.Path("/dev").joinpath(dev["ttys"][0])
         if not tty_path.exists():
             raise FlashError("Detected tty path does not exist")
         self._can_bridge_serial_path = tty_path
         return tty_path
 
     def _handle_can_response(self) -> None:
-        try:
-            data = self.cansock.recv(4096)
-        except socket.error as e:
-            # If bad file descriptor allow connection to be
-            # closed by the data check
-            if e.errno == errno.EBADF:
-                logging.exception("Can Socket Read Error, closing")
-                data = b''
-            else:
-                return
-        if not data:
-            # socket closed
+        # Read every frame queued on the socket into the preallocated
+        # buffer, then demultiplex them in a single pass.  In CAN-FD mode
+        # classic frames are received into a CAN-FD sized slot, the
+        # header layout of both is the same.
+        view = self.input_view
+        end = self.input_len
+        frame_size = self.frame_size
+        closed = False
+        while end + frame_size <= len(view):
+            try:
+                nbytes = self.cansock.recv_into(view[end:end + frame_size])
+            except BlockingIOError:
+                break
+            except socket.error as e:
+                # If bad file descriptor allow connection to be
+                # closed by the data check
+                if e.errno == errno.EBADF:
+                    logging.exception("Can Socket Read Error, closing")
+                    closed = True
+                break
+            if not nbytes:
+                # socket closed
+                closed = True
+                break
+            end += frame_size
+        frames_end = end - end % frame_size
+        nodes = self.nodes
+        for frame in self.frame_struct.iter_unpack(view[:frames_end]):
+            node = nodes.get(frame[0] & socket.CAN_EFF_MASK)
+            if node is not None:
+                node.feed_data(frame[-1][:frame[1]])
+        self.input_len = end - frames_end
+        if self.input_len:
+            view[:self.input_len] = view[frames_end:end]
+        if closed:
             self.close()
-            return
-        self.input_buffer += data
-        if self.input_busy:
-            return
-        self.input_busy = True
-        while len(self.input_buffer) >= 16:
-            packet = self.input_buffer[:16]
-            self._process_packet(packet)
-            self.input_buffer = self.input_buffer[16:]
-        self.input_busy = False
-
-    def _process_packet(self, packet: bytes) -> None:
-        can_id, length, data = struct.unpack(CAN_FMT, packet)
-        can_id &= socket.CAN_EFF_MASK
-        payload = data[:length]
-        node = self.nodes.get(can_id)
-        if node is not None:
-            node.feed_data(payload)
 
     def send(self, can_id: int, payload: bytes = b"") -> None:
         if can_id > 0x7FF:
             can_id |= socket.CAN_EFF_FLAG
-        if not payload:
-            packet = struct.pack(CAN_FMT, can_id, 0, b"")
-            self.output_packets.append(packet)
+        ring = self.output_rings.get(can_id)
+        if ring is None:
+            ring = CanFrameRing()
+            self.output_rings[can_id] = ring
+        if self.fd_mode and len(payload) > 8:
+            # Messages that fit a classic frame are sent as one, so nodes
+            # without CAN-FD (admin queries, Klipper) are unaffected
+            offset = 0
+            while offset < len(payload):
+                length = len(payload) - offset
+                if length > 8:
+                    length = next(n for n in CANFD_LENGTHS if n <= length)
+                ring.push(
+                    CANFD_STRUCT, can_id, length, CANFD_BRS,
+                    payload[offset:offset + length]
+                )
+                offset += length
         else:
-            while payload:
-                length = min(len(payload), 8)
-                pkt_data = payload[:length]
-                payload = payload[length:]
-                packet = struct.pack(
-                    CAN_FMT, can_id, length, pkt_data)
-                self.output_packets.append(packet)
-        if self.output_busy:
-            return
-        self.output_busy = True
-        asyncio.create_task(self._do_can_send())
-
-    async def _do_can_send(self):
-        while self.output_packets:
-            packet = self.output_packets.pop(0)
-            try:
-                await self._loop.sock_sendall(self.cansock, packet)
-            except socket.error:
-                logging.info("Socket Write Error, closing")
-                self.close()
-                break
+            for offset in range(0, max(1, len(payload)), 8):
+                chunk = payload[offset:offset + 8]
+                ring.push(CAN_STRUCT, can_id, len(chunk), chunk)
+        if not self.output_busy:
+            self.output_busy = True
+            self._flush_output()
+
+    async def drain(self, can_id: int) -> None:
+        """
+        Wait until the frames queued for a node drop to the queue limit,
+        so a sender can't queue without bound while the interface is
+        backed up.
+        """
+        if can_id > 0x7FF:
+            can_id |= socket.CAN_EFF_FLAG
+        ring = self.output_rings.get(can_id)
+        while (
+            ring is not None and ring.count > CAN_TX_QUEUE_LIMIT and
+            not self.closed
+        ):
+            fut = self._loop.create_future()
+            ring.waiters.append(fut)
+            await fut
+
+    def _flush_output(self) -> None:
+        """
+        Write queued frames until the socket would block, taking one
+        frame from each node's ring in turn so that concurrent flashers
+        share the bus fairly.  Sending resumes once the socket is
+        writable again, or after a short delay if the interface transmit
+        queue is full, which raw CAN sockets report with ENOBUFS.
+        Senders waiting in drain() are woken as their ring empties.
+        """
+        self.output_handle = None
+        sock = self.cansock
+        active = [r for r in self.output_rings.values() if r.count]
+        while active:
+            for ring in active:
+                try:
+                    sock.send(ring.peek())
+                except (BlockingIOError, InterruptedError):
+                    self._loop.add_writer(sock.fileno(), self._handle_writable)
+                    return
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        self.output_handle = self._loop.call_later(
+                            CAN_SEND_RETRY_DELAY, self._flush_output
+                        )
+                        return
+                    logging.info("Socket Write Error, closing")
+                    self.close()
+                    return
+                ring.pop()
+                if ring.count <= CAN_TX_QUEUE_LIMIT and ring.waiters:
+                    ring.wake()
+            active = [r for r in active if r.count]
         self.output_busy = False
 
+    def _handle_writable(self) -> None:
+        self._loop.remove_writer(self.cansock.fileno())
+        self._flush_output()
+
     def _jump_to_bootloader(self, uuid: int):
         output_line("Sending bootloader jump command...")
         plist = [(uuid >> ((5 - i) * 8)) & 0xFF for i in range(6)]
         plist.insert(0, KLIPPER_REBOOT_CMD)
         self.send(KLIPPER_ADMIN_ID, bytes(plist))
 
-    async def _query_uuids(self) -> List[int]:
-        output_line("Checking for Katapult nodes...")
+    async def _discover_uuids(
+        self,
+        expected: Optional[int] = None,
+        quiet_time: Optional[float] = .5,
+        timeout: Optional[float] = 2.
+    ) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Query unassigned nodes and yield the uuid and application of each
+        node the first time it responds.  The query is repeated with
+        exponential backoff to catch nodes that respond late.  Discovery
+        ends once the expected number of nodes responded, after quiet_time
+        seconds without a new node or after timeout seconds, whichever
+        comes first.  With all three unset it runs until cancelled.
+        """
         payload = bytes([CANBUS_CMD_QUERY_UNASSIGNED])
-        self.admin_node.write(payload)
-        curtime = self._loop.time()
-        endtime = curtime + 2.
-        self.uuids: List[int] = []
-        while curtime < endtime:
-            timeout = max(.1, endtime - curtime)
+        app_names = {
+            KLIPPER_SET_NODE_CMD: "Klipper",
+            CANBUS_CMD_SET_NODEID: "Katapult"
+        }
+        seen: set = set()
+        start = last_new = next_query = self._loop.time()
+        interval = DISCOVERY_MIN_INTERVAL
+        # Query at least twice per quiet period so a late node is asked
+        # again before discovery gives up on it
+        max_interval = DISCOVERY_MAX_INTERVAL
+        if quiet_time is not None:
+            max_interval = max(interval, min(max_interval, quiet_time / 2.))
+        while True:
+            curtime = self._loop.time()
+            if curtime >= next_query:
+                self.admin_node.write(payload)
+                await self.admin_node.drain()
+                next_query = curtime + interval
+                interval = min(interval * 2., max_interval)
+            deadline = next_query
+            if timeout is not None:
+                if curtime >= start + timeout:
+                    return
+                deadline = min(deadline, start + timeout)
+            if quiet_time is not None and seen:
+                if curtime >= last_new + quiet_time:
+                    return
+                deadline = min(deadline, last_new + quiet_time)
             try:
-                resp = await self.admin_node.read(8, timeout)
+                resp = await self.admin_node.read(
+                    8, max(.001, deadline - curtime)
+                )
             except asyncio.TimeoutError:
                 continue
-            finally:
-                curtime = self._loop.time()
             if len(resp) < 7 or resp[0] != CANBUS_RESP_NEED_NODEID:
                 continue
-            app_names = {
-                KLIPPER_SET_NODE_CMD: "Klipper",
-                CANBUS_CMD_SET_NODEID: "Katapult"
-            }
             app = "Unknown"
             if len(resp) > 7:
                 app = app_names.get(resp[7], "Unknown")
-            data = resp[1:7]
-            output_line(f"Detected UUID: {data.hex()}, Application: {app}")
-            uuid = sum([v << ((5 - i) * 8) for i, v in enumerate(data)])
-            if uuid not in self.uuids and app == "Katapult":
+            uuid = int.from_bytes(resp[1:7], "big")
+            if uuid in seen:
+                continue
+            seen.add(uuid)
+            last_new = self._loop.time()
+            yield uuid, app
+            if expected is not None and len(seen) >= expected:
+                return
+
+    async def _query_uuids(self) -> List[int]:
+        output_line("Checking for Katapult nodes...")
+        self.uuids: List[int] = []
+        self.discovered: List[Dict[str, Any]] = []
+        timeout = self._args.query_timeout
+        discovery = self._discover_uuids(
+            self._args.expect_nodes, self._args.quiet_time,
+            2. if timeout is None else timeout
+        )
+        async for uuid, app in discovery:
+            output_line(f"Detected UUID: {uuid:012x}, Application: {app}")
+            self.discovered.append(
+                {"uuid": f"{uuid:012x}", "application": app}
+            )
+            if app == "Katapult":
                 self.uuids.append(uuid)
         return self.uuids
 
@@ -738,108 +2534,200 @@ class CanSocket(BaseSocket):
 
     def _search_canbus_bridge(self) -> None:
         can_intf = self._can_interface.lower()
-        sysfs_usb_path = pathlib.Path("/sys/bus/usb/devices")
-        if not sysfs_usb_path.is_dir():
-            return
-        for item in sysfs_usb_path.iterdir():
-            if not item.joinpath("bDeviceClass").is_file():
-                continue
-            usb_info = get_usb_info(item)
-            if (
-                usb_info["usb_id"] != GS_CAN_USB_ID or
-                usb_info["manufacturer"] != "klipper"
-            ):
-                continue
-            if not list(item.glob(f"{item.name}:*/net/{can_intf}")):
+        for dev in get_device_inventory().find_by_usb_id(GS_CAN_USB_ID):
+            if dev["manufacturer"] != "klipper" or can_intf not in dev["net"]:
                 continue
             # Klipper GS USB Device matches
-            serial_no = usb_info["serial_number"]
+            serial_no = dev["serial_number"]
             logging.info(
                 f"Found Klipper USB-CAN bridge on {can_intf}, serial {serial_no}"
             )
-            if serial_no:
-                try:
-                    det_uuid = convert_usbsn_to_uuid(serial_no)
-                except Exception:
-                    output_line(
-                        f"Failed to convert can bridge serial number {serial_no} "
-                        f"to a uuid for device {item.name}"
-                    )
-                    logging.exception("UUID conversion failed")
-                    return
+            if serial_no and dev["uuid"] is None:
+                output_line(
+                    f"Failed to convert can bridge serial number {serial_no} "
+                    f"to a uuid for device {dev['sys_path'].name}"
+                )
+                return
+            if dev["uuid"] is not None:
                 logging.info(
-                    f"Detected UUID: {det_uuid:x}, provided UUID: {self._uuid:x}"
+                    f"Detected UUID: {dev['uuid']:x}, "
+                    f"provided UUID: {self._uuid:x}"
                 )
-                if det_uuid == self._uuid:
-                    self._can_bridge_path = item
-                    output_line(f"Canbus Bridge detected at {item}")
+                if dev["uuid"] == self._uuid:
+                    self._can_bridge_path = dev["sys_path"]
+                    output_line(f"Canbus Bridge detected at {dev['sys_path']}")
             break
 
-    async def _wait_canbridge_reset(self) -> None:
+    async def _wait_canbridge_reset(self, monitor: UsbEventMonitor) -> None:
         if self._can_bridge_path is None:
             return
         output("Waiting for USB Reconnect.")
-        for _ in range(8):
-            await asyncio.sleep(.5)
-            output(".")
-            usb_info = get_usb_info(self._can_bridge_path)
-            mfr = usb_info.get("manufacturer")
-            usb_id = usb_info.get("usb_id", "")
-            product = usb_info.get("product")
-            if usb_id and usb_id != GS_CAN_USB_ID:
-                await asyncio.sleep(.5)
-                output_line("done")
-                output_line(f"Detected new USB Device: {usb_id} {mfr} {product}")
-                if mfr == "katapult" or usb_id == KATAPULT_USB_ID:
-                    serial_path = self.usb_serial_path
-                    output_line(f"Katapult detected at serial port {serial_path}")
-                else:
-                    # Device is not Katapult, force exit
-                    self._args.request_bootloader = True
-                    output_line("Device is not Katapult, exiting...")
-                break
-        else:
+        usb_info = await wait_usb_reconnect(
+            monitor, self._can_bridge_path, GS_CAN_USB_ID
+        )
+        if usb_info is None:
             output_line("timed out")
-
-    async def run(self) -> None:
-        self._check_firmware()
+            return
+        mfr = usb_info.get("manufacturer")
+        usb_id = usb_info.get("usb_id", "")
+        product = usb_info.get("product")
+        output_line("done")
+        output_line(f"Detected new USB Device: {usb_id} {mfr} {product}")
+        if mfr == "katapult" or usb_id == KATAPULT_USB_ID:
+            serial_path = self.usb_serial_path
+            output_line(f"Katapult detected at serial port {serial_path}")
+        else:
+            # Device is not Katapult, force exit
+            self._args.request_bootloader = True
+            output_line("Device is not Katapult, exiting...")
+
+    def _enable_fd(self) -> None:
+        # The MTU of an interface is CANFD_MTU only when it is configured
+        # for CAN-FD, which requires a data bitrate for bitrate switching
+        intf = self._can_interface
+        try:
+            mtu = int(pathlib.Path(f"/sys/class/net/{intf}/mtu").read_text())
+        except (OSError, ValueError):
+            mtu = 0
+        if mtu != CANFD_FRAME_SIZE:
+            output_line(
+                f"Interface {intf} is not configured for CAN-FD, "
+                "using classic CAN"
+            )
+            return
+        try:
+            self.cansock.setsockopt(
+                socket.SOL_CAN_RAW, socket.CAN_RAW_FD_FRAMES, 1
+            )
+        except (AttributeError, OSError):
+            output_line("CAN-FD frames not supported, using classic CAN")
+            return
+        self.fd_mode = True
+        self.frame_struct = CANFD_STRUCT
+        self.frame_size = CANFD_FRAME_SIZE
+        self.input_buffer = bytearray(CANFD_FRAME_SIZE * CAN_RECV_BATCH)
+        self.input_view = memoryview(self.input_buffer)
+        output_line(f"Using CAN-FD with bitrate switching on {intf}")
+
+    def open(self) -> None:
         try:
             self.cansock.bind((self._can_interface,))
         except Exception:
             raise FlashError(f"Unable to bind socket to {self._can_interface}")
+        if self._args.canfd:
+            self._enable_fd()
+        self.telemetry.info["can_fd"] = self.fd_mode
         self.closed = False
         self.cansock.setblocking(False)
         self._loop.add_reader(
             self.cansock.fileno(), self._handle_can_response)
+
+    async def run(self) -> None:
+        self._check_firmware()
+        self.open()
+        if self.is_multi_target:
+            await self._run_multi_target()
+            return
+        telemetry = self.telemetry
         if self.is_flash_req or self.is_bootloader_req:
-            self._jump_to_bootloader(self._uuid)
             if self.is_usb_can_bridge:
-                await self._wait_canbridge_reset()
+                monitor = UsbEventMonitor()
+                try:
+                    with telemetry.phase("bootloader_jump"):
+                        self._jump_to_bootloader(self._uuid)
+                    with telemetry.phase("reenumeration"):
+                        await self._wait_canbridge_reset(monitor)
+                finally:
+                    monitor.close()
                 return
-            else:
+            with telemetry.phase("bootloader_jump"):
+                self._jump_to_bootloader(self._uuid)
                 await asyncio.sleep(1.0)
             if self.is_bootloader_req:
                 return
-        self._reset_nodes()
-        await asyncio.sleep(.5)
-        if self.is_query:
-            await self._query_uuids()
-            return
-        node = self._set_node_id(self._uuid)
-        flasher = CanFlasher(node, self._fw_path)
-        await asyncio.sleep(.5)
+        with telemetry.phase("node_setup"):
+            self._reset_nodes()
+            await asyncio.sleep(.5)
+            if self.is_query:
+                await self._query_uuids()
+                return
+            node = self._set_node_id(self._uuid)
+            flasher = CanFlasher(
+                node, self._fw_path, self._args.window, self._args.diff,
+                f"can:{self._uuid:012x}", telemetry=telemetry,
+                progress=self.progress
+            )
+            await asyncio.sleep(.5)
+        await self._flash_node(flasher, self._uuid)
+
+    async def _flash_node(self, flasher: CanFlasher, uuid: int) -> None:
+        telemetry = flasher.telemetry
         try:
-            await flasher.connect_btl()
-            await flasher.verify_canbus_uuid(self._uuid)
+            with telemetry.phase("connect"):
+                await flasher.connect_btl()
+                await flasher.verify_canbus_uuid(uuid)
             if not self.is_status_req:
+                # send_file times its "readback" and "write" phases
                 await flasher.send_file()
-                await flasher.verify_file()
+                with telemetry.phase("verify"):
+                    await flasher.verify_file()
         finally:
             # always attempt to send the complete command. If
             # there is an error it will exit the bootloader
             # unless comms were broken
             if self.is_flash_req:
-                await flasher.finish()
+                with telemetry.phase("finish"):
+                    await flasher.finish()
+
+    async def _run_multi_target(self) -> None:
+        uuids = self._uuids
+        telemetry = self.telemetry
+        if not self._flash_all and (
+            self.is_flash_req or self.is_bootloader_req
+        ):
+            with telemetry.phase("bootloader_jump"):
+                for uuid in uuids:
+                    self._jump_to_bootloader(uuid)
+                await asyncio.sleep(1.0)
+            if self.is_bootloader_req:
+                return
+        with telemetry.phase("node_setup"):
+            self._reset_nodes()
+            await asyncio.sleep(.5)
+            if self._flash_all:
+                uuids = list(await self._query_uuids())
+                if not uuids:
+                    raise FlashError("No Katapult nodes found")
+            flashers: List[CanFlasher] = []
+            for uuid in uuids:
+                node = self._set_node_id(uuid)
+                name = f"{uuid:012x}"
+                flashers.append(
+                    CanFlasher(
+                        node, self._fw_path, self._args.window,
+                        self._args.diff, f"can:{name}", name,
+                        telemetry.node(name), self.progress
+                    )
+                )
+            await asyncio.sleep(.5)
+        results = await asyncio.gather(
+            *[self._flash_node(f, u) for f, u in zip(flashers, uuids)],
+            return_exceptions=True
+        )
+        output_line("\nResults:")
+        failed = 0
+        for uuid, result in zip(uuids, results):
+            node_info = telemetry.node(f"{uuid:012x}").info
+            if isinstance(result, BaseException):
+                failed += 1
+                node_info["result"] = "error"
+                node_info["error"] = str(result)
+                output_line(f"  {uuid:012x}: Failed ({result})")
+            else:
+                node_info["result"] = "success"
+                output_line(f"  {uuid:012x}: Success")
+        if failed:
+            raise FlashError(f"{failed} of {len(uuids)} CAN nodes failed")
 
     def close(self):
         if self.closed:
@@ -847,12 +2735,25 @@ class CanSocket(BaseSocket):
         self.closed = True
         for node in self.nodes.values():
             node.close()
+        if self.output_handle is not None:
+            self.output_handle.cancel()
+            self.output_handle = None
+        for ring in self.output_rings.values():
+            ring.wake()
+        self.output_rings.clear()
+        self.output_busy = False
         self._loop.remove_reader(self.cansock.fileno())
+        self._loop.remove_writer(self.cansock.fileno())
         self.cansock.close()
 
 class SerialSocket(BaseSocket):
-    def __init__(self, args: argparse.Namespace) -> None:
-        super().__init__(args)
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        telemetry: Optional[FlashTelemetry] = None,
+        progress: Optional[ProgressCallback] = None
+    ) -> None:
+        super().__init__(args, telemetry, progress)
         self._device = args.device
         self._baud = args.baud
         if not HAS_SERIAL:
@@ -898,58 +2799,33 @@ class SerialSocket(BaseSocket):
             logging.exception("Error on serial write")
             self.close()
 
-    async def _lookup_proc_name(self, process_id: str) -> str:
-        has_sysctl = shutil.which("systemctl") is not None
-        if has_sysctl:
-            cmd = shlex.split(f"systemctl status {process_id}")
-            proc = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, _ = await proc.communicate()
-            resp = stdout.strip().decode(errors="ignore")
-            if resp:
-                unit = resp.split(maxsplit=2)
-                if len(unit) == 3:
-                    return f"Systemd Unit Name: {unit[1]}"
-        cmdline_file = pathlib.Path(f"/proc/{process_id}/cmdline")
-        if cmdline_file.exists():
-            res = cmdline_file.read_text().replace("\x00", " ").strip()
-            return f"Command Line: {res}"
-        exe_file = pathlib.Path(f"/proc/{process_id}/exe")
-        if exe_file.exists():
-            return f"Executable: {exe_file.resolve()})"
-        return "Name Unknown"
-
     async def validate_device(self, dev_strpath: str) -> None:
         dev_path = pathlib.Path(dev_strpath)
         if not dev_path.exists():
             raise FlashError(f"No Serial Device found at {dev_path}")
         try:
-            dev_st = dev_path.stat()
+            dev_path.stat()
         except PermissionError as e:
             raise FlashError(f"No permission to access device {dev_path}") from e
-        dev_id = (dev_st.st_dev, dev_st.st_ino)
-        for fd_dir in pathlib.Path("/proc").glob("*/fd"):
-            pid = fd_dir.parent.name
-            if not pid.isdigit():
-                continue
-            with contextlib.suppress(OSError):
-                for item in fd_dir.iterdir():
-                    try:
-                        item_st = item.stat()
-                    except OSError:
-                        continue
-                    item_id = (item_st.st_dev, item_st.st_ino)
-                    if item_id == dev_id:
-                        proc_name = await self._lookup_proc_name(pid)
-                        output_line(
-                            f"Serial device {dev_path} in use by another program.\n"
-                            f"Process ID: {pid}\n"
-                            f"Process {proc_name}"
-                        )
-                        raise FlashError(f"Serial device {dev_path} in use")
+        owner = await self._loop.run_in_executor(
+            None, check_device_owner, dev_path
+        )
+        if owner is None:
+            return
+        if owner["unit"] is not None:
+            proc_name = f"Systemd Unit Name: {owner['unit']}"
+        elif owner["cmdline"]:
+            proc_name = f"Command Line: {owner['cmdline']}"
+        elif owner["exe"]:
+            proc_name = f"Executable: {owner['exe']}"
+        else:
+            proc_name = "Name Unknown"
+        output_line(
+            f"Serial device {dev_path} in use by another program.\n"
+            f"Process ID: {owner['pid'] or 'unknown'}\n"
+            f"Process {proc_name}"
+        )
+        raise DeviceInUseError(dev_path, owner)
 
     async def _request_usb_bootloader(self, device: pathlib.Path) -> pathlib.Path:
         output_line(f"Requesting USB bootloader for {device}...")
@@ -960,53 +2836,55 @@ class SerialSocket(BaseSocket):
         stable_path = get_stable_usb_symlink(device)
         usb_info = get_usb_info(usb_dev_path)
         start_usb_id = usb_info["usb_id"]
-        fd: Optional[int] = None
-        with contextlib.suppress(OSError):
-            fd = os.open(str(device), os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
-            dtr_data = struct.pack('I', termios.TIOCM_DTR)
-            fcntl.ioctl(fd, termios.TIOCMBIS, dtr_data)
-            t = termios.tcgetattr(fd)
-            t[4] = t[5] = termios.B1200
-            termios.tcsetattr(fd, termios.TCSANOW, t)
-            fcntl.ioctl(fd, termios.TIOCMBIC, dtr_data)
-        if fd is not None:
-            os.close(fd)
-        output("Waiting for USB Reconnect.")
-        for _ in range(8):
-            await asyncio.sleep(.5)
-            output(".")
-            usb_info = get_usb_info(usb_dev_path)
-            mfr = usb_info.get("manufacturer")
-            product = usb_info.get("product")
-            usb_id = usb_info.get("usb_id", "")
-            if usb_id and usb_id != start_usb_id:
-                await asyncio.sleep(.5)
-                output_line("done")
-                output_line(f"Detected new USB Device: {usb_id} {mfr} {product}")
-                if mfr == "katapult" or usb_id == KATAPULT_USB_ID:
-                    # prefer path resolved from sysfs usb path
-                    path_match = list(
-                        usb_dev_path.glob(f"{usb_dev_path.name}:*/tty/tty*")
+        monitor = UsbEventMonitor()
+        try:
+            with self.telemetry.phase("bootloader_jump"):
+                fd: Optional[int] = None
+                with contextlib.suppress(OSError):
+                    fd = os.open(
+                        str(device), os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK
                     )
-                    if len(path_match) == 1:
-                        det_path = pathlib.Path(f"/dev/{path_match[0].name}")
-                        if det_path.exists():
-                            stable_path = det_path
-                    output_line(f"Katapult detected on {stable_path}")
-                else:
-                    # Device is not Katapult, force exit
-                    self._args.request_bootloader = True
-                    output_line("Device is not Katapult, exiting...")
-                break
-        else:
+                    dtr_data = struct.pack('I', termios.TIOCM_DTR)
+                    fcntl.ioctl(fd, termios.TIOCMBIS, dtr_data)
+                    t = termios.tcgetattr(fd)
+                    t[4] = t[5] = termios.B1200
+                    termios.tcsetattr(fd, termios.TCSANOW, t)
+                    fcntl.ioctl(fd, termios.TIOCMBIC, dtr_data)
+                if fd is not None:
+                    os.close(fd)
+            output("Waiting for USB Reconnect.")
+            with self.telemetry.phase("reenumeration"):
+                new_info = await wait_usb_reconnect(
+                    monitor, usb_dev_path, start_usb_id
+                )
+        finally:
+            monitor.close()
+        if new_info is None:
             output_line("timed out")
+            return stable_path
+        mfr = new_info.get("manufacturer")
+        product = new_info.get("product")
+        usb_id = new_info.get("usb_id", "")
+        output_line("done")
+        output_line(f"Detected new USB Device: {usb_id} {mfr} {product}")
+        if mfr == "katapult" or usb_id == KATAPULT_USB_ID:
+            # prefer path resolved from sysfs usb path
+            det_path = get_usb_tty(usb_dev_path)
+            if det_path is not None:
+                stable_path = det_path
+            output_line(f"Katapult detected on {stable_path}")
+        else:
+            # Device is not Katapult, force exit
+            self._args.request_bootloader = True
+            output_line("Device is not Katapult, exiting...")
         return stable_path
 
     async def _request_serial_bootloader(self, device: str, baud: int) -> None:
         output_line(f"Requesting serial bootloader for device {device}...")
-        self.serial = self._open_device(device, baud)
-        self.send(0, SERIAL_BL_REQ)
-        await asyncio.sleep(1.)
+        with self.telemetry.phase("bootloader_jump"):
+            self.serial = self._open_device(device, baud)
+            self.send(0, SERIAL_BL_REQ)
+            await asyncio.sleep(1.)
         if self.serial is not None:
             self.close()
 
@@ -1030,7 +2908,8 @@ class SerialSocket(BaseSocket):
     async def run(self) -> None:
         self._check_firmware()
         device = self._device
-        await self.validate_device(device)
+        with self.telemetry.phase("validate"):
+            await self.validate_device(device)
         dev_path = pathlib.Path(device)
         usb_dev_path = get_usb_path(dev_path)
         dev_info: Dict[str, Any] = {}
@@ -1058,23 +2937,34 @@ class SerialSocket(BaseSocket):
             usb_prod = ""
         self.serial = self._open_device(device, self._baud)
         self._loop.add_reader(self.serial.fileno(), self._handle_response)
-        flasher = CanFlasher(self.node, self._fw_path)
+        device_id = f"tty:{get_stable_usb_symlink(pathlib.Path(device))}"
+        if dev_info.get("serial_number"):
+            device_id = f"usb:{dev_info['serial_number']}"
+        telemetry = self.telemetry
+        flasher = CanFlasher(
+            self.node, self._fw_path, self._args.window, self._args.diff,
+            device_id, telemetry=telemetry, progress=self.progress
+        )
         try:
-            if self._has_double_buffering(usb_prod):
-                # Prime the USB Connection with a dummy command.  This is
-                # necessary to get STM32 devices with usbfs double buffering
-                # to respond immediately to the connect command.
-                flasher.prime()
-            await flasher.connect_btl()
+            with telemetry.phase("connect"):
+                if self._has_double_buffering(usb_prod):
+                    # Prime the USB Connection with a dummy command.  This is
+                    # necessary to get STM32 devices with usbfs double buffering
+                    # to respond immediately to the connect command.
+                    flasher.prime()
+                await flasher.connect_btl()
             if not self.is_status_req:
+                # send_file times its "readback" and "write" phases
                 await flasher.send_file()
-                await flasher.verify_file()
+                with telemetry.phase("verify"):
+                    await flasher.verify_file()
         finally:
             # always attempt to send the complete command. If
             # there is an error it will exit the bootloader
             # unless comms were broken
             if self.is_flash_req:
-                await flasher.finish()
+                with telemetry.phase("finish"):
+                    await flasher.finish()
 
     def close(self):
         if self.serial is None:
@@ -1083,35 +2973,269 @@ class SerialSocket(BaseSocket):
         self.serial.close()
         self.serial = None
 
+async def check_args_current(
+    args: argparse.Namespace
+) -> Optional[Dict[str, Any]]:
+    fw_path = pathlib.Path(args.firmware).expanduser().resolve()
+    uuid: Optional[int] = None
+    if args.device is None:
+        # Only a single CAN node can be checked
+        if not args.uuid or "," in args.uuid or args.uuid == "all":
+            return None
+        try:
+            uuid = int(args.uuid, 16)
+        except ValueError:
+            return None
+    if not fw_path.is_file():
+        return None
+    return await check_firmware_current(
+        fw_path, pathlib.Path(args.klippy_socket), args.device, uuid
+    )
+
+def _make_args(**kwargs: Any) -> argparse.Namespace:
+    # Same options and defaults as the command line
+    args = argparse.Namespace(
+        device=None, baud=250000, interface="can0",
+        firmware="~/klipper/out/klipper.bin", uuid=None, query=False,
+        request_bootloader=False, status=False, window=1, diff=False,
+        skip_current=False, klippy_socket=str(KLIPPY_SOCKET_PATH),
+        expect_nodes=None, quiet_time=.5, query_timeout=None, canfd=False
+    )
+    for key, val in kwargs.items():
+        setattr(args, key, val)
+    return args
+
+async def _run_session(
+    args: argparse.Namespace,
+    telemetry: Optional[FlashTelemetry],
+    progress: Optional[ProgressCallback]
+) -> Dict[str, Any]:
+    telemetry = telemetry or FlashTelemetry()
+    redirect_token: Optional[contextvars.Token] = None
+    if progress is not None:
+        redirect_token = _output_redirect.set(_OutputRedirect(progress))
+    try:
+        return await _run_session_output(args, telemetry, progress)
+    finally:
+        if redirect_token is not None:
+            _output_redirect.reset(redirect_token)
+
+async def _run_session_output(
+    args: argparse.Namespace,
+    telemetry: FlashTelemetry,
+    progress: Optional[ProgressCallback]
+) -> Dict[str, Any]:
+    telemetry.info.update({
+        "timestamp": time.time(),
+        "firmware": args.firmware,
+        "device": args.device,
+        "interface": None if args.device else args.interface,
+        "uuid": args.uuid,
+        "window": args.window,
+        "result": "success"
+    })
+    is_flash_req = not (args.query or args.status or args.request_bootloader)
+    if args.skip_current and is_flash_req:
+        with telemetry.phase("version_check"):
+            status = await check_args_current(args)
+        if status is not None:
+            telemetry.info["running_version"] = status["running_version"]
+            telemetry.info["image_version"] = status["image_version"]
+            if status["up_to_date"]:
+                output_line(
+                    f"MCU '{status['mcu_name']}' already runs "
+                    f"{status['running_version']}, nothing to flash"
+                )
+                telemetry.info["result"] = "up_to_date"
+                return telemetry.get_report()
+            if status["running_version"] is not None:
+                output_line(
+                    f"MCU '{status['mcu_name']}' runs "
+                    f"{status['running_version']}, image is "
+                    f"{status['image_version']}"
+                )
+    sock: CanSocket | SerialSocket | None = None
+    try:
+        with telemetry.phase("total"):
+            if args.device is None:
+                sock = CanSocket(args, telemetry, progress)
+            else:
+                sock = SerialSocket(args, telemetry, progress)
+            await sock.run()
+            if isinstance(sock, CanSocket) and sock.is_query:
+                telemetry.info["can_nodes"] = sock.discovered
+            if sock.is_usb_can_bridge and not sock.is_bootloader_req:
+                args.device = str(sock.usb_serial_path)
+                sock.close()
+                sock = SerialSocket(args, telemetry, progress)
+                await sock.run()
+    except Exception as e:
+        telemetry.info["result"] = "error"
+        telemetry.info["error"] = str(e)
+        raise
+    finally:
+        if sock is not None:
+            sock.close()
+    return telemetry.get_report()
+
+async def flash_serial(
+    device: str,
+    firmware: Union[str, pathlib.Path],
+    baud: int = 250000,
+    window: int = 1,
+    diff: bool = False,
+    skip_current: bool = False,
+    klippy_socket: Union[str, pathlib.Path] = KLIPPY_SOCKET_PATH,
+    request_bootloader: bool = False,
+    status: bool = False,
+    telemetry: Optional[FlashTelemetry] = None,
+    progress: Optional[ProgressCallback] = None
+) -> Dict[str, Any]:
+    """
+    Flash a device connected over USB or a UART.  A USB device running
+    Klipper is switched to Katapult first.  Returns the telemetry report,
+    with "result" set to "success" or "up_to_date".  Raises FlashError
+    (or OSError) on failure.  With a progress callback, progress events
+    and status messages are passed to it instead of being printed.
+    """
+    args = _make_args(
+        device=device, firmware=str(firmware), baud=baud, window=window,
+        diff=diff, skip_current=skip_current,
+        klippy_socket=str(klippy_socket),
+        request_bootloader=request_bootloader, status=status
+    )
+    return await _run_session(args, telemetry, progress)
+
+async def flash_can(
+    uuid: Union[int, str, Iterable[int], None],
+    firmware: Union[str, pathlib.Path],
+    interface: str = "can0",
+    window: int = 1,
+    diff: bool = False,
+    skip_current: bool = False,
+    klippy_socket: Union[str, pathlib.Path] = KLIPPY_SOCKET_PATH,
+    request_bootloader: bool = False,
+    status: bool = False,
+    expect_nodes: Optional[int] = None,
+    canfd: bool = False,
+    telemetry: Optional[FlashTelemetry] = None,
+    progress: Optional[ProgressCallback] = None
+) -> Dict[str, Any]:
+    """
+    Flash one or more CAN nodes.  The uuid may be an integer, a hex
+    string, a list of integers or "all" for every Katapult node found.
+    Multiple nodes are flashed concurrently and reported under "nodes".
+    With canfd set, long messages are sent in CAN-FD frames when the
+    interface supports it.  Otherwise behaves like flash_serial().
+    """
+    if uuid is None:
+        raise FlashError(
+            "The 'uuid' option must be specified to flash a CAN device"
+        )
+    if isinstance(uuid, int):
+        uuid_arg = f"{uuid:012x}"
+    elif isinstance(uuid, str):
+        uuid_arg = uuid
+    else:
+        uuid_arg = ",".join(f"{u:012x}" for u in uuid)
+    args = _make_args(
+        uuid=uuid_arg, firmware=str(firmware), interface=interface,
+        window=window, diff=diff, skip_current=skip_current,
+        klippy_socket=str(klippy_socket),
+        request_bootloader=request_bootloader, status=status,
+        expect_nodes=expect_nodes, canfd=canfd
+    )
+    return await _run_session(args, telemetry, progress)
+
+async def query_can(
+    interface: str = "can0",
+    expect_nodes: Optional[int] = None,
+    quiet_time: Optional[float] = .5,
+    timeout: Optional[float] = None,
+    telemetry: Optional[FlashTelemetry] = None,
+    progress: Optional[ProgressCallback] = None
+) -> List[Dict[str, Any]]:
+    """
+    Query the unassigned nodes on a CAN interface.  Returns a list of
+    nodes with their "uuid" as a hex string and "application".
+    """
+    args = _make_args(
+        interface=interface, query=True, expect_nodes=expect_nodes,
+        quiet_time=quiet_time, query_timeout=timeout, firmware=""
+    )
+    report = await _run_session(args, telemetry, progress)
+    return report.get("can_nodes", [])
+
+async def watch_can(
+    interface: str = "can0", timeout: Optional[float] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Continuously query a CAN interface and yield each node, with its
+    "uuid", "application" and "timestamp", the first time it responds.
+    Runs until the timeout expires or the consumer stops iterating.
+    """
+    args = _make_args(interface=interface, query=True, firmware="")
+    sock = CanSocket(args)
+    try:
+        sock.open()
+        async for uuid, app in sock._discover_uuids(None, None, timeout):
+            yield {
+                "uuid": f"{uuid:012x}", "application": app,
+                "timestamp": time.time()
+            }
+    finally:
+        sock.close()
+
 async def main(args: argparse.Namespace) -> int:
+    logging.basicConfig(level=logging.INFO)
     if not args.verbose:
         logging.getLogger().setLevel(logging.ERROR)
-    iscan = args.device is None
-    sock: CanSocket | SerialSocket | None = None
+    if args.firmware_info:
+        fw_path = pathlib.Path(args.firmware).expanduser().resolve()
+        try:
+            fw_info = get_firmware_info(fw_path)
+        except OSError:
+            logging.exception("Unable to read firmware file")
+            return 1
+        output_line(json.dumps(fw_info))
+        return 0
+    telemetry = FlashTelemetry()
     try:
-        if iscan:
-            sock = CanSocket(args)
+        if args.watch:
+            async for node in watch_can(args.interface, args.query_timeout):
+                output_line(json.dumps(node))
+            return 0
+        elif args.query:
+            await query_can(
+                args.interface, args.expect_nodes, args.quiet_time,
+                args.query_timeout, telemetry
+            )
+        elif args.device is not None:
+            await flash_serial(
+                args.device, args.firmware, args.baud, args.window,
+                args.diff, args.skip_current, args.klippy_socket,
+                args.request_bootloader, args.status, telemetry
+            )
         else:
-            sock = SerialSocket(args)
-        await sock.run()
-        if sock.is_usb_can_bridge and not sock.is_bootloader_req:
-            args.device = str(sock.usb_serial_path)
-            sock.close()
-            sock = SerialSocket(args)
-            await sock.run()
+            await flash_can(
+                args.uuid, args.firmware, args.interface, args.window,
+                args.diff, args.skip_current, args.klippy_socket,
+                args.request_bootloader, args.status, args.expect_nodes,
+                args.canfd, telemetry
+            )
     except Exception:
         logging.exception("Flash Tool Error")
         return 1
     finally:
-        if sock is not None:
-            sock.close()
-    if sock is None:
-        return 1
-    if sock.is_query:
+        if args.report is not None and not args.watch:
+            telemetry.write_report(args.report)
+    if telemetry.info["result"] == "up_to_date":
+        pass
+    elif args.query:
         output_line("CANBus UUID Query Complete")
-    elif sock.is_bootloader_req:
+    elif args.request_bootloader:
         output_line("Bootloader Request Complete")
-    elif sock.is_status_req:
+    elif args.status:
         output_line("Status Request Complete")
     else:
         output_line("Programming Complete")
@@ -1139,12 +3263,37 @@ if __name__ == '__main__':
         help="Path to Klipper firmware file")
     parser.add_argument(
         "-u", "--uuid", metavar="<uuid>", default=None,
-        help="Can device uuid"
+        help="Can device uuid. Multiple comma separated uuids, or 'all' "
+        "for every Katapult node found, are flashed concurrently"
     )
     parser.add_argument(
         "-q", "--query", action="store_true",
         help="Query available CAN UUIDs (CANBus Ony)"
     )
+    parser.add_argument(
+        "-n", "--expect-nodes", type=int, metavar="<count>", default=None,
+        help="Stop CAN node discovery once this many nodes responded"
+    )
+    parser.add_argument(
+        "--quiet-time", type=float, metavar="<seconds>", default=.5,
+        help="Stop CAN node discovery when no new node responded for "
+        "this long"
+    )
+    parser.add_argument(
+        "--query-timeout", type=float, metavar="<seconds>", default=None,
+        help="Maximum duration of CAN node discovery, defaults to 2 "
+        "seconds and to no limit with --watch"
+    )
+    parser.add_argument(
+        "-W", "--watch", action="store_true",
+        help="Continuously query CAN nodes and print each new node as a "
+        "JSON line (implies --query)"
+    )
+    parser.add_argument(
+        "-F", "--canfd", action="store_true",
+        help="Send long messages in CAN-FD frames, falls back to classic "
+        "CAN when the interface is not configured for CAN-FD"
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true",
         help="Enable verbose responses"
@@ -1157,5 +3306,34 @@ if __name__ == '__main__':
         "-s", "--status", action="store_true",
         help="Connect to bootloader and print status"
     )
+    parser.add_argument(
+        "-I", "--firmware-info", action="store_true",
+        help="Print the Klipper version and MCU of the firmware file as JSON"
+    )
+    parser.add_argument(
+        "-D", "--diff", action="store_true",
+        help="Only write flash pages that differ from the current contents"
+    )
+    parser.add_argument(
+        "-R", "--report", metavar="<file>", default=None,
+        help="Write a JSON timing report to a file, '-' for stdout"
+    )
+    parser.add_argument(
+        "-C", "--skip-current", action="store_true",
+        help="Skip flashing when Klipper reports that the device already "
+        "runs the firmware version"
+    )
+    parser.add_argument(
+        "-k", "--klippy-socket", metavar="<socket>",
+        default=str(KLIPPY_SOCKET_PATH),
+        help="Path to the Klippy API socket used by --skip-current"
+    )
+    parser.add_argument(
+        "-w", "--window", default=1, type=int, metavar='<blocks>',
+        help="Number of blocks kept in flight while flashing"
+    )
     args = parser.parse_args()
-    exit(asyncio.run(main(args)))
+    try:
+        exit(asyncio.run(main(args)))
+    except KeyboardInterrupt:
+        exit(0 if args.watch else 1)
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# Micro benchmarks for flashtool.py
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import annotations
+import io
+import sys
+import time
+import errno
+import contextlib
+import socket
+import struct
+import asyncio
+import logging
+import pathlib
+import argparse
+from typing import Any, Callable, Dict, List, Type, Union
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+import flashtool  # noqa: E402
+from katapult_emulator import (  # noqa: E402
+    KatapultEmulator, PtyTransport, CanTransport
+)
+
+DEFAULT_IMAGE = pathlib.Path(__file__).parent.joinpath(
+    "../mainboard_and_toolhead_firmwares/v0.13.0-154/Toolhead_X3.uf2"
+).resolve()
+
+# Original bitwise implementation, kept as the reference for the benchmark
+def crc16_ccitt_bitwise(buf: Union[bytes, bytearray]) -> int:
+    crc = 0xffff
+    for data in buf:
+        data ^= crc & 0xff
+        data ^= (data & 0x0f) << 4
+        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
+    return crc & 0xFFFF
+
+def timeit(func: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def build_frames(image: bytes, block_size: int) -> list:
+    cmd = flashtool.BOOTLOADER_CMDS["SEND_BLOCK"]
+    frames = []
+    for idx, offset in enumerate(range(0, len(image), block_size)):
+        buf = image[offset:offset + block_size]
+        buf += b"\xFF" * (block_size - len(buf))
+        payload = struct.pack("<I", idx * block_size) + buf
+        frames.append(bytes([cmd, len(payload) // 4]) + payload)
+    return frames
+
+def bench_crc(args: argparse.Namespace) -> int:
+    image = pathlib.Path(args.image).expanduser().read_bytes()
+    flashtool.output_line(
+        f"Image: {args.image} ({len(image)} bytes), best of {args.repeat}"
+    )
+    for block_size in (64, 128, 256, 512):
+        frames = build_frames(image, block_size)
+        expected = [crc16_ccitt_bitwise(f) for f in frames]
+        if [flashtool.crc16_ccitt(f) for f in frames] != expected:
+            flashtool.output_line("crc16_ccitt output mismatch")
+            return 1
+        if flashtool.crc16_ccitt_batch(frames) != expected:
+            flashtool.output_line("crc16_ccitt_batch output mismatch")
+            return 1
+        t_ref = timeit(
+            lambda: [crc16_ccitt_bitwise(f) for f in frames], args.repeat
+        )
+        t_single = timeit(
+            lambda: [flashtool.crc16_ccitt(f) for f in frames], args.repeat
+        )
+        t_batch = timeit(
+            lambda: flashtool.crc16_ccitt_batch(frames), args.repeat
+        )
+        flashtool.output_line(
+            f"block {block_size:3d}: {len(frames):5d} frames | "
+            f"bitwise {t_ref * 1000:8.2f} ms | "
+            f"per frame {t_single * 1000:7.2f} ms "
+            f"({t_ref / t_single:6.1f}x) | "
+            f"batch {t_batch * 1000:7.2f} ms ({t_ref / t_batch:6.1f}x)"
+        )
+    return 0
+
+# Receive handler prior to the zero-copy rework, kept as the reference
+class LegacyRecvCanSocket(flashtool.CanSocket):
+    def __init__(self, args: argparse.Namespace) -> None:
+        super().__init__(args)
+        self.input_buffer = b""  # type: ignore
+        self.input_busy = False
+
+    def _handle_can_response(self) -> None:
+        try:
+            data = self.cansock.recv(4096)
+        except socket.error as e:
+            if e.errno == errno.EBADF:
+                logging.exception("Can Socket Read Error, closing")
+                data = b''
+            else:
+                return
+        if not data:
+            self.close()
+            return
+        self.input_buffer += data  # type: ignore
+        if self.input_busy:
+            return
+        self.input_busy = True
+        while len(self.input_buffer) >= 16:
+            packet = self.input_buffer[:16]
+            can_id, length, data = struct.unpack(flashtool.CAN_FMT, packet)
+            can_id &= socket.CAN_EFF_MASK
+            node = self.nodes.get(can_id)
+            if node is not None:
+                node.feed_data(data[:length])
+            self.input_buffer = self.input_buffer[16:]  # type: ignore
+        self.input_busy = False
+
+async def measure_can_rx(
+    sock_cls: Type[flashtool.CanSocket], args: argparse.Namespace
+) -> float:
+    sock_args = argparse.Namespace(
+        interface=args.interface, firmware="", uuid=None, query=True,
+        request_bootloader=False, status=False,
+        expect_nodes=None, quiet_time=.5, query_timeout=None, canfd=False
+    )
+    cansock = sock_cls(sock_args)
+    cansock.cansock.bind((args.interface,))
+    cansock.cansock.setblocking(False)
+    cansock.closed = False
+    node = flashtool.CanNode(args.can_id, cansock)
+    cansock.nodes[args.can_id] = node
+    loop = asyncio.get_running_loop()
+    loop.add_reader(cansock.cansock.fileno(), cansock._handle_can_response)
+    txsock = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    txsock.bind((args.interface,))
+    frame = flashtool.CAN_STRUCT.pack(args.can_id, 8, b"\xA5" * 8)
+
+    def transmit() -> None:
+        for _ in range(args.frames):
+            while True:
+                try:
+                    txsock.send(frame)
+                except OSError as e:
+                    # Transmit queue full, give the receiver a moment
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    time.sleep(.0001)
+                else:
+                    break
+
+    received = 0
+    start = time.perf_counter()
+    tx_done = loop.run_in_executor(None, transmit)
+    try:
+        while received < args.frames * 8:
+            try:
+                data = await node.read(65536, timeout=1.)
+            except asyncio.TimeoutError:
+                break
+            received += len(data)
+        elapsed = time.perf_counter() - start
+        await tx_done
+    finally:
+        txsock.close()
+        cansock.close()
+    frames = received // 8
+    if frames < args.frames:
+        flashtool.output_line(
+            f"  {sock_cls.__name__}: {args.frames - frames} frames dropped"
+        )
+    return frames / elapsed
+
+def bench_can_rx(args: argparse.Namespace) -> int:
+    try:
+        legacy = asyncio.run(measure_can_rx(LegacyRecvCanSocket, args))
+        current = asyncio.run(measure_can_rx(flashtool.CanSocket, args))
+    except OSError as e:
+        flashtool.output_line(
+            f"Unable to use CAN interface {args.interface}: {e}\n"
+            "Create a virtual interface with:\n"
+            "  sudo ip link add dev vcan0 type vcan\n"
+            "  sudo ip link set up vcan0"
+        )
+        return 1
+    flashtool.output_line(
+        f"Interface {args.interface}, {args.frames} frames\n"
+        f"  legacy receive: {legacy:10.0f} frames/s\n"
+        f"  current receive: {current:9.0f} frames/s "
+        f"({current / legacy:.1f}x)"
+    )
+    return 0
+
+# Transmit path prior to the batched queue, kept as the reference
+class LegacySendCanSocket(flashtool.CanSocket):
+    def __init__(self, args: argparse.Namespace) -> None:
+        super().__init__(args)
+        self.output_packets: Dict[int, List[bytes]] = {}
+
+    def send(self, can_id: int, payload: bytes = b"") -> None:
+        if can_id > 0x7FF:
+            can_id |= socket.CAN_EFF_FLAG
+        queue = self.output_packets.setdefault(can_id, [])
+        while payload:
+            length = min(len(payload), 8)
+            pkt_data = payload[:length]
+            payload = payload[length:]
+            queue.append(flashtool.CAN_STRUCT.pack(can_id, length, pkt_data))
+        if self.output_busy:
+            return
+        self.output_busy = True
+        asyncio.create_task(self._do_can_send())
+
+    async def _do_can_send(self) -> None:
+        while self.output_packets:
+            for can_id in list(self.output_packets):
+                queue = self.output_packets[can_id]
+                packet = queue.pop(0)
+                if not queue:
+                    del self.output_packets[can_id]
+                await self._loop.sock_sendall(self.cansock, packet)
+        self.output_busy = False
+
+async def measure_can_tx(
+    sock_cls: Type[flashtool.CanSocket], args: argparse.Namespace
+) -> float:
+    sock_args = argparse.Namespace(
+        interface=args.interface, firmware="", uuid=None, query=True,
+        request_bootloader=False, status=False,
+        expect_nodes=None, quiet_time=.5, query_timeout=None, canfd=False
+    )
+    cansock = sock_cls(sock_args)
+    cansock.open()
+    rxsock = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    rxsock.bind((args.interface,))
+    rxsock.settimeout(1.)
+    loop = asyncio.get_running_loop()
+
+    def receive() -> int:
+        count = 0
+        while count < args.frames:
+            try:
+                rxsock.recv(flashtool.CAN_FRAME_SIZE)
+            except socket.timeout:
+                break
+            count += 1
+        return count
+
+    # SEND_BLOCK sized messages of 64 byte blocks
+    payload = b"\xA5" * 72
+    start = time.perf_counter()
+    rx_done = loop.run_in_executor(None, receive)
+    try:
+        for _ in range(args.frames // 9):
+            cansock.send(args.can_id, payload)
+            # Let the legacy sender run, as a flasher awaiting a response would
+            await asyncio.sleep(0)
+        frames = await rx_done
+        elapsed = time.perf_counter() - start
+    finally:
+        rxsock.close()
+        cansock.close()
+    if frames < args.frames // 9 * 9:
+        flashtool.output_line(
+            f"  {sock_cls.__name__}: {args.frames // 9 * 9 - frames} "
+            "frames not received"
+        )
+    return frames / elapsed
+
+def bench_can_tx(args: argparse.Namespace) -> int:
+    try:
+        legacy = asyncio.run(measure_can_tx(LegacySendCanSocket, args))
+        current = asyncio.run(measure_can_tx(flashtool.CanSocket, args))
+    except (OSError, flashtool.FlashError) as e:
+        flashtool.output_line(
+            f"Unable to use CAN interface {args.interface}: {e}\n"
+            "Create a virtual interface with:\n"
+            "  sudo ip link add dev vcan0 type vcan\n"
+            "  sudo ip link set up vcan0"
+        )
+        return 1
+    flashtool.output_line(
+        f"Interface {args.interface}, {args.frames} frames\n"
+        f"  legacy send: {legacy:10.0f} frames/s\n"
+        f"  current send: {current:9.0f} frames/s "
+        f"({current / legacy:.1f}x)"
+    )
+    return 0
+
+async def measure_flash(
+    args: argparse.Namespace, block_size: int
+) -> Dict[str, Any]:
+    uuid = 0x0123456789AB
+    emulator = KatapultEmulator(
+        block_size=block_size, uuid=uuid, latency=args.latency,
+        loss=args.loss, busy=args.busy, seed=0
+    )
+    transport: PtyTransport | CanTransport
+    telemetry = flashtool.FlashTelemetry()
+    if args.transport == "pty":
+        transport = PtyTransport(emulator)
+    else:
+        transport = CanTransport(args.interface, [emulator])
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if isinstance(transport, PtyTransport):
+                return await flashtool.flash_serial(
+                    transport.device, args.image, window=args.window,
+                    telemetry=telemetry
+                )
+            return await flashtool.flash_can(
+                uuid, args.image, args.interface, window=args.window,
+                telemetry=telemetry
+            )
+    finally:
+        transport.close()
+
+def bench_flash(args: argparse.Namespace) -> int:
+    # Retries are counted in the report, keep them off the console
+    logging.getLogger().setLevel(logging.ERROR)
+    flashtool.output_line(
+        f"Image: {args.image}, transport: {args.transport}, "
+        f"window: {args.window}, latency: {args.latency * 1000:.1f} ms, "
+        f"loss: {args.loss:.3f}, busy: {args.busy:.3f}"
+    )
+    for block_size in args.block_sizes:
+        try:
+            report = asyncio.run(measure_flash(args, block_size))
+        except (OSError, flashtool.FlashError) as e:
+            flashtool.output_line(f"block {block_size:3d}: failed ({e})")
+            return 1
+        rates = report["bytes_per_second"]
+        events: Dict[str, int] = {}
+        for stats in report["commands"].values():
+            for name, count in stats["events"].items():
+                events[name] = events.get(name, 0) + count
+        flashtool.output_line(
+            f"block {block_size:3d}: "
+            f"write {rates.get('write', 0.) / 1024:8.1f} KiB/s | "
+            f"verify {rates.get('verify', 0.) / 1024:8.1f} KiB/s | "
+            f"events {events or '-'}"
+        )
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Katapult Flash Tool Benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    crc_parser = subparsers.add_parser(
+        "crc", help="Compare crc16 implementations"
+    )
+    crc_parser.add_argument(
+        "-f", "--image", metavar="<firmware>", default=str(DEFAULT_IMAGE),
+        help="Firmware image to checksum"
+    )
+    crc_parser.add_argument(
+        "-n", "--repeat", default=5, type=int, metavar="<count>",
+        help="Number of timed runs"
+    )
+    crc_parser.set_defaults(func=bench_crc)
+    rx_parser = subparsers.add_parser(
+        "can-rx", help="Measure CanSocket receive throughput"
+    )
+    rx_parser.add_argument(
+        "-i", "--interface", default="vcan0", metavar="<can interface>",
+        help="Can Interface"
+    )
+    rx_parser.add_argument(
+        "-c", "--frames", default=100000, type=int, metavar="<count>",
+        help="Number of frames to transmit"
+    )
+    rx_parser.add_argument(
+        "--can-id", default=0x101, type=int, metavar="<id>",
+        help="CAN ID of the transmitted frames"
+    )
+    rx_parser.set_defaults(func=bench_can_rx)
+    tx_parser = subparsers.add_parser(
+        "can-tx", help="Measure CanSocket transmit throughput"
+    )
+    tx_parser.add_argument(
+        "-i", "--interface", default="vcan0", metavar="<can interface>",
+        help="Can Interface"
+    )
+    tx_parser.add_argument(
+        "-c", "--frames", default=90000, type=int, metavar="<count>",
+        help="Number of frames to transmit"
+    )
+    tx_parser.add_argument(
+        "--can-id", default=0x101, type=int, metavar="<id>",
+        help="CAN ID of the transmitted frames"
+    )
+    tx_parser.set_defaults(func=bench_can_tx)
+    flash_parser = subparsers.add_parser(
+        "flash", help="Flash and verify an emulated Katapult bootloader"
+    )
+    flash_parser.add_argument(
+        "transport", choices=["pty", "can"],
+        help="Transport to the emulated bootloader"
+    )
+    flash_parser.add_argument(
+        "-f", "--image", metavar="<firmware>", default=str(DEFAULT_IMAGE),
+        help="Firmware image to flash"
+    )
+    flash_parser.add_argument(
+        "-i", "--interface", default="vcan0", metavar="<can interface>",
+        help="Can Interface"
+    )
+    flash_parser.add_argument(
+        "-s", "--block-sizes", default=[64, 128, 256, 512], type=int,
+        nargs="+", metavar="<bytes>", help="Block sizes to benchmark"
+    )
+    flash_parser.add_argument(
+        "-w", "--window", default=1, type=int, metavar="<blocks>",
+        help="Number of blocks kept in flight while flashing"
+    )
+    flash_parser.add_argument(
+        "-l", "--latency", default=0., type=float, metavar="<seconds>",
+        help="Emulated response latency"
+    )
+    flash_parser.add_argument(
+        "--loss", default=0., type=float, metavar="<probability>",
+        help="Emulated request loss probability"
+    )
+    flash_parser.add_argument(
+        "--busy", default=0., type=float, metavar="<probability>",
+        help="Emulated busy response probability"
+    )
+    flash_parser.set_defaults(func=bench_flash)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    exit(args.func(args))
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+# Flash every MCU of a printer in one batch, driven by a per-model manifest
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# A manifest is a JSON file named after the printer model, stored next to
+# the firmware images it references:
+#
+#   {
+#     "model": "x-plus3",
+#     "targets": [
+#       {"name": "toolhead", "type": "uf2", "firmware": "Toolhead_X3.uf2",
+#        "size_mb": 128, "trigger": true},
+#       {"name": "mainboard", "type": "hid", "firmware": "X_4.bin",
+#        "device": "ttyS0"}
+#     ]
+#   }
+#
+# Target types:
+#   uf2       copy the image to an RP2040 in BOOTSEL mode, found by the
+#             size of its mass storage block device
+#   hid       flash an STM32 HID bootloader with hid-flash
+#   serial    flash Katapult over a serial or USB device
+#   can       flash Katapult over CAN, "uuid" may be a list or "all"
+#
+# Optional target keys are "depends" (names of targets that must finish
+# first), "device", "baud", "interface", "uuid", "expect_nodes" (stops CAN
+# discovery early when "uuid" is "all"), "canfd" and "window".  Targets
+# without a dependency path between them are flashed concurrently.  With
+# --on-trigger the batch only runs if the targets marked as "trigger"
+# are present, so a boot without a toolhead in BOOTSEL mode leaves the
+# printer untouched.  Targets that Klipper reports as already running the
+# image version are skipped, and Klipper is only stopped if something is
+# left to flash: once before the first flash, started again after the
+# last one.
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import pathlib
+import argparse
+import graphlib
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+import flashtool  # noqa: E402
+from flashtool import FlashError, FlashTelemetry, output_line  # noqa: E402
+
+FREEDI_DIR = pathlib.Path(__file__).parent.parent.resolve()
+FIRMWARE_DIR = FREEDI_DIR.joinpath(
+    "mainboard_and_toolhead_firmwares/v0.13.0-154"
+)
+HID_FLASH_PATH = FREEDI_DIR.joinpath("helpers/hid-flash")
+# The boot service runs as root, printer_data lives next to the checkout
+KLIPPY_SOCKET_PATH = FREEDI_DIR.parent.joinpath("printer_data/comms/klippy.sock")
+TARGET_TYPES = ("uf2", "hid", "serial", "can")
+
+def _sudo(*cmd: str) -> List[str]:
+    if os.geteuid() == 0:
+        return list(cmd)
+    return ["sudo", "-n", *cmd]
+
+async def run_command(cmd: List[str]) -> str:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT
+    )
+    stdout, _ = await proc.communicate()
+    output = stdout.decode(errors="replace").strip()
+    if proc.returncode != 0:
+        raise FlashError(
+            f"Command '{' '.join(cmd)}' failed with code "
+            f"{proc.returncode}: {output}"
+        )
+    return output
+
+def find_uf2_block_device(size_mb: int) -> Optional[pathlib.Path]:
+    # An RP2040 in BOOTSEL mode shows up as a mass storage device with a
+    # single partition of a fixed size
+    for sys_path in sorted(pathlib.Path("/sys/class/block").glob("sd*[0-9]")):
+        try:
+            sectors = int(sys_path.joinpath("size").read_text())
+        except (OSError, ValueError):
+            continue
+        if sectors * 512 == size_mb * 1024 * 1024:
+            dev_path = pathlib.Path("/dev").joinpath(sys_path.name)
+            if dev_path.exists():
+                return dev_path
+    return None
+
+def load_manifest(path: pathlib.Path) -> Dict[str, Any]:
+    try:
+        manifest = json.loads(path.read_text())
+    except (OSError, ValueError) as e:
+        raise FlashError(f"Unable to read manifest {path}: {e}") from e
+    targets: Dict[str, Dict[str, Any]] = {}
+    for target in manifest.get("targets", []):
+        name = target.get("name")
+        if not name or name in targets:
+            raise FlashError(f"Manifest {path}: missing or duplicate name")
+        if target.get("type") not in TARGET_TYPES:
+            raise FlashError(
+                f"Manifest {path}: target '{name}' has unknown type "
+                f"'{target.get('type')}'"
+            )
+        fw_path = path.parent.joinpath(target["firmware"]).resolve()
+        if not fw_path.is_file():
+            raise FlashError(
+                f"Manifest {path}: firmware for '{name}' not found at {fw_path}"
+            )
+        target["firmware"] = fw_path
+        target.setdefault("depends", [])
+        targets[name] = target
+    if not targets:
+        raise FlashError(f"Manifest {path} contains no targets")
+    graph = graphlib.TopologicalSorter()
+    for name, target in targets.items():
+        for dep in target["depends"]:
+            if dep not in targets:
+                raise FlashError(
+                    f"Manifest {path}: target '{name}' depends on unknown "
+                    f"target '{dep}'"
+                )
+        graph.add(name, *target["depends"])
+    try:
+        order = list(graph.static_order())
+    except graphlib.CycleError as e:
+        raise FlashError(f"Manifest {path}: dependency cycle {e.args[1]}")
+    # Targets sharing a device must be ordered, they can't run concurrently
+    ancestors: Dict[str, set] = {}
+    for name in order:
+        deps = set(targets[name]["depends"])
+        for dep in targets[name]["depends"]:
+            deps |= ancestors[dep]
+        ancestors[name] = deps
+    devices: Dict[str, str] = {}
+    for name in order:
+        device = targets[name].get("device")
+        if device is None:
+            continue
+        prev = devices.get(device)
+        if prev is not None and prev not in ancestors[name]:
+            raise FlashError(
+                f"Manifest {path}: targets '{prev}' and '{name}' share "
+                f"device {device} and must depend on each other"
+            )
+        devices[device] = name
+    manifest["targets"] = {name: targets[name] for name in order}
+    return manifest
+
+class FleetFlasher:
+    def __init__(
+        self,
+        manifest: Dict[str, Any],
+        stop_klipper: bool = True,
+        dry_run: bool = False,
+        require_trigger: bool = False,
+        klippy_socket: Optional[pathlib.Path] = KLIPPY_SOCKET_PATH
+    ) -> None:
+        self.manifest = manifest
+        self.targets: Dict[str, Dict[str, Any]] = manifest["targets"]
+        self.stop_klipper = stop_klipper
+        self.dry_run = dry_run
+        self.require_trigger = require_trigger
+        self.klippy_socket = klippy_socket
+        self.telemetry = FlashTelemetry()
+        self.results: Dict[str, str] = {}
+        self.uf2_devices: Dict[str, pathlib.Path] = {}
+
+    def _log(self, name: str, msg: str) -> None:
+        output_line(f"[{name}] {msg}")
+
+    def _is_present(self, target: Dict[str, Any]) -> bool:
+        if target["type"] == "uf2":
+            dev = find_uf2_block_device(target.get("size_mb", 128))
+            if dev is None:
+                return False
+            self.uf2_devices[target["name"]] = dev
+            return True
+        device = target.get("device")
+        if device is None or target["type"] == "can":
+            return True
+        if target["type"] == "hid":
+            device = f"/dev/{device}"
+        return pathlib.Path(device).exists()
+
+    async def _is_current(self, target: Dict[str, Any]) -> bool:
+        assert self.klippy_socket is not None
+        device: Optional[str] = target.get("device")
+        uuid: Optional[int] = None
+        if target["type"] == "uf2":
+            # A toolhead in BOOTSEL mode is never running Klipper
+            return False
+        elif target["type"] == "hid":
+            device = f"/dev/{device}"
+        elif target["type"] == "can":
+            if not isinstance(target.get("uuid"), str):
+                return False
+            try:
+                uuid = int(target["uuid"], 16)
+            except ValueError:
+                return False
+        status = await flashtool.check_firmware_current(
+            target["firmware"], self.klippy_socket, device, uuid
+        )
+        if status["up_to_date"]:
+            self._log(
+                target["name"], f"Already running {status['running_version']}"
+            )
+        return status["up_to_date"]
+
+    async def _flash_uf2(self, target: Dict[str, Any]) -> None:
+        dev = self.uf2_devices[target["name"]]
+        self._log(target["name"], f"Copying {target['firmware'].name} to {dev}")
+        await run_command(
+            _sudo("dd", f"if={target['firmware']}", f"of={dev}",
+                  "bs=64k", "conv=fsync", "status=none")
+        )
+
+    async def _flash_hid(self, target: Dict[str, Any]) -> None:
+        self._log(
+            target["name"],
+            f"Flashing {target['firmware'].name} to {target['device']}"
+        )
+        output = await run_command(
+            [str(HID_FLASH_PATH), str(target["firmware"]), target["device"]]
+        )
+        logging.info(output)
+
+    async def _flash_katapult(
+        self, target: Dict[str, Any], telemetry: FlashTelemetry
+    ) -> None:
+        self._log(target["name"], f"Flashing {target['firmware'].name}")
+        options: Dict[str, Any] = {
+            "window": target.get("window", 1), "telemetry": telemetry
+        }
+        if target["type"] == "can":
+            uuid = target["uuid"]
+            await flashtool.flash_can(
+                ",".join(uuid) if isinstance(uuid, list) else uuid,
+                target["firmware"], target.get("interface", "can0"),
+                expect_nodes=target.get("expect_nodes"),
+                canfd=target.get("canfd", False), **options
+            )
+            return
+        device = target["device"]
+        baud = target.get("baud", 250000)
+        if flashtool.get_usb_path(pathlib.Path(device)) is None:
+            # A Klipper MCU on a plain UART must be asked to jump to
+            # Katapult before flashing, USB devices are handled by the tool
+            await flashtool.flash_serial(
+                device, target["firmware"], baud, request_bootloader=True,
+                **options
+            )
+        await flashtool.flash_serial(
+            device, target["firmware"], baud, **options
+        )
+
+    async def _run_target(
+        self, name: str, deps: List[asyncio.Task]
+    ) -> bool:
+        target = self.targets[name]
+        if deps and not all(await asyncio.gather(*deps)):
+            self.results[name] = "skipped"
+            self._log(name, "Skipped, a dependency did not complete")
+            return False
+        telemetry = self.telemetry.node(name)
+        try:
+            if target["type"] in ("can", "serial"):
+                # The flashtool session records its own total
+                await self._flash_katapult(target, telemetry)
+            else:
+                with telemetry.phase("total"):
+                    if target["type"] == "uf2":
+                        await self._flash_uf2(target)
+                    else:
+                        await self._flash_hid(target)
+        except Exception as e:
+            logging.exception(f"Flash target '{name}' failed")
+            telemetry.info["error"] = str(e)
+            self.results[name] = "error"
+            self._log(name, f"Failed: {e}")
+            return False
+        self.results[name] = "success"
+        self._log(name, f"Done in {telemetry.phases['total']:.1f}s")
+        return True
+
+    async def _set_klipper(self, action: str) -> None:
+        output_line(f"Klipper service: {action}")
+        await run_command(_sudo("systemctl", action, "klipper"))
+
+    async def _klipper_active(self) -> bool:
+        try:
+            await run_command(["systemctl", "is-active", "--quiet", "klipper"])
+        except (FlashError, OSError):
+            return False
+        return True
+
+    async def run(self) -> bool:
+        present = {
+            name: self._is_present(target)
+            for name, target in self.targets.items()
+        }
+        triggers = [
+            name for name, target in self.targets.items()
+            if target.get("trigger")
+        ]
+        if self.require_trigger:
+            if not triggers:
+                output_line("Manifest has no trigger target, nothing to do")
+                return True
+            for name in triggers:
+                if not present[name]:
+                    output_line(
+                        f"Trigger target '{name}' not present, nothing to do"
+                    )
+                    return True
+        missing = [name for name, found in present.items() if not found]
+        for name in missing:
+            self.results[name] = "missing"
+            self._log(name, "Device not present, skipping")
+        names = [name for name, found in present.items() if found]
+        if self.klippy_socket is not None:
+            # Klipper must still be running to report the MCU versions
+            with self.telemetry.phase("version_check"):
+                current = await asyncio.gather(
+                    *(self._is_current(self.targets[name]) for name in names)
+                )
+            for name, is_current in zip(list(names), current):
+                if is_current:
+                    self.results[name] = "current"
+                    names.remove(name)
+        if not names:
+            output_line("All targets are up to date, nothing to flash")
+            return True
+        if self.dry_run:
+            for name, target in self.targets.items():
+                if name in names:
+                    deps = ", ".join(target["depends"]) or "none"
+                    self._log(
+                        name, f"Would flash {target['firmware'].name} "
+                        f"({target['type']}), depends on {deps}"
+                    )
+            return True
+        restart_klipper = False
+        with self.telemetry.phase("downtime"):
+            if self.stop_klipper and await self._klipper_active():
+                await self._set_klipper("stop")
+                restart_klipper = True
+            try:
+                tasks: Dict[str, asyncio.Task] = {}
+                for name in names:
+                    target = self.targets[name]
+                    deps = [
+                        tasks[dep] for dep in target["depends"] if dep in tasks
+                    ]
+                    satisfied = [
+                        dep for dep in target["depends"]
+                        if self.results.get(dep) == "current"
+                    ]
+                    if len(deps) + len(satisfied) < len(target["depends"]):
+                        self.results[name] = "skipped"
+                        self._log(name, "Skipped, a dependency is not present")
+                        continue
+                    tasks[name] = asyncio.create_task(
+                        self._run_target(name, deps)
+                    )
+                await asyncio.gather(*tasks.values())
+            finally:
+                if restart_klipper:
+                    await self._set_klipper("start")
+        self.telemetry.info["results"] = dict(self.results)
+        downtime = self.telemetry.phases["downtime"]
+        output_line(f"Batch complete in {downtime:.1f}s: {self.results}")
+        return all(
+            res in ("success", "missing", "current")
+            for res in self.results.values()
+        )
+
+async def main(args: argparse.Namespace) -> int:
+    logging.basicConfig(level=logging.INFO)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+    if args.manifest is not None:
+        manifest_path = pathlib.Path(args.manifest).expanduser().resolve()
+    else:
+        manifest_path = FIRMWARE_DIR.joinpath(f"{args.model.lower()}.json")
+    fleet: Optional[FleetFlasher] = None
+    try:
+        manifest = load_manifest(manifest_path)
+        fleet = FleetFlasher(
+            manifest, not args.keep_klipper, args.dry_run, args.on_trigger,
+            None if args.force else pathlib.Path(args.klippy_socket)
+        )
+        fleet.telemetry.info.update({
+            "timestamp": time.time(),
+            "manifest": str(manifest_path),
+            "model": manifest.get("model")
+        })
+        success = await fleet.run()
+    except Exception:
+        logging.exception("Fleet Flasher Error")
+        return 1
+    finally:
+        if fleet is not None and args.report is not None:
+            fleet.telemetry.write_report(args.report)
+    return 0 if success else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Flash all MCUs of a printer from a model manifest")
+    parser.add_argument(
+        "-m", "--model", default="x-plus3", metavar="<printer model>",
+        help="Printer model, selects <model>.json in the firmware directory"
+    )
+    parser.add_argument(
+        "-M", "--manifest", metavar="<manifest>", default=None,
+        help="Path to a manifest file, overrides --model"
+    )
+    parser.add_argument(
+        "-k", "--keep-klipper", action="store_true",
+        help="Do not stop the Klipper service while flashing"
+    )
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true",
+        help="Print the targets that would be flashed and exit"
+    )
+    parser.add_argument(
+        "-t", "--on-trigger", action="store_true",
+        help="Only flash when the manifest has a trigger target and it "
+        "is present, used by the boot service"
+    )
+    parser.add_argument(
+        "-f", "--force", action="store_true",
+        help="Flash targets even if Klipper reports they are up to date"
+    )
+    parser.add_argument(
+        "-s", "--klippy-socket", metavar="<socket>",
+        default=str(KLIPPY_SOCKET_PATH),
+        help="Path to the Klippy API socket used for the version check"
+    )
+    parser.add_argument(
+        "-R", "--report", metavar="<file>", default=None,
+        help="Write a JSON timing report to a file, '-' for stdout"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="Enable verbose responses"
+    )
+    args = parser.parse_args()
+    exit(asyncio.run(main(args)))
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# Software emulation of a Katapult bootloader for testing flashtool.py
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import annotations
+import sys
+import os
+import tty
+import socket
+import struct
+import random
+import asyncio
+import logging
+import pathlib
+import argparse
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+from flashtool import (  # noqa: E402
+    CMD_HEADER, CMD_TRAILER, BOOTLOADER_CMDS, ACK_SUCCESS, ACK_ERROR,
+    ACK_BUSY, CAN_STRUCT, CAN_FRAME_SIZE, CANBUS_ID_ADMIN,
+    CANBUS_ID_ADMIN_RESP, CANBUS_CMD_QUERY_UNASSIGNED, CANBUS_CMD_SET_NODEID,
+    CANBUS_CMD_CLEAR_NODE_ID, CANBUS_RESP_NEED_NODEID, crc16_ccitt,
+    output_line
+)
+
+PROTO_VERSION = (1, 1, 0)
+
+class KatapultEmulator:
+    """
+    Implements the Katapult command protocol on top of an in-memory
+    flash.  Requests are dropped with probability 'loss' and answered
+    with a busy response with probability 'busy'.  Transports delay each
+    response by 'latency' seconds.
+    """
+    def __init__(
+        self,
+        block_size: int = 64,
+        app_start: int = 0x08002000,
+        mcu_type: str = "stm32f103xe",
+        software_version: str = "v0.0.1-emulated",
+        uuid: int = 0,
+        latency: float = 0.,
+        loss: float = 0.,
+        busy: float = 0.,
+        seed: Optional[int] = None
+    ) -> None:
+        if block_size not in (64, 128, 256, 512):
+            raise ValueError(f"Invalid block size {block_size}")
+        self.block_size = block_size
+        self.app_start = app_start
+        self.mcu_type = mcu_type
+        self.software_version = software_version
+        self.uuid = uuid
+        self.latency = latency
+        self.loss = loss
+        self.busy = busy
+        self.flash: Dict[int, bytes] = {}
+        self.blocks_written = 0
+        self.completed = False
+        self._random = random.Random(seed)
+        self._buffer = bytearray()
+
+    def reset(self) -> None:
+        self._buffer.clear()
+        self.blocks_written = 0
+        self.completed = False
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """
+        Process received bytes and return the response frames.
+        """
+        self._buffer.extend(data)
+        responses: List[bytes] = []
+        while True:
+            idx = self._buffer.find(CMD_HEADER)
+            if idx < 0:
+                # Keep a trailing header byte that may be completed later
+                del self._buffer[:max(0, len(self._buffer) - 1)]
+                break
+            del self._buffer[:idx]
+            if len(self._buffer) < 4:
+                break
+            frame_len = self._buffer[3] * 4 + 8
+            if len(self._buffer) < frame_len:
+                break
+            frame = bytes(self._buffer[:frame_len])
+            crc, = struct.unpack("<H", frame[-4:-2])
+            if frame[-2:] != CMD_TRAILER or crc != crc16_ccitt(frame[2:-4]):
+                # Resync on the next header
+                del self._buffer[:1]
+                continue
+            del self._buffer[:frame_len]
+            resp = self._handle_command(frame[2], frame[4:-4])
+            if resp is not None:
+                responses.append(resp)
+        return responses
+
+    def _build_response(
+        self, ack: int, cmd: int, payload: bytes = b""
+    ) -> bytes:
+        if len(payload) % 4:
+            payload += b"\x00" * (4 - len(payload) % 4)
+        data = struct.pack("<I", cmd) + payload
+        out = bytearray(CMD_HEADER)
+        out.append(ack)
+        out.append(len(data) // 4)
+        out.extend(data)
+        out.extend(struct.pack("<H", crc16_ccitt(out[2:])))
+        out.extend(CMD_TRAILER)
+        return bytes(out)
+
+    def _handle_command(self, cmd: int, payload: bytes) -> Optional[bytes]:
+        if self.loss and self._random.random() < self.loss:
+            return None
+        if self.busy and self._random.random() < self.busy:
+            return self._build_response(ACK_BUSY, cmd)
+        if cmd == BOOTLOADER_CMDS["CONNECT"]:
+            ver_bytes = bytes(reversed(PROTO_VERSION)) + b"\x00"
+            mcu_info = (
+                f"{self.mcu_type}\x00{self.software_version}\x00".encode()
+            )
+            resp = struct.pack(
+                "<4sII", ver_bytes, self.app_start, self.block_size
+            )
+            return self._build_response(ACK_SUCCESS, cmd, resp + mcu_info)
+        if cmd == BOOTLOADER_CMDS["GET_CANBUS_ID"]:
+            uuid = self.uuid.to_bytes(6, "big")
+            return self._build_response(ACK_SUCCESS, cmd, uuid)
+        if cmd == BOOTLOADER_CMDS["SEND_BLOCK"]:
+            if len(payload) != self.block_size + 4:
+                return self._build_response(ACK_ERROR, cmd)
+            addr, = struct.unpack("<I", payload[:4])
+            if addr < self.app_start or (addr - self.app_start) % self.block_size:
+                return self._build_response(ACK_ERROR, cmd)
+            self.flash[addr] = payload[4:]
+            self.blocks_written += 1
+            return self._build_response(ACK_SUCCESS, cmd, payload[:4])
+        if cmd == BOOTLOADER_CMDS["SEND_EOF"]:
+            return self._build_response(
+                ACK_SUCCESS, cmd, struct.pack("<I", self.blocks_written)
+            )
+        if cmd == BOOTLOADER_CMDS["REQUEST_BLOCK"]:
+            if len(payload) < 4:
+                return self._build_response(ACK_ERROR, cmd)
+            addr, = struct.unpack("<I", payload[:4])
+            block = self.flash.get(addr, b"\xFF" * self.block_size)
+            return self._build_response(ACK_SUCCESS, cmd, payload[:4] + block)
+        if cmd == BOOTLOADER_CMDS["COMPLETE"]:
+            self.completed = True
+            return self._build_response(ACK_SUCCESS, cmd)
+        return self._build_response(ACK_ERROR, cmd)
+
+class PtyTransport:
+    """
+    Presents an emulator on a pseudo-terminal.  The slave path can be
+    passed to flashtool.py with the -d option.
+    """
+    def __init__(self, emulator: KatapultEmulator) -> None:
+        self.emulator = emulator
+        self._loop = asyncio.get_running_loop()
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        self.device = os.ttyname(self.slave_fd)
+        self._loop.add_reader(self.master_fd, self._handle_read)
+
+    def _handle_read(self) -> None:
+        try:
+            data = os.read(self.master_fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # No slave is currently open
+            return
+        for resp in self.emulator.feed(data):
+            self._schedule(resp)
+
+    def _schedule(self, resp: bytes) -> None:
+        if self.emulator.latency:
+            self._loop.call_later(self.emulator.latency, self._write, resp)
+        else:
+            self._write(resp)
+
+    def _write(self, data: bytes) -> None:
+        try:
+            os.write(self.master_fd, data)
+        except OSError:
+            logging.exception("Emulator pty write error")
+
+    def close(self) -> None:
+        self._loop.remove_reader(self.master_fd)
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+class CanTransport:
+    """
+    Presents one or more emulated nodes on a CAN interface, answering
+    UUID queries and node ID assignment like the Katapult CAN admin
+    protocol.
+    """
+    def __init__(
+        self, interface: str, emulators: List[KatapultEmulator]
+    ) -> None:
+        self._loop = asyncio.get_running_loop()
+        self.emulators = emulators
+        self.node_ids: Dict[int, KatapultEmulator] = {}
+        self.cansock = socket.socket(
+            socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW
+        )
+        self.cansock.bind((interface,))
+        self.cansock.setblocking(False)
+        self._loop.add_reader(self.cansock.fileno(), self._handle_read)
+
+    def _handle_read(self) -> None:
+        while True:
+            try:
+                packet = self.cansock.recv(CAN_FRAME_SIZE)
+            except BlockingIOError:
+                break
+            except OSError:
+                logging.exception("Emulator CAN read error")
+                break
+            can_id, length, data = CAN_STRUCT.unpack(packet)
+            self._process_frame(can_id & socket.CAN_EFF_MASK, data[:length])
+
+    def _process_frame(self, can_id: int, data: bytes) -> None:
+        if can_id == CANBUS_ID_ADMIN:
+            self._handle_admin(data)
+            return
+        emulator = self.node_ids.get(can_id)
+        if emulator is None:
+            return
+        for resp in emulator.feed(data):
+            self._schedule(can_id + 1, resp, emulator.latency)
+
+    def _handle_admin(self, data: bytes) -> None:
+        if not data:
+            return
+        cmd = data[0]
+        if cmd == CANBUS_CMD_QUERY_UNASSIGNED:
+            assigned = set(self.node_ids.values())
+            for emu in self.emulators:
+                if emu in assigned:
+                    continue
+                resp = bytes([CANBUS_RESP_NEED_NODEID])
+                resp += emu.uuid.to_bytes(6, "big")
+                resp += bytes([CANBUS_CMD_SET_NODEID])
+                self._schedule(CANBUS_ID_ADMIN_RESP, resp, emu.latency)
+        elif cmd == CANBUS_CMD_SET_NODEID and len(data) >= 8:
+            uuid = int.from_bytes(data[1:7], "big")
+            for emu in self.emulators:
+                if emu.uuid == uuid:
+                    self._clear_node(emu)
+                    emu.reset()
+                    self.node_ids[data[7] * 2 + 0x100] = emu
+        elif cmd == CANBUS_CMD_CLEAR_NODE_ID:
+            self.node_ids.clear()
+
+    def _clear_node(self, emulator: KatapultEmulator) -> None:
+        for can_id, emu in list(self.node_ids.items()):
+            if emu is emulator:
+                del self.node_ids[can_id]
+
+    def _schedule(self, can_id: int, payload: bytes, latency: float) -> None:
+        if latency:
+            self._loop.call_later(latency, self._send, can_id, payload)
+        else:
+            self._send(can_id, payload)
+
+    def _send(self, can_id: int, payload: bytes) -> None:
+        for offset in range(0, len(payload), 8):
+            chunk = payload[offset:offset + 8]
+            packet = CAN_STRUCT.pack(can_id, len(chunk), chunk)
+            try:
+                self.cansock.send(packet)
+            except OSError:
+                logging.exception("Emulator CAN write error")
+                return
+
+    def close(self) -> None:
+        self._loop.remove_reader(self.cansock.fileno())
+        self.cansock.close()
+
+async def run_emulator(args: argparse.Namespace) -> None:
+    transports: List[PtyTransport | CanTransport] = []
+    emu_args = dict(
+        block_size=args.block_size, mcu_type=args.mcu, latency=args.latency,
+        loss=args.loss, busy=args.busy
+    )
+    if args.transport == "pty":
+        pty_transport = PtyTransport(KatapultEmulator(**emu_args))
+        transports.append(pty_transport)
+        output_line(f"Katapult emulator listening on {pty_transport.device}")
+    else:
+        emulators = [
+            KatapultEmulator(uuid=int(u, 16), **emu_args)
+            for u in args.uuid.split(",")
+        ]
+        transports.append(CanTransport(args.interface, emulators))
+        output_line(
+            f"Katapult emulator on {args.interface}, UUIDs: {args.uuid}"
+        )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for transport in transports:
+            transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Katapult Bootloader Emulator")
+    parser.add_argument(
+        "transport", choices=["pty", "can"],
+        help="Transport to present the emulator on"
+    )
+    parser.add_argument(
+        "-i", "--interface", default="vcan0", metavar='<can interface>',
+        help="Can Interface"
+    )
+    parser.add_argument(
+        "-u", "--uuid", default="0123456789ab", metavar="<uuid>",
+        help="Comma separated UUIDs of the emulated CAN nodes"
+    )
+    parser.add_argument(
+        "-s", "--block-size", default=64, type=int, metavar="<bytes>",
+        help="Block size reported by the bootloader"
+    )
+    parser.add_argument(
+        "-m", "--mcu", default="stm32f103xe", metavar="<mcu>",
+        help="MCU type reported by the bootloader"
+    )
+    parser.add_argument(
+        "-l", "--latency", default=0., type=float, metavar="<seconds>",
+        help="Delay applied to each response"
+    )
+    parser.add_argument(
+        "--loss", default=0., type=float, metavar="<probability>",
+        help="Probability of dropping a request"
+    )
+    parser.add_argument(
+        "--busy", default=0., type=float, metavar="<probability>",
+        help="Probability of answering a request with a busy response"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run_emulator(args))
+    except KeyboardInterrupt:
+        pass
@@ -6,10 +6,40 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
+import json
+import logging
+import math
+import os
+import time
 from operator import neg
 
 from . import probe
 
+# Two-sided 95% Student's t values, indexed by degrees of freedom - 1
+T_VALUES_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]
+# Samples needed before a sequential run may stop, as the highest and
+# lowest are discarded from the result
+MIN_SEQUENTIAL_SAMPLES = 3
+
+
+def calc_confidence_interval(z_positions):
+    # Returns the standard deviation of the samples and the half width of
+    # the 95% confidence interval of their mean
+    count = len(z_positions)
+    if count < 2:
+        return None, None
+    mean = sum(z_positions) / count
+    variance = sum((z - mean) ** 2 for z in z_positions) / (count - 1)
+    stddev = math.sqrt(variance)
+    t_value = 1.960
+    if count - 1 <= len(T_VALUES_95):
+        t_value = T_VALUES_95[count - 2]
+    return stddev, t_value * stddev / math.sqrt(count)
+
 
 class AutoZOffsetCommandHelper(probe.ProbeCommandHelper):
     def __init__(self, config, mcu_probe, query_endstop=None):
@@ -21,7 +51,39 @@ class AutoZOffsetCommandHelper(probe.ProbeCommandHelper):
         self.z_offset = config.getfloat("z_offset", -0.1)
         self.probe_hop = config.getfloat("probe_hop", 5.0, minval=4.0)
         self.offset_samples = config.getint("offset_samples", 3, minval=1)
+        cmodes = {"home_each": "home_each", "single_home": "single_home"}
+        self.calibrate_mode = config.getchoice(
+            "calibrate_mode", cmodes, "home_each"
+        )
         self.calibrated_z_offset = config.getfloat("calibrated_z_offset", 0.0)
+        # Temperatures calibrated_z_offset was set at, unknown until it is
+        # set again after a restart
+        self.calibrated_temps = None
+        # Calibration history, used by AUTO_Z_CALIBRATE CACHED=1
+        config_dir = os.path.dirname(
+            self.printer.get_start_args()["config_file"]
+        )
+        self.history_file = os.path.expanduser(
+            config.get(
+                "history_file",
+                os.path.join(config_dir, "auto_z_offset_history.json"),
+            )
+        )
+        self.history_size = config.getint("history_size", 200, minval=1)
+        self.chamber_sensor = config.get("chamber_sensor", "heater_generic chamber")
+        self.cache_max_age = config.getfloat("cache_max_age", 3600.0, minval=0.0)
+        self.cache_bed_tolerance = config.getfloat(
+            "cache_bed_tolerance", 2.0, minval=0.0
+        )
+        self.cache_extruder_tolerance = config.getfloat(
+            "cache_extruder_tolerance", 5.0, minval=0.0
+        )
+        self.cache_chamber_tolerance = config.getfloat(
+            "cache_chamber_tolerance", 3.0, minval=0.0
+        )
+        self.thermal_model = None
+        if config.getboolean("thermal_compensation", False):
+            self.thermal_model = AutoZOffsetThermalModel(config, self)
         self.last_state = False
         self.last_z_result = 0.0
         self.last_probe_position = gcode.Coord((0., 0., 0.))
@@ -69,6 +131,19 @@ class AutoZOffsetCommandHelper(probe.ProbeCommandHelper):
             curpos[2] = self.probe_hop
         self._move(curpos, params["lift_speed"])
 
+    def _move_to_travel_height(self, gcmd, x, y):
+        # Rise to probe_hop above the homed bed contact, then move in XY
+        toolhead = self.printer.lookup_object("toolhead")
+        params = self.mcu_probe.get_probe_params(gcmd)
+        curpos = toolhead.get_position()
+        travel_z = self.z_offset + self.probe_hop
+        if curpos[2] < travel_z:
+            curpos[2] = travel_z
+            self._move(curpos, params["lift_speed"])
+        curpos[0] = x
+        curpos[1] = y
+        self._move(curpos, params["lift_speed"])
+
     def lift_probe(self, gcmd):
         toolhead = self.printer.lookup_object("toolhead")
         params = self.mcu_probe.get_probe_params(gcmd)
@@ -125,17 +200,106 @@ class AutoZOffsetCommandHelper(probe.ProbeCommandHelper):
         self.lift_probe(gcmd)
         return pos[2]
 
-    cmd_AUTO_Z_CALIBRATE_help = (
-        "Set the Z-Offset by averaging multiple runs of AUTO_Z_MEASURE_OFFSET"
-    )
-
-    def cmd_AUTO_Z_CALIBRATE(self, gcmd):
-        # Get average measured offset over self.offset_samples number of tests
-        offset_total = 0.0
-        for _ in range(self.offset_samples):
-            offset_total += self.cmd_AUTO_Z_MEASURE_OFFSET(gcmd)
-        self.calibrated_z_offset = neg(offset_total / self.offset_samples)
-
+    def _measure_offsets_single_home(self, gcmd):
+        # Home Z once, then alternate bed sensor and probe samples from a
+        # single travel height. Each probe result is taken relative to the
+        # bed contact measured just before it, which is the value
+        # AUTO_Z_MEASURE_OFFSET reports after homing Z again.
+        self.cmd_AUTO_Z_HOME_Z(gcmd)
+        main_probe = self.printer.lookup_object("probe")
+        probe_x = 120 - main_probe.probe_offsets.x_offset
+        probe_y = 120 - main_probe.probe_offsets.y_offset
+        contact_z = self.z_offset
+        offsets = []
+        for i in range(self.offset_samples):
+            if i:
+                self._move_to_travel_height(gcmd, 120, 120)
+                pos = probe.run_single_probe(self.mcu_probe, gcmd)
+                contact_z = pos[2]
+                gcmd.respond_info(
+                    "%s: bed sensor measured offset: z=%.6f"
+                    % (self.name, neg(contact_z) + self.z_offset)
+                )
+            self._move_to_travel_height(gcmd, probe_x, probe_y)
+            pos = probe.run_single_probe(main_probe, gcmd)
+            offset = pos[2] - (contact_z - self.z_offset)
+            gcmd.respond_info(
+                "%s: probe measured offset: z=%.6f" % (self.name, offset)
+            )
+            offsets.append(offset)
+        self._move_to_travel_height(gcmd, probe_x, probe_y)
+        return offsets
+
+    def _get_temperatures(self):
+        # Current bed, extruder and chamber temperatures, None for a
+        # missing heater or sensor
+        eventtime = self.printer.get_reactor().monotonic()
+        temps = {}
+        for key, name in (
+            ("bed", "heater_bed"),
+            ("extruder", "extruder"),
+            ("chamber", self.chamber_sensor),
+        ):
+            obj = self.printer.lookup_object(name, None)
+            if obj is None:
+                temps[key] = None
+                continue
+            temps[key] = round(obj.get_status(eventtime)["temperature"], 2)
+        return temps
+
+    def load_history(self):
+        try:
+            with open(self.history_file, "r") as f:
+                history = json.load(f)
+        except (IOError, ValueError):
+            return []
+        if not isinstance(history, list):
+            return []
+        return history
+
+    def _save_history(self, history):
+        history = history[-self.history_size:]
+        tmp_file = self.history_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(history, f, separators=(",", ":"))
+            os.rename(tmp_file, self.history_file)
+        except IOError:
+            logging.exception("auto_z_offset: unable to save history")
+
+    def _find_cached(self, temps, nozzle):
+        # The most recent calibration with the same nozzle taken at
+        # temperatures within tolerance
+        tolerances = {
+            "bed": self.cache_bed_tolerance,
+            "extruder": self.cache_extruder_tolerance,
+            "chamber": self.cache_chamber_tolerance,
+        }
+        now = time.time()
+        for entry in reversed(self.load_history()):
+            if now - entry.get("time", 0.0) > self.cache_max_age:
+                break
+            if entry.get("nozzle", "") != nozzle:
+                continue
+            for key, tolerance in tolerances.items():
+                cur = temps[key]
+                prev = entry.get(key)
+                if cur is None or prev is None:
+                    if cur != prev:
+                        break
+                elif abs(cur - prev) > tolerance:
+                    break
+            else:
+                return entry
+        return None
+
+    def _set_calibrated_offset(self, gcmd, offset, temps):
+        if self.thermal_model is not None:
+            # The new offset is measured at the given temperatures, the
+            # next AUTO_Z_LOAD_OFFSET starts tracking from it
+            self.thermal_model.stop_tracking()
+        self.calibrated_z_offset = offset
+        self.calibrated_temps = temps
         # Apply calibrated offset and save to config
         self.gcode.run_script_from_command(
             "SET_GCODE_OFFSET Z=%f MOVE=0" % self.calibrated_z_offset
@@ -151,16 +315,72 @@ class AutoZOffsetCommandHelper(probe.ProbeCommandHelper):
             % (self.name, self.calibrated_z_offset)
         )
 
+    cmd_AUTO_Z_CALIBRATE_help = (
+        "Set the Z-Offset by averaging offset_samples measurements, either "
+        "homing Z for each (MODE=home_each) or alternating bed sensor and "
+        "probe samples after a single home (MODE=single_home)"
+    )
+
+    def cmd_AUTO_Z_CALIBRATE(self, gcmd):
+        temps = self._get_temperatures()
+        nozzle = gcmd.get("NOZZLE", "")
+        if gcmd.get_int("CACHED", 0, minval=0, maxval=1):
+            entry = self._find_cached(temps, nozzle)
+            if entry is not None:
+                gcmd.respond_info(
+                    "%s: reusing calibration from %d seconds ago"
+                    % (self.name, time.time() - entry["time"])
+                )
+                self._set_calibrated_offset(gcmd, entry["offset"], entry)
+                return
+            gcmd.respond_info(
+                "%s: no calibration matches the current conditions" % (self.name,)
+            )
+        # Get average measured offset over self.offset_samples number of tests
+        mode = gcmd.get("MODE", self.calibrate_mode).lower()
+        if mode == "single_home":
+            offsets = self._measure_offsets_single_home(gcmd)
+        elif mode == "home_each":
+            offsets = [
+                self.cmd_AUTO_Z_MEASURE_OFFSET(gcmd)
+                for _ in range(self.offset_samples)
+            ]
+        else:
+            raise gcmd.error("Unknown calibrate mode '%s'" % (mode,))
+        offset = neg(sum(offsets) / len(offsets))
+        entry = dict(temps)
+        entry.update({
+            "time": round(time.time(), 1),
+            "nozzle": nozzle,
+            "offset": round(offset, 6),
+            "samples": [round(o, 6) for o in offsets],
+            "spread": round(max(offsets) - min(offsets), 6),
+        })
+        history = self.load_history()
+        history.append(entry)
+        self._save_history(history)
+        self._set_calibrated_offset(gcmd, offset, temps)
+        if self.thermal_model is not None:
+            self.thermal_model.fit()
+
     cmd_AUTO_Z_LOAD_OFFSET_help = (
         "Apply the calibrated_z_offset saved in the config file"
     )
 
     def cmd_AUTO_Z_LOAD_OFFSET(self, gcmd):
+        offset = self.calibrated_z_offset
+        if self.thermal_model is not None:
+            predicted = self.thermal_model.start_tracking()
+            if predicted is not None:
+                gcmd.respond_info(
+                    "%s: thermal model offset: %.6f" % (self.name, predicted)
+                )
+                offset = predicted
         gcmd.respond_info(
             "%s: calibrated_z_offset: %.6f" % (self.name, self.calibrated_z_offset)
         )
         self.gcode.run_script_from_command(
-            "SET_GCODE_OFFSET Z=%f MOVE=0" % self.calibrated_z_offset
+            "SET_GCODE_OFFSET Z=%f MOVE=0" % offset
         )
 
     cmd_AUTO_Z_SAVE_GCODE_OFFSET_help = (
@@ -169,7 +389,11 @@ class AutoZOffsetCommandHelper(probe.ProbeCommandHelper):
 
     def cmd_AUTO_Z_SAVE_GCODE_OFFSET(self, gcmd):
         gcode_move = self.printer.lookup_object("gcode_move")
+        if self.thermal_model is not None:
+            # The saved offset already includes any thermal adjustment
+            self.thermal_model.stop_tracking()
         self.calibrated_z_offset = gcode_move.homing_position[2]
+        self.calibrated_temps = self._get_temperatures()
         configfile = self.printer.lookup_object("configfile")
         configfile.set(
             self.name, "calibrated_z_offset", "%.6f" % self.calibrated_z_offset
@@ -182,6 +406,208 @@ class AutoZOffsetCommandHelper(probe.ProbeCommandHelper):
         )
 
 
+# Predicts how the offset changes with the bed, extruder and chamber
+# temperatures with a linear least squares fit over the calibration
+# history, and applies that change to calibrated_z_offset during a print
+class AutoZOffsetThermalModel:
+    def __init__(self, config, cmd_helper):
+        self.printer = config.get_printer()
+        self.cmd_helper = cmd_helper
+        try:
+            import numpy
+        except ImportError:
+            raise config.error(
+                "auto_z_offset thermal_compensation requires numpy"
+            )
+        self.numpy = numpy
+        self.min_samples = config.getint("thermal_min_samples", 6, minval=3)
+        self.update_interval = config.getfloat(
+            "thermal_update_interval", 10.0, minval=1.0
+        )
+        self.max_step = config.getfloat("thermal_max_step", 0.005, above=0.0)
+        self.deadband = config.getfloat("thermal_deadband", 0.002, minval=0.0)
+        self.model = None
+        self.applied_offset = None
+        self.tracking = False
+        self.was_printing = False
+        self.print_stats = None
+        self.update_timer = None
+        self.reactor = self.printer.get_reactor()
+        self.gcode = self.printer.lookup_object("gcode")
+        self.gcode.register_command(
+            "AUTO_Z_THERMAL_MODEL",
+            self.cmd_AUTO_Z_THERMAL_MODEL,
+            desc=self.cmd_AUTO_Z_THERMAL_MODEL_help,
+        )
+        self.printer.register_event_handler("klippy:ready", self._handle_ready)
+
+    def _handle_ready(self):
+        self.print_stats = self.printer.lookup_object("print_stats", None)
+        self.fit()
+
+    def fit(self):
+        np = self.numpy
+        history = [
+            e for e in self.cmd_helper.load_history()
+            if e.get("bed") is not None and e.get("extruder") is not None
+        ]
+        # Only the calibrations of the current nozzle are comparable
+        if history:
+            nozzle = history[-1].get("nozzle", "")
+            history = [e for e in history if e.get("nozzle", "") == nozzle]
+        self.model = None
+        if len(history) < self.min_samples:
+            return
+        features = ["bed", "extruder"]
+        if all(e.get("chamber") is not None for e in history):
+            features.append("chamber")
+        temps = np.array([[e[f] for f in features] for e in history], dtype=float)
+        offsets = np.array([e["offset"] for e in history], dtype=float)
+        # A temperature that did not vary has no measurable effect
+        varied = [i for i in range(len(features)) if np.ptp(temps[:, i]) >= 1.0]
+        if not varied:
+            return
+        features = [features[i] for i in varied]
+        temps = temps[:, varied]
+        matrix = np.column_stack([np.ones(len(offsets)), temps])
+        coeffs, _, rank, _ = np.linalg.lstsq(matrix, offsets, rcond=None)
+        if rank < matrix.shape[1]:
+            return
+        residuals = matrix.dot(coeffs) - offsets
+        self.model = {
+            "features": features,
+            "coefficients": [float(c) for c in coeffs],
+            "low": [float(t) for t in temps.min(axis=0)],
+            "high": [float(t) for t in temps.max(axis=0)],
+            # Temperatures of the last calibration, used when those of
+            # calibrated_z_offset are not known
+            "reference": [float(t) for t in temps[-1]],
+            "samples": len(offsets),
+            "rms": float(np.sqrt(np.mean(residuals ** 2))),
+        }
+
+    def _reference_temps(self):
+        # The temperatures calibrated_z_offset was set at, those of the
+        # last calibration if they are not known
+        reference = self.cmd_helper.calibrated_temps
+        if reference is None:
+            return list(self.model["reference"])
+        return [reference.get(feature) for feature in self.model["features"]]
+
+    def predict(self, temps):
+        # calibrated_z_offset corrected by the change the model predicts
+        # between its temperatures and the given ones, so that adjustments
+        # saved with AUTO_Z_SAVE_GCODE_OFFSET are kept
+        if self.model is None:
+            return None
+        model = self.model
+        offset = self.cmd_helper.calibrated_z_offset
+        for feature, coeff, low, high, ref_temp in zip(
+            model["features"], model["coefficients"][1:], model["low"],
+            model["high"], self._reference_temps()
+        ):
+            temp = temps.get(feature)
+            if temp is None or ref_temp is None:
+                return None
+            # Never extrapolate beyond the calibrated temperatures
+            offset += coeff * (
+                min(max(temp, low), high) - min(max(ref_temp, low), high)
+            )
+        return offset
+
+    def start_tracking(self):
+        offset = self.predict(self.cmd_helper._get_temperatures())
+        if offset is None:
+            self.stop_tracking()
+            return None
+        self.applied_offset = offset
+        self.tracking = True
+        self.was_printing = False
+        if self.update_timer is None:
+            self.update_timer = self.reactor.register_timer(
+                self._update_event, self.reactor.monotonic() + self.update_interval
+            )
+        return offset
+
+    def stop_tracking(self):
+        self.tracking = False
+        self.applied_offset = None
+        if self.update_timer is not None:
+            self.reactor.unregister_timer(self.update_timer)
+            self.update_timer = None
+
+    def _update_event(self, eventtime):
+        state = "printing"
+        if self.print_stats is not None:
+            state = self.print_stats.get_status(eventtime)["state"]
+        if state == "printing":
+            self.was_printing = True
+            self._update_offset()
+        elif state != "paused" and self.was_printing:
+            # The print ended, the next one starts with AUTO_Z_LOAD_OFFSET
+            self.stop_tracking()
+        if not self.tracking:
+            return self.reactor.NEVER
+        return eventtime + self.update_interval
+
+    def _update_offset(self):
+        # Move towards the predicted offset by at most max_step per
+        # update, keeping any manual adjustments made during the print
+        offset = self.predict(self.cmd_helper._get_temperatures())
+        if offset is None:
+            return
+        diff = offset - self.applied_offset
+        if abs(diff) < self.deadband:
+            return
+        step = max(-self.max_step, min(self.max_step, diff))
+        try:
+            self.gcode.run_script("SET_GCODE_OFFSET Z_ADJUST=%f MOVE=0" % step)
+        except self.printer.command_error:
+            logging.exception("auto_z_offset: thermal offset update failed")
+            self.stop_tracking()
+            return
+        self.applied_offset += step
+
+    def get_status(self, eventtime):
+        return {
+            "thermal_model": self.model,
+            "thermal_offset": self.applied_offset if self.tracking else None,
+        }
+
+    cmd_AUTO_Z_THERMAL_MODEL_help = (
+        "Fit and report the thermal Z-Offset model"
+    )
+
+    def cmd_AUTO_Z_THERMAL_MODEL(self, gcmd):
+        self.fit()
+        if self.model is None:
+            gcmd.respond_info(
+                "auto_z_offset: at least %d calibrations at different "
+                "temperatures are needed for the thermal model"
+                % (self.min_samples,)
+            )
+            return
+        model = self.model
+        terms = ["calibrated_z_offset"]
+        for feature, coeff, ref_temp in zip(
+            model["features"], model["coefficients"][1:], self._reference_temps()
+        ):
+            if ref_temp is None:
+                terms.append("%.6f * (%s - ?)" % (coeff, feature))
+            else:
+                terms.append("%.6f * (%s - %.1f)" % (coeff, feature, ref_temp))
+        temps = self.cmd_helper._get_temperatures()
+        predicted = self.predict(temps)
+        msg = (
+            "auto_z_offset: offset = %s\n"
+            "fitted to %d calibrations, rms error %.6f"
+            % (" + ".join(terms), model["samples"], model["rms"])
+        )
+        if predicted is not None:
+            msg += "\npredicted offset now: %.6f" % (predicted,)
+        gcmd.respond_info(msg)
+
+
 # Homing via auto_z_offset:z_virtual_endstop
 class HomingViaAutoZHelper(probe.HomingViaProbeHelper):
     def __init__(self, config, mcu_probe, param_helper):
@@ -264,6 +690,31 @@ class AutoZOffsetParameterHelper(probe.ProbeParameterHelper):
         self.samples_result = config.getchoice("samples_result", atypes, "average")
         self.samples_tolerance = config.getfloat("samples_tolerance", 0.100, minval=0.0)
         self.samples_retries = config.getint("samples_tolerance_retries", 0, minval=0)
+        tactions = {"restart": "restart", "reject": "reject"}
+        self.samples_tolerance_action = config.getchoice(
+            "samples_tolerance_action", tactions, "restart"
+        )
+        # Sequential sampling, stops once the result is known to within
+        # samples_confidence (disabled when 0)
+        self.samples_confidence = config.getfloat(
+            "samples_confidence", 0.0, minval=0.0
+        )
+        self.samples_max = config.getint(
+            "samples_max", 2 * self.sample_count, minval=self.sample_count
+        )
+
+    def get_probe_params(self, gcmd=None):
+        params = probe.ProbeParameterHelper.get_probe_params(self, gcmd)
+        if gcmd is None:
+            gcmd = self.dummy_gcode_cmd
+        params["samples_confidence"] = gcmd.get_float(
+            "SAMPLES_CONFIDENCE", self.samples_confidence, minval=0.0
+        )
+        params["samples_max"] = gcmd.get_int(
+            "SAMPLES_MAX", self.samples_max, minval=1
+        )
+        params["samples_tolerance_action"] = self.samples_tolerance_action
+        return params
 
 
 class AutoZOffsetSessionHelper(probe.ProbeSessionHelper):
@@ -274,11 +725,36 @@ class AutoZOffsetSessionHelper(probe.ProbeSessionHelper):
         # Session state
         self.hw_probe_session = None
         self.results = []
+        # Statistics of the last probe
+        self.last_sample_count = 0
+        self.last_sample_stddev = None
+        self.last_confidence_interval = None
+        self.last_rejected_samples = []
         # Register event handlers
         self.printer.register_event_handler(
             "gcode:command_error", self._handle_command_error
         )
 
+    def _reject_outliers(self, positions, tolerance):
+        # Keep the samples within half the tolerance of the median, so the
+        # remaining spread is within tolerance. Two samples give no
+        # consensus, neither is rejected until another is taken.
+        if len(positions) < 3:
+            return positions, []
+        z_sorted = sorted(p[2] for p in positions)
+        middle = len(z_sorted) // 2
+        median = z_sorted[middle]
+        if not len(z_sorted) & 1:
+            median = (z_sorted[middle - 1] + median) / 2.0
+        kept = []
+        rejected = []
+        for p in positions:
+            if abs(p[2] - median) > tolerance / 2.0:
+                rejected.append(p)
+            else:
+                kept.append(p)
+        return kept, rejected
+
     def run_probe(self, gcmd):
         if self.hw_probe_session is None:
             self._probe_state_error()
@@ -288,24 +764,73 @@ class AutoZOffsetSessionHelper(probe.ProbeSessionHelper):
         retries = 0
         positions = []
         sample_count = params["samples"]
-        while len(positions) < sample_count:
+        # With a confidence target, sampling stops as soon as the target
+        # is met once sample_count samples are in, and continues up to
+        # samples_max while it is not
+        target = params["samples_confidence"]
+        min_count = max(sample_count, MIN_SEQUENTIAL_SAMPLES)
+        max_count = max(min_count, params["samples_max"])
+        tolerance = params["samples_tolerance"]
+        self.last_rejected_samples = []
+        while True:
             # Probe position
             pos = self._probe(gcmd)
             positions.append(pos)
             # Check samples tolerance
             z_positions = [p[2] for p in positions]
-            if max(z_positions) - min(z_positions) > params["samples_tolerance"]:
-                if retries >= params["samples_tolerance_retries"]:
-                    raise gcmd.error("Probe samples exceed samples_tolerance")
-                gcmd.respond_info("Probe samples exceed tolerance. Retrying...")
-                retries += 1
-                positions = []
+            consistent = True
+            if max(z_positions) - min(z_positions) > tolerance:
+                if params["samples_tolerance_action"] == "reject":
+                    # Drop only the inconsistent samples and top up
+                    positions, rejected = self._reject_outliers(
+                        positions, tolerance
+                    )
+                    for p in rejected:
+                        gcmd.respond_info(
+                            "Probe sample z=%.6f rejected as outlier" % (p[2],)
+                        )
+                        self.last_rejected_samples.append(p[2])
+                    # Top ups have their own budget, samples_tolerance_retries
+                    # only applies to restarts
+                    if len(self.last_rejected_samples) > params["samples_max"]:
+                        raise gcmd.error(
+                            "Probe samples exceed samples_tolerance, %d "
+                            "samples rejected"
+                            % (len(self.last_rejected_samples),)
+                        )
+                    consistent = bool(rejected)
+                else:
+                    if retries >= params["samples_tolerance_retries"]:
+                        raise gcmd.error("Probe samples exceed samples_tolerance")
+                    gcmd.respond_info("Probe samples exceed tolerance. Retrying...")
+                    retries += 1
+                    positions = []
+                z_positions = [p[2] for p in positions]
+            count = len(positions)
+            if not consistent:
+                # Two disagreeing samples, another one decides
+                pass
+            elif target and count >= min_count:
+                _, interval = calc_confidence_interval(z_positions)
+                if interval <= target:
+                    break
+                if count >= max_count:
+                    gcmd.respond_info(
+                        "Probe confidence interval %.6f exceeds target "
+                        "%.6f after %d samples" % (interval, target, count)
+                    )
+                    break
+            elif not target and count >= sample_count:
+                break
             # Retract
-            if len(positions) < sample_count:
-                toolhead.manual_move(
-                    probexy + [pos[2] + params["sample_retract_dist"]],
-                    params["lift_speed"],
-                )
+            toolhead.manual_move(
+                probexy + [pos[2] + params["sample_retract_dist"]],
+                params["lift_speed"],
+            )
+        self.last_sample_count = len(positions)
+        self.last_sample_stddev, self.last_confidence_interval = (
+            calc_confidence_interval([p[2] for p in positions])
+        )
         # Discard highest and lowest values
         positions.remove(max(positions))
         positions.remove(min(positions))
@@ -313,6 +838,14 @@ class AutoZOffsetSessionHelper(probe.ProbeSessionHelper):
         epos = probe.calc_probe_z_average(positions, params["samples_result"])
         self.results.append(epos)
 
+    def get_status(self, eventtime):
+        return {
+            "last_sample_count": self.last_sample_count,
+            "last_sample_stddev": self.last_sample_stddev,
+            "last_confidence_interval": self.last_confidence_interval,
+            "last_rejected_samples": list(self.last_rejected_samples),
+        }
+
 
 class AutoZOffsetOffsetsHelper:
     def __init__(self, config):
@@ -347,7 +880,11 @@ class AutoZOffsetProbe:
         return self.probe_offsets.get_offsets()
 
     def get_status(self, eventtime):
-        return self.cmd_helper.get_status(eventtime)
+        status = self.cmd_helper.get_status(eventtime)
+        status.update(self.probe_session.get_status(eventtime))
+        if self.cmd_helper.thermal_model is not None:
+            status.update(self.cmd_helper.thermal_model.get_status(eventtime))
+        return status
 
     def start_probe_session(self, gcmd):
         return self.probe_session.start_probe_session(gcmd)
@@ -0,0 +1,11 @@
+import os
+import sys
+import pathlib
+import tempfile
+
+REPO_DIR = pathlib.Path(__file__).parent.parent
+sys.path.insert(0, str(REPO_DIR.joinpath("helpers")))
+sys.path.insert(0, str(REPO_DIR.joinpath("tests")))
+
+# flashtool keeps its caches below ~/.cache, resolved at import
+os.environ["HOME"] = tempfile.mkdtemp(prefix="freedi-tests-")
@@ -0,0 +1,83 @@
+# In-memory transport between CanFlasher and a KatapultEmulator
+import asyncio
+import pathlib
+import random
+from typing import Optional
+
+import flashtool
+from katapult_emulator import KatapultEmulator
+
+
+class EmulatorNode:
+    """
+    Stands in for a CanNode, feeding written commands to the emulator
+    and delivering its responses after the emulator latency.
+    """
+    def __init__(self, emulator: KatapultEmulator) -> None:
+        self.emulator = emulator
+        self._loop = asyncio.get_running_loop()
+        self._reader = asyncio.StreamReader()
+
+    def write(self, payload) -> None:
+        for resp in self.emulator.feed(bytes(payload)):
+            if self.emulator.latency:
+                self._loop.call_later(
+                    self.emulator.latency, self._reader.feed_data, resp
+                )
+            else:
+                self._loop.call_soon(self._reader.feed_data, resp)
+
+    async def drain(self) -> None:
+        pass
+
+    async def read(self, n: int = -1, timeout: Optional[float] = 2.) -> bytes:
+        return await asyncio.wait_for(self._reader.read(n), timeout)
+
+    async def readexactly(self, n: int, timeout: Optional[float] = 2.) -> bytes:
+        return await asyncio.wait_for(self._reader.readexactly(n), timeout)
+
+    async def readuntil(
+        self, sep: bytes = b"\x03", timeout: Optional[float] = 2.
+    ) -> bytes:
+        return await asyncio.wait_for(self._reader.readuntil(sep), timeout)
+
+
+def make_image(path: pathlib.Path, size: int, seed: int = 0) -> bytearray:
+    rand = random.Random(seed)
+    data = bytearray(rand.getrandbits(8) for _ in range(size))
+    path.write_bytes(data)
+    return data
+
+
+def flashed_image(emulator: KatapultEmulator, size: int) -> bytes:
+    # The application area of the emulated flash, erased bytes read 0xFF
+    block_size = emulator.block_size
+    out = bytearray()
+    for offset in range(0, size, block_size):
+        addr = emulator.app_start + offset
+        out += emulator.flash.get(addr, b"\xFF" * block_size)
+    return bytes(out[:size])
+
+
+async def flash(
+    emulator: KatapultEmulator,
+    fw_path: pathlib.Path,
+    window: int = 1,
+    diff: bool = False,
+    device_id: Optional[str] = None
+) -> flashtool.CanFlasher:
+    """
+    Runs a complete flash session like SerialSocket.run, including the
+    COMPLETE request of the finally clause.
+    """
+    node = EmulatorNode(emulator)
+    flasher = flashtool.CanFlasher(
+        node, fw_path, window, diff, device_id, progress=lambda e: None
+    )
+    try:
+        await flasher.connect_btl()
+        await flasher.send_file()
+        await flasher.verify_file()
+    finally:
+        await flasher.finish()
+    return flasher
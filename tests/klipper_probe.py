@@ -0,0 +1,194 @@
+# Loads the auto_z_offset extra outside of Klipper, with the parts of
+# Klipper's extras/probe.py it builds on
+import importlib
+import pathlib
+import sys
+import types
+
+MODULE_DIR = pathlib.Path(__file__).parent.parent.joinpath(
+    "klipper_module", "qidi_auto_z_offset"
+)
+
+
+class ProbeCommandHelper:
+    pass
+
+
+class ProbeParameterHelper:
+    pass
+
+
+class ProbeSessionHelper:
+    def _handle_command_error(self):
+        pass
+
+
+class HomingViaProbeHelper:
+    pass
+
+
+def calc_probe_z_average(positions, method="average"):
+    if method != "median":
+        count = float(len(positions))
+        return [sum([pos[i] for pos in positions]) / count for i in range(3)]
+    z_sorted = sorted(positions, key=(lambda p: p[2]))
+    middle = len(positions) // 2
+    if (len(positions) & 1) == 1:
+        return z_sorted[middle]
+    return calc_probe_z_average(z_sorted[middle - 1:middle + 1], "average")
+
+
+def load_auto_z_offset():
+    if "extras.auto_z_offset" not in sys.modules:
+        extras = types.ModuleType("extras")
+        extras.__path__ = [str(MODULE_DIR)]
+        sys.modules["extras"] = extras
+        sys.modules["extras.probe"] = sys.modules[__name__]
+        extras.probe = sys.modules[__name__]
+    return importlib.import_module("extras.auto_z_offset")
+
+
+class GCodeError(Exception):
+    pass
+
+
+class FakeGCodeCommand:
+    def __init__(self):
+        self.messages = []
+
+    def respond_info(self, msg):
+        self.messages.append(msg)
+
+    def error(self, msg):
+        return GCodeError(msg)
+
+
+class FakeToolhead:
+    def __init__(self):
+        self.moves = 0
+
+    def get_position(self):
+        return [120.0, 120.0, 5.0, 0.0]
+
+    def manual_move(self, coord, speed):
+        self.moves += 1
+
+
+class FakeGCode:
+    def __init__(self):
+        self.scripts = []
+
+    def register_command(self, cmd, func, desc=None):
+        pass
+
+    def run_script(self, script):
+        self.scripts.append(script)
+
+
+class FakeReactor:
+    NEVER = 9999999999999999.
+
+    def monotonic(self):
+        return 0.
+
+    def register_timer(self, callback, waketime):
+        return callback
+
+    def unregister_timer(self, timer):
+        pass
+
+
+class FakePrinter:
+    def __init__(self):
+        self.toolhead = FakeToolhead()
+        self.gcode = FakeGCode()
+        self.reactor = FakeReactor()
+
+    def lookup_object(self, name, default=None):
+        if name == "gcode":
+            return self.gcode
+        return self.toolhead
+
+    def get_reactor(self):
+        return self.reactor
+
+    def register_event_handler(self, event, callback):
+        pass
+
+
+class FakeConfig:
+    error = Exception
+
+    def __init__(self):
+        self.printer = FakePrinter()
+
+    def get_printer(self):
+        return self.printer
+
+    def getint(self, option, default, **kwargs):
+        return default
+
+    def getfloat(self, option, default, **kwargs):
+        return default
+
+
+class FakeParamHelper:
+    def __init__(self, **params):
+        self.params = {
+            "samples": 5,
+            "samples_max": 10,
+            "samples_confidence": 0.0,
+            "samples_tolerance": 0.1,
+            "samples_tolerance_retries": 0,
+            "samples_tolerance_action": "restart",
+            "samples_result": "average",
+            "sample_retract_dist": 2.0,
+            "lift_speed": 5.0,
+        }
+        self.params.update(params)
+
+    def get_probe_params(self, gcmd=None):
+        return dict(self.params)
+
+
+def make_session(module, heights, **params):
+    """
+    Returns a probe session helper whose probe reports the given
+    heights in turn.
+    """
+    class ScriptedSession(module.AutoZOffsetSessionHelper):
+        def _probe(self, gcmd):
+            self.probe_calls += 1
+            return [120.0, 120.0, next(self.heights)]
+
+    session = ScriptedSession(
+        FakeConfig(), FakeParamHelper(**params), lambda gcmd: None
+    )
+    session.heights = iter(heights)
+    session.probe_calls = 0
+    session.hw_probe_session = object()
+    return session
+
+
+class FakeCommandHelper:
+    """
+    The calibration state the thermal model reads from the command
+    helper, with the current temperatures set by the test.
+    """
+    def __init__(self, history, calibrated_z_offset, calibrated_temps=None):
+        self.history = history
+        self.calibrated_z_offset = calibrated_z_offset
+        self.calibrated_temps = calibrated_temps
+        self.temps = {"bed": None, "extruder": None, "chamber": None}
+
+    def load_history(self):
+        return list(self.history)
+
+    def _get_temperatures(self):
+        return dict(self.temps)
+
+
+def make_thermal_model(module, cmd_helper):
+    model = module.AutoZOffsetThermalModel(FakeConfig(), cmd_helper)
+    model.fit()
+    return model
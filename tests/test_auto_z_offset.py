@@ -0,0 +1,136 @@
+import math
+
+import pytest
+
+from klipper_probe import (
+    FakeCommandHelper, FakeGCodeCommand, GCodeError, load_auto_z_offset,
+    make_session, make_thermal_model
+)
+
+auto_z_offset = load_auto_z_offset()
+
+
+def test_confidence_interval_of_known_samples():
+    assert auto_z_offset.calc_confidence_interval([1.0]) == (None, None)
+    stddev, interval = auto_z_offset.calc_confidence_interval([0., .02, .04])
+    assert stddev == pytest.approx(.02)
+    assert interval == pytest.approx(4.303 * .02 / math.sqrt(3))
+    # Past the table the normal distribution is used
+    heights = [.01 * (i % 2) for i in range(40)]
+    stddev, interval = auto_z_offset.calc_confidence_interval(heights)
+    assert interval == pytest.approx(1.960 * stddev / math.sqrt(40))
+
+
+def test_sequential_probe_takes_at_least_samples():
+    session = make_session(
+        auto_z_offset, [2.0] * 10, samples=5, samples_confidence=.01
+    )
+    session.run_probe(FakeGCodeCommand())
+    # The target is met from the third sample, samples is the floor
+    assert session.probe_calls == 5
+    assert session.last_sample_count == 5
+    assert session.results == [[120.0, 120.0, 2.0]]
+
+
+def test_sequential_probe_never_stops_before_three_samples():
+    session = make_session(
+        auto_z_offset, [2.0] * 10, samples=1, samples_confidence=.01
+    )
+    session.run_probe(FakeGCodeCommand())
+    assert session.probe_calls == auto_z_offset.MIN_SEQUENTIAL_SAMPLES
+
+
+def test_sequential_probe_stops_once_target_is_met():
+    heights = [2.0, 2.04, 1.96, 2.0, 2.0, 2.0, 2.0, 2.0, 2.0, 2.0]
+    session = make_session(
+        auto_z_offset, heights, samples=3, samples_max=10,
+        samples_confidence=.03
+    )
+    session.run_probe(FakeGCodeCommand())
+    count = session.probe_calls
+    assert 3 < count < 10
+    _, interval = auto_z_offset.calc_confidence_interval(heights[:count])
+    _, previous = auto_z_offset.calc_confidence_interval(heights[:count - 1])
+    assert interval <= .03 < previous
+    assert session.last_confidence_interval == pytest.approx(interval)
+
+
+def test_sequential_probe_gives_up_at_samples_max():
+    heights = [2.0, 2.04] * 10
+    session = make_session(
+        auto_z_offset, heights, samples=3, samples_max=8,
+        samples_confidence=.001
+    )
+    gcmd = FakeGCodeCommand()
+    session.run_probe(gcmd)
+    assert session.probe_calls == 8
+    assert "exceeds target" in gcmd.messages[-1]
+    assert session.last_sample_count == 8
+
+
+def test_reject_mode_tops_up_without_retries():
+    heights = [2.0, 2.01, 2.5, 2.0, 1.99, 2.01]
+    session = make_session(
+        auto_z_offset, heights, samples=5, samples_tolerance_action="reject"
+    )
+    session.run_probe(FakeGCodeCommand())
+    assert session.probe_calls == 6
+    assert session.last_sample_count == 5
+    status = session.get_status(0.)
+    assert status["last_rejected_samples"] == [2.5]
+    assert status["last_rejected_samples"] is not session.last_rejected_samples
+
+
+def test_reject_mode_fails_past_samples_max():
+    heights = [2.0, 2.01, 2.0] + [2.5] * 10
+    session = make_session(
+        auto_z_offset, heights, samples=5, samples_max=4,
+        samples_tolerance_action="reject"
+    )
+    with pytest.raises(GCodeError, match="5 samples rejected"):
+        session.run_probe(FakeGCodeCommand())
+
+
+def bed_history(beds, offset_per_degree=.001):
+    return [
+        {"bed": bed, "extruder": 220., "chamber": None, "nozzle": "",
+         "offset": .1 + offset_per_degree * (bed - 60.), "time": 0.}
+        for bed in beds
+    ]
+
+
+def test_thermal_model_keeps_saved_offset_adjustments():
+    pytest.importorskip("numpy")
+    # The offset was saved 0.05 higher than calibrated at 60 C
+    helper = FakeCommandHelper(
+        bed_history([55., 60., 65., 70., 80., 90.]), .15,
+        {"bed": 60., "extruder": 220., "chamber": None}
+    )
+    thermal = make_thermal_model(auto_z_offset, helper)
+    assert thermal.model["features"] == ["bed"]
+    helper.temps.update(bed=60., extruder=220.)
+    assert thermal.predict(helper._get_temperatures()) == pytest.approx(.15)
+    helper.temps["bed"] = 80.
+    assert thermal.predict(helper._get_temperatures()) == pytest.approx(.17)
+    # Clamped to the calibrated range
+    helper.temps["bed"] = 120.
+    assert thermal.predict(helper._get_temperatures()) == pytest.approx(.18)
+
+
+def test_thermal_model_defaults_to_last_calibration_temperatures():
+    pytest.importorskip("numpy")
+    helper = FakeCommandHelper(
+        bed_history([55., 60., 65., 70., 80., 90.]), .12
+    )
+    thermal = make_thermal_model(auto_z_offset, helper)
+    helper.temps.update(bed=70., extruder=220.)
+    assert thermal.predict(helper._get_temperatures()) == pytest.approx(.10)
+
+
+def test_thermal_model_needs_a_varied_temperature():
+    pytest.importorskip("numpy")
+    helper = FakeCommandHelper(bed_history([60.] * 8), .1)
+    thermal = make_thermal_model(auto_z_offset, helper)
+    assert thermal.model is None
+    helper.temps.update(bed=60., extruder=220.)
+    assert thermal.predict(helper._get_temperatures()) is None
@@ -0,0 +1,169 @@
+import asyncio
+import socket
+
+import pytest
+
+import flashtool
+from flashtool import ACK_ERROR, BOOTLOADER_CMDS
+from katapult_emulator import KatapultEmulator
+from katapult_node import flash, flashed_image, make_image
+
+
+def test_windowed_send_recovers_lost_blocks(tmp_path):
+    fw_path = tmp_path.joinpath("klipper.bin")
+    image = make_image(fw_path, 24000)
+    emulator = KatapultEmulator(latency=.0005, loss=.03, seed=1)
+    flasher = asyncio.run(flash(emulator, fw_path, window=8))
+    assert flashed_image(emulator, len(image)) == image
+    assert emulator.completed
+    events = flasher.telemetry.commands["SEND_BLOCK"]["events"]
+    assert events.get("retransmit", 0) > 0
+    assert flasher.telemetry.info["blocks_written"] == flasher.block_count
+
+
+def test_diff_write_only_changed_pages(tmp_path):
+    fw_path = tmp_path.joinpath("klipper.bin")
+    image = make_image(fw_path, 20000)
+    emulator = KatapultEmulator(mcu_type="stm32f103xe")
+    asyncio.run(flash(emulator, fw_path, window=4, device_id="can:0a0b"))
+    image[9000] ^= 0xFF
+    fw_path.write_bytes(image)
+    emulator.reset()
+    flasher = asyncio.run(
+        flash(emulator, fw_path, window=4, diff=True, device_id="can:0a0b")
+    )
+    assert flasher.contents_cached
+    # One 2 KiB page of 64 byte blocks is rewritten
+    assert emulator.blocks_written == 2048 // 64
+    assert flashed_image(emulator, len(image)) == image
+    assert emulator.completed
+
+
+def test_diff_write_with_stale_cache_fails_verify(tmp_path):
+    fw_path = tmp_path.joinpath("klipper.bin")
+    image = make_image(fw_path, 20000)
+    emulator = KatapultEmulator(mcu_type="stm32f103xe")
+    asyncio.run(flash(emulator, fw_path, window=4, device_id="can:0c0d"))
+    # Another tool changes a block the cache still records as flashed
+    addr = emulator.app_start + 64 * 10
+    emulator.flash[addr] = b"\x00" * 64
+    image[15000] ^= 0xFF
+    fw_path.write_bytes(image)
+    emulator.reset()
+    with pytest.raises(flashtool.FlashError, match="Checksum mismatch"):
+        asyncio.run(
+            flash(emulator, fw_path, window=4, diff=True, device_id="can:0c0d")
+        )
+    # The corrupt app must not be started
+    assert not emulator.completed
+    assert "can:0c0d" not in flashtool.FlashStateCache()._load()
+    # The next differential run reads the flash back and repairs it
+    emulator.reset()
+    flasher = asyncio.run(
+        flash(emulator, fw_path, window=4, diff=True, device_id="can:0c0d")
+    )
+    assert not flasher.contents_cached
+    assert flashed_image(emulator, len(image)) == image
+    assert emulator.completed
+
+
+def test_tty_devices_do_not_cache_contents(tmp_path):
+    fw_path = tmp_path.joinpath("klipper.bin")
+    make_image(fw_path, 8000)
+    emulator = KatapultEmulator(mcu_type="stm32f103xe")
+    asyncio.run(flash(emulator, fw_path, device_id="tty:/dev/ttyS2"))
+    emulator.reset()
+    flasher = asyncio.run(
+        flash(emulator, fw_path, diff=True, device_id="tty:/dev/ttyS2")
+    )
+    assert not flasher.contents_cached
+    assert emulator.blocks_written == 0
+
+
+class FailingEmulator(KatapultEmulator):
+    # Rejects every block write once fail_after blocks were written
+    fail_after = None
+
+    def _handle_command(self, cmd, payload):
+        if (
+            self.fail_after is not None and
+            cmd == BOOTLOADER_CMDS["SEND_BLOCK"] and
+            self.blocks_written >= self.fail_after
+        ):
+            return self._build_response(ACK_ERROR, cmd)
+        return super()._handle_command(cmd, payload)
+
+
+def test_interrupted_write_resumes_from_checkpoint(tmp_path):
+    fw_path = tmp_path.joinpath("klipper.bin")
+    image = make_image(fw_path, 40000)
+    emulator = FailingEmulator(mcu_type="stm32f103xe")
+    emulator.fail_after = 400
+    with pytest.raises(flashtool.FlashError):
+        asyncio.run(flash(emulator, fw_path, window=4, device_id="can:0e0f"))
+    # A partial image must not be started
+    assert not emulator.completed
+    checkpoint = flashtool.FlashStateCache()._load()["can:0e0f"]["checkpoint"]
+    assert checkpoint == emulator.app_start + 400 * 64
+    emulator.fail_after = None
+    emulator.reset()
+    flasher = asyncio.run(
+        flash(emulator, fw_path, window=4, device_id="can:0e0f")
+    )
+    # Writing restarts at the start of the 2 KiB page of the checkpoint
+    resumed_at = flasher.telemetry.info["resumed_at"]
+    assert resumed_at == checkpoint - checkpoint % 2048
+    assert emulator.blocks_written == (
+        flasher.block_count - (resumed_at - emulator.app_start) // 64
+    )
+    assert flashed_image(emulator, len(image)) == image
+    assert emulator.completed
+    assert "checkpoint" not in flashtool.FlashStateCache()._load()["can:0e0f"]
+
+
+def test_can_send_ring_applies_backpressure(monkeypatch):
+    # Stand a small-buffered socketpair in for the CAN socket, frames
+    # are read back slower than they are queued
+    monkeypatch.setattr(flashtool.socket, "PF_CAN", socket.AF_UNIX)
+    monkeypatch.setattr(flashtool.socket, "SOCK_RAW", socket.SOCK_DGRAM)
+    monkeypatch.setattr(flashtool.socket, "CAN_RAW", 0, raising=False)
+    payload = bytes(range(256)) * 2 + b"tail"
+    received = bytearray()
+
+    async def run() -> int:
+        cansock = flashtool.CanSocket(flashtool._make_args(query=True))
+        tx, rx = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        tx.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        tx.setblocking(False)
+        rx.setblocking(False)
+        cansock.cansock.close()
+        cansock.cansock = tx
+        cansock.closed = False
+        node = flashtool.CanNode(0x200, cansock)
+
+        async def read_frames() -> None:
+            while len(received) < len(payload) * 20:
+                await asyncio.sleep(.002)
+                for _ in range(20):
+                    try:
+                        frame = rx.recv(flashtool.CANFD_FRAME_SIZE)
+                    except BlockingIOError:
+                        break
+                    _, length, data = flashtool.CAN_STRUCT.unpack(frame)
+                    received.extend(data[:length])
+
+        reader = asyncio.create_task(read_frames())
+        for _ in range(20):
+            node.write(payload)
+            await node.drain()
+            ring = cansock.output_rings[0x200]
+            assert ring.count <= flashtool.CAN_TX_QUEUE_LIMIT
+        await asyncio.wait_for(reader, 10)
+        capacity = cansock.output_rings[0x200].capacity
+        cansock.close()
+        rx.close()
+        return capacity
+
+    capacity = asyncio.run(run())
+    assert capacity == flashtool.CAN_TX_RING_FRAMES
+    assert received == payload * 20